@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Measure DNS lookup latency for names outside the cluster, with all queries
+sent to the cluster (sshuttle --dns), with --split-dns, and with all queries
+sent to the cluster through the local DNS cache (the default on Linux).
+
+Everything runs locally: a nameserver standing in for the proxy's DNS server,
+which answers after --rtt milliseconds (the cost of going through sshuttle,
+SSH and kubectl port-forward), and a nameserver standing in for the local
+one. All modes use the DNS stub from telepresence.dns; in 'all' mode it
+sends every query to the cluster, as sshuttle --dns would. In 'cached' mode
+the same --names names are looked up over and over, as an application that
+doesn't cache DNS itself would; a real session only gets this with
+--dns-cache, since the cache is off by default.
+
+$ benchmarks/dns_lookup_latency.py --rtt 50
+  mode      p50      p90      p99  (milliseconds)
+   all     50.8     50.9     52.7
+ split      0.2      0.2      0.4
+cached      0.0      0.1     50.8
+"""
+
+import argparse
+import os
+import socket
+import sys
+from threading import Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telepresence.dns import RemoteDomains, SplitDomains, StubResolver, \
+    parse_question, query  # noqa: E402
+
+
+class NullRunner(object):
+    def write(self, message):
+        pass
+
+
+def start_nameserver(delay):
+    """
+    Start a nameserver that answers every A query with 1.2.3.4 after delay
+    seconds, and return its port.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+
+    def respond(data, address):
+        sleep(delay)
+        server.sendto(
+            data[:2] + b"\x81\x80" + data[4:6] + b"\x00\x01\x00\x00\x00\x00" +
+            data[12:] + b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x05\x00\x04" +
+            socket.inet_aton("1.2.3.4"), address
+        )
+
+    def serve():
+        while True:
+            data, address = server.recvfrom(4096)
+            if parse_question(data) is None:
+                continue
+            thread = Thread(target=respond, args=(data, address))
+            thread.daemon = True
+            thread.start()
+
+    thread = Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rtt", type=float, default=50, help="Cluster RTT in milliseconds"
+    )
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument(
+        "--names",
+        type=int,
+        default=10,
+        help="Names used in 'cached' (--dns-cache) mode"
+    )
+    args = parser.parse_args()
+
+    remote = ("127.0.0.1", start_nameserver(args.rtt / 1000))
+    local = ("127.0.0.1", start_nameserver(0))
+    print("{:>6} {:>8} {:>8} {:>8}  (milliseconds)".format(
+        "mode", "p50", "p90", "p99"
+    ))
+    for mode, domains, names in [
+        ("all", RemoteDomains(), args.samples),
+        ("split", SplitDomains(["default"], ["corp.example.com"]),
+         args.samples),
+        ("cached", RemoteDomains(), args.names),
+    ]:
+        stub = StubResolver(
+            NullRunner(), domains, remote, local, cache=mode == "cached"
+        )
+        stub.start()
+        samples = []
+        for i in range(args.samples):
+            name = "host{}.example.com".format(i % names)
+            start = time()
+            query("127.0.0.1", name, 5, stub.port)
+            samples.append(time() - start)
+        stub.close()
+        print(
+            "{:>6} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                mode, *[
+                    percentile(samples, p) * 1000 for p in (0.5, 0.9, 0.99)
+                ]
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
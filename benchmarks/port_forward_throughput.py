@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Measure how aggregate tunnel throughput scales with the number of kubectl
+port-forward streams to a proxy pod (see telepresence --port-forwards).
+
+Needs a running datawire/telepresence-k8s pod, e.g. one started by
+'telepresence --new-deployment bench --run sleep 1000000'. For each N it
+opens N port-forwards to the pod's sshd, downloads --megabytes from the pod
+over each in parallel, and prints aggregate throughput:
+
+$ benchmarks/port_forward_throughput.py --pod bench-1234-abcd --max 8
+streams  seconds     MB/s
+      1    12.41     8.06
+      2     6.50    15.38
+      ...
+"""
+
+import argparse
+import os
+import sys
+from subprocess import Popen, DEVNULL
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telepresence.runner import Runner  # noqa: E402
+from telepresence.ssh import SSH  # noqa: E402
+from telepresence.utilities import find_free_port  # noqa: E402
+
+
+def start_port_forwards(args, runner, count):
+    """Start port-forwards, return (list of Popen, list of SSH)."""
+    processes = []
+    sshs = []
+    for _ in range(count):
+        ssh = SSH(runner, find_free_port())
+        processes.append(
+            Popen(
+                runner.kubectl(
+                    args.context, args.namespace,
+                    ["port-forward", args.pod, "{}:8022".format(ssh.port)]
+                ),
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+            )
+        )
+        sshs.append(ssh)
+    for ssh in sshs:
+        ssh.wait()
+    return processes, sshs
+
+
+def download(sshs, megabytes):
+    """Download megabytes over each SSH in parallel, return seconds taken."""
+    start = time()
+    readers = [
+        Popen(
+            ssh.command([
+                "head", "-c", str(megabytes * 1024 * 1024), "/dev/zero"
+            ]),
+            stdout=DEVNULL,
+            stderr=DEVNULL
+        ) for ssh in sshs
+    ]
+    for reader in readers:
+        reader.wait()
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pod", required=True)
+    parser.add_argument("--context", default=None)
+    parser.add_argument("--namespace", default="default")
+    parser.add_argument("--max", type=int, default=8, help="Maximum N")
+    parser.add_argument(
+        "--megabytes", type=int, default=50, help="Data per stream"
+    )
+    args = parser.parse_args()
+    runner = Runner.open("/dev/null", "kubectl", False)
+    if args.context is None:
+        args.context = runner.get_output([
+            "kubectl", "config", "current-context"
+        ])
+    print("{:>7} {:>8} {:>8}".format("streams", "seconds", "MB/s"))
+    count = 1
+    while count <= args.max:
+        processes, sshs = start_port_forwards(args, runner, count)
+        try:
+            elapsed = download(sshs, args.megabytes)
+        finally:
+            for process in processes:
+                process.terminate()
+        print(
+            "{:>7} {:>8.2f} {:>8.2f}".format(
+                count, elapsed, count * args.megabytes / elapsed
+            )
+        )
+        count *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Measure SOCKS connect latency through a slow tunnel, with and without the
+pre-handshaked connection pool used by --method inject-tcp (--socks-pool).
+
+Everything runs locally: the k8s-proxy SOCKS server, a relay that adds
+--rtt milliseconds of round trip time (standing in for SSH over kubectl
+port-forward), and a TCP server to connect to. Each sample is the time from
+a client opening a connection until the SOCKS CONNECT succeeds, which is
+what torsocks waits for before the application's connect() returns.
+
+$ benchmarks/socks_connect_latency.py --rtt 20
+pool      p50      p90      p99  (milliseconds)
+   0     43.4     45.3     48.0
+   4     22.2     24.6     43.4
+"""
+
+import argparse
+import os
+import socket
+import struct
+import sys
+from threading import Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "k8s-proxy"))
+
+from telepresence.balancer import (  # noqa: E402
+    RoundRobinProxy, SOCKSPool, recv_exactly
+)
+from telepresence.utilities import find_free_port  # noqa: E402
+
+
+class NullRunner(object):
+    def write(self, message):
+        pass
+
+
+def listener():
+    """Return listening socket on a random local port."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+    return server
+
+
+def serve_forever(server, handler):
+    def loop():
+        while True:
+            conn, _ = server.accept()
+            thread = Thread(target=handler, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    thread = Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+
+
+def delayed_pipe(source, destination, delay):
+    """Copy data, adding delay seconds of latency."""
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            sleep(delay)
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def start_slow_relay(upstream_port, rtt):
+    """Start relay adding rtt seconds round trip time, return its port."""
+    server = listener()
+
+    def handle(client):
+        upstream = socket.create_connection(("127.0.0.1", upstream_port))
+        back = Thread(target=delayed_pipe, args=(upstream, client, rtt / 2))
+        back.daemon = True
+        back.start()
+        delayed_pipe(client, upstream, rtt / 2)
+
+    serve_forever(server, handle)
+    return server.getsockname()[1]
+
+
+def start_socks_server():
+    """Run the k8s-proxy SOCKS server in a thread, return its port."""
+    from twisted.internet import reactor
+    import socks
+    port = find_free_port()
+    reactor.listenTCP(port, socks.SOCKSv5Factory(), interface="127.0.0.1")
+    thread = Thread(
+        target=reactor.run, kwargs={"installSignalHandlers": False}
+    )
+    thread.daemon = True
+    thread.start()
+    return port
+
+
+def socks_connect(port, target_port):
+    """Do what torsocks does for a connect(), return seconds taken."""
+    start = time()
+    client = socket.create_connection(("127.0.0.1", port))
+    client.sendall(b"\x05\x01\x00")
+    assert recv_exactly(client, 2) == b"\x05\x00"
+    client.sendall(
+        b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") +
+        struct.pack("!H", target_port)
+    )
+    assert recv_exactly(client, 10)[1] == 0
+    elapsed = time() - start
+    client.close()
+    return elapsed
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--rtt", type=float, default=50, help="Tunnel RTT in milliseconds"
+    )
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--pool", type=int, default=4)
+    args = parser.parse_args()
+
+    target = listener()
+    serve_forever(target, lambda conn: conn.close())
+    tunnel_port = start_slow_relay(start_socks_server(), args.rtt / 1000)
+
+    print("{:>4} {:>8} {:>8} {:>8}  (milliseconds)".format(
+        "pool", "p50", "p90", "p99"
+    ))
+    for size in (0, args.pool):
+        port = find_free_port()
+        if size:
+            front_end = SOCKSPool(NullRunner(), port, [tunnel_port], size)
+        else:
+            front_end = RoundRobinProxy(NullRunner(), port, [tunnel_port])
+        front_end.start()
+        samples = []
+        for _ in range(args.samples):
+            samples.append(socks_connect(port, target.getsockname()[1]))
+            # Like a real application, don't connect in a tight loop; gives
+            # the pool a chance to refill:
+            sleep(args.rtt / 1000 * 2)
+        front_end.close()
+        print(
+            "{:>4} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                size, *[
+                    percentile(samples, p) * 1000 for p in (0.5, 0.9, 0.99)
+                ]
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Compare the sshfs mount profiles (telepresence --mount-profile) on stat,
+readdir and sequential read performance.
+
+Runs a throwaway sshd on localhost serving a generated directory tree, mounts
+it with each profile's options, and times: stat() of every file, twice (the
+second pass is what caching helps), listing every directory, and reading one
+large file. A real tunnel to the cluster adds a round trip to every
+operation that isn't cached, so differences there are larger.
+
+Needs sshd, sftp-server and sshfs installed:
+
+$ benchmarks/sshfs_profiles.py --files 2000
+   profile  stat 1st  stat 2nd   readdir      MB/s
+consistent       ...
+   default       ...
+read-heavy       ...
+(milliseconds, except for MB/s)
+"""
+
+import argparse
+import getpass
+import os
+import sys
+from pathlib import Path
+from shutil import rmtree, which
+from subprocess import DEVNULL, Popen, check_call
+from tempfile import mkdtemp
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telepresence.remote import MOUNT_PROFILES  # noqa: E402
+from telepresence.utilities import find_free_port  # noqa: E402
+
+SFTP_SERVERS = [
+    "/usr/lib/openssh/sftp-server",
+    "/usr/libexec/openssh/sftp-server",
+    "/usr/libexec/sftp-server",
+    "/usr/lib/ssh/sftp-server",
+]
+
+
+def start_sshd(workdir):
+    """Start sshd on a free port, return (process, port, private key path)."""
+    existing = [path for path in SFTP_SERVERS if Path(path).exists()]
+    if not existing:
+        raise SystemExit("Can't find sftp-server")
+    host_key = workdir / "host_key"
+    client_key = workdir / "client_key"
+    for key in (host_key, client_key):
+        check_call([
+            "ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f",
+            str(key)
+        ])
+    authorized = workdir / "authorized_keys"
+    authorized.write_text((workdir / "client_key.pub").read_text())
+    port = find_free_port()
+    config = workdir / "sshd_config"
+    config.write_text(
+        "\n".join([
+            "Port {}".format(port),
+            "ListenAddress 127.0.0.1",
+            "HostKey {}".format(host_key),
+            "AuthorizedKeysFile {}".format(authorized),
+            "PidFile {}".format(workdir / "sshd.pid"),
+            "StrictModes no",
+            "UsePAM no",
+            "Subsystem sftp {}".format(existing[0]),
+        ]) + "\n"
+    )
+    process = Popen(
+        [which("sshd") or "/usr/sbin/sshd", "-D", "-e", "-f",
+         str(config)],
+        stderr=DEVNULL
+    )
+    sleep(0.5)
+    return process, port, client_key
+
+
+def make_tree(root, files, megabytes):
+    """Create files spread over directories of 100, and one large file."""
+    for i in range(files):
+        directory = root / "dir{}".format(i // 100)
+        directory.mkdir(exist_ok=True)
+        (directory / "file{}".format(i)).write_text("x" * 100)
+    with (root / "large").open("wb") as f:
+        f.write(os.urandom(megabytes * 2**20))
+
+
+def mount(profile, port, key, tree, mount_dir):
+    options = [
+        "StrictHostKeyChecking=no",
+        "UserKnownHostsFile=/dev/null",
+        "IdentityFile={}".format(key),
+        "IdentitiesOnly=yes",
+    ] + MOUNT_PROFILES[profile]
+    command = ["sshfs", "-p", str(port), "-F", "/dev/null"]
+    for option in options:
+        command += ["-o", option]
+    remote = "{}@127.0.0.1:{}".format(getpass.getuser(), tree)
+    check_call(command + [remote, str(mount_dir)])
+
+
+def unmount(mount_dir):
+    if sys.platform.startswith("linux"):
+        check_call(["fusermount", "-u", str(mount_dir)])
+    else:
+        check_call(["umount", str(mount_dir)])
+
+
+def timed(function):
+    start = time()
+    function()
+    return time() - start
+
+
+def stat_all(root):
+    for directory in root.glob("dir*"):
+        for path in directory.iterdir():
+            path.stat()
+
+
+def list_all(root):
+    for directory in root.glob("dir*"):
+        os.listdir(str(directory))
+
+
+def read_large(root):
+    with (root / "large").open("rb") as f:
+        while f.read(2**20):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--megabytes", type=int, default=100)
+    args = parser.parse_args()
+
+    workdir = Path(mkdtemp())
+    sshd = None
+    try:
+        sshd, port, key = start_sshd(workdir)
+        tree = workdir / "tree"
+        tree.mkdir()
+        make_tree(tree, args.files, args.megabytes)
+        print("{:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            "profile", "stat 1st", "stat 2nd", "readdir", "MB/s"
+        ))
+        for profile in sorted(MOUNT_PROFILES):
+            mount_dir = workdir / ("mount-" + profile)
+            mount_dir.mkdir()
+            mount(profile, port, key, tree, mount_dir)
+            try:
+                first = timed(lambda: stat_all(mount_dir))
+                second = timed(lambda: stat_all(mount_dir))
+                readdir = timed(lambda: list_all(mount_dir))
+                read = timed(lambda: read_large(mount_dir))
+            finally:
+                unmount(mount_dir)
+            print(
+                "{:>10} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                    profile, first * 1000, second * 1000, readdir * 1000,
+                    args.megabytes / read
+                )
+            )
+        print("(milliseconds, except for MB/s)")
+    finally:
+        if sshd is not None:
+            sshd.terminate()
+        rmtree(str(workdir), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Compare the --swap-strategy options on how long swapping a Deployment in and
+out takes, and whether the Deployment drops to zero ready pods meanwhile.
+
+Needs a cluster to talk to, ideally a local one like minikube or kind, and
+an existing Deployment to swap (use one nobody depends on). For each strategy
+it makes the same changes telepresence does, waits with kubectl rollout
+status until the swapped pod is ready (swap-in), then undoes them and waits
+for the original pods (swap-out):
+
+$ benchmarks/swap_strategies.py --deployment myapp --rounds 3
+strategy   swap-in  swap-out  min ready
+   patch       ...       ...        ...
+ replace       ...       ...        ...
+(seconds; min ready is the fewest ready pods seen)
+"""
+
+import argparse
+import json
+import os
+import sys
+from subprocess import DEVNULL, check_call, check_output, run
+from threading import Event, Thread
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telepresence import TELEPRESENCE_REMOTE_IMAGE  # noqa: E402
+from telepresence.deployment import new_swapped_deployment, \
+    swap_patches  # noqa: E402
+
+
+def kubectl(args, *command):
+    result = ["kubectl"]
+    if args.context:
+        result += ["--context", args.context]
+    if args.namespace:
+        result += ["--namespace", args.namespace]
+    return result + list(command)
+
+
+class ReadyWatcher(object):
+    """Poll the Deployment's ready replica count, remembering the lowest."""
+
+    def __init__(self, args):
+        self.args = args
+        self.minimum = None
+        self.stopped = Event()
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            try:
+                ready = int(
+                    check_output(
+                        kubectl(
+                            self.args, "get", "deployment",
+                            self.args.deployment, "-o",
+                            "jsonpath={.status.readyReplicas}"
+                        ),
+                        stderr=DEVNULL
+                    ).decode("ascii").strip() or 0
+                )
+            except Exception:
+                # Deleted, with the replace strategy:
+                ready = 0
+            if self.minimum is None or ready < self.minimum:
+                self.minimum = ready
+            sleep(0.2)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.minimum
+
+
+def wait_for_rollout(args):
+    check_call(
+        kubectl(
+            args, "rollout", "status", "deployment/" + args.deployment,
+            "--timeout=300s"
+        ),
+        stdout=DEVNULL
+    )
+
+
+def replace(args, deployment):
+    check_call(kubectl(args, "delete", "deployment", args.deployment))
+    run(
+        kubectl(args, "apply", "-f", "-"),
+        input=json.dumps(deployment).encode("utf-8"),
+        stdout=DEVNULL,
+        check=True
+    )
+
+
+def patch(args, operations):
+    check_call(
+        kubectl(
+            args, "patch", "deployment", args.deployment, "--type=json",
+            "--patch=" + json.dumps(operations)
+        ),
+        stdout=DEVNULL
+    )
+
+
+def timed_swap(args, swap, restore):
+    """Run swap then restore, return (swap-in, swap-out, min ready)."""
+    watcher = ReadyWatcher(args)
+    start = time()
+    swap()
+    wait_for_rollout(args)
+    swap_in = time() - start
+    start = time()
+    restore()
+    wait_for_rollout(args)
+    swap_out = time() - start
+    return swap_in, swap_out, watcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--context")
+    parser.add_argument("--namespace")
+    parser.add_argument("--deployment", required=True)
+    parser.add_argument("--container", help="Default: the first one")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    original = json.loads(
+        check_output(
+            kubectl(
+                args, "get", "deployment", args.deployment, "-o", "json",
+                "--export"
+            )
+        ).decode("utf-8")
+    )
+    container = args.container or original["spec"]["template"]["spec"][
+        "containers"
+    ][0]["name"]
+    swapped, _ = new_swapped_deployment(
+        original, container, "benchmark", TELEPRESENCE_REMOTE_IMAGE, False,
+        False
+    )
+    swap, restore = swap_patches(original, swapped, container)
+    strategies = [
+        ("patch", lambda: patch(args, swap), lambda: patch(args, restore)),
+        (
+            "replace", lambda: replace(args, swapped),
+            lambda: replace(args, original)
+        ),
+    ]
+
+    print("{:>8} {:>9} {:>9} {:>10}".format(
+        "strategy", "swap-in", "swap-out", "min ready"
+    ))
+    for name, do_swap, do_restore in strategies:
+        results = [
+            timed_swap(args, do_swap, do_restore) for _ in range(args.rounds)
+        ]
+        print(
+            "{:>8} {:>9.1f} {:>9.1f} {:>10}".format(
+                name,
+                sum(r[0] for r in results) / len(results),
+                sum(r[1] for r in results) / len(results),
+                min(r[2] for r in results),
+            )
+        )
+    print("(seconds; min ready is the fewest ready pods seen)")
+
+
+if __name__ == '__main__':
+    main()
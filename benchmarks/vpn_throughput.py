@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Measure TCP throughput and connection rate from this machine to a pod, for
+comparing --method vpn-tcp (sshuttle) with --method vpn-tun.
+
+Run it inside a telepresence session, with the method to measure:
+
+$ telepresence --method vpn-tun --run benchmarks/vpn_throughput.py
+$ telepresence --method vpn-tcp --run benchmarks/vpn_throughput.py
+
+It starts a small TCP server in the proxy pod with kubectl exec, connects to
+the pod's IP, and prints e.g.:
+
+ streams       MB/s
+       1      41.20
+       4      63.85
+connections/s: 212.4
+"""
+
+import argparse
+import os
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import DEVNULL, Popen, check_output
+from time import sleep, time
+
+PORT = 9099
+
+# Sends as many bytes as asked for by an 8 byte count, then closes:
+SERVER_PY = """
+import socket, struct, threading
+CHUNK = b"x" * 65536
+def handle(conn):
+    remaining = struct.unpack("!Q", conn.recv(8))[0]
+    while remaining > 0:
+        remaining -= conn.send(CHUNK[:remaining])
+    conn.close()
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(("0.0.0.0", {port}))
+server.listen(128)
+while True:
+    conn, _ = server.accept()
+    threading.Thread(target=handle, args=(conn,), daemon=True).start()
+""".format(port=PORT)
+
+
+def kubectl(args, *command):
+    result = ["kubectl"]
+    if args.context:
+        result += ["--context", args.context]
+    if args.namespace:
+        result += ["--namespace", args.namespace]
+    return result + list(command)
+
+
+def fetch(ip, size):
+    """Download size bytes from the server, return how many arrived."""
+    conn = socket.create_connection((ip, PORT))
+    conn.sendall(struct.pack("!Q", size))
+    received = 0
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    conn.close()
+    return received
+
+
+def wait_for_server(ip, timeout=30):
+    start = time()
+    while time() - start < timeout:
+        try:
+            fetch(ip, 0)
+            return
+        except OSError:
+            sleep(0.5)
+    raise SystemExit("Server in pod isn't reachable at {}".format(ip))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--context")
+    parser.add_argument("--namespace")
+    parser.add_argument(
+        "--pod", default=os.environ.get("TELEPRESENCE_POD"),
+        help="Pod to run the server in (default: the proxy pod)"
+    )
+    parser.add_argument(
+        "--container", default=os.environ.get("TELEPRESENCE_CONTAINER")
+    )
+    parser.add_argument("--megabytes", type=int, default=100)
+    parser.add_argument("--streams", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=200)
+    args = parser.parse_args()
+    if args.pod is None:
+        raise SystemExit("Run this inside telepresence, or give --pod")
+
+    exec_command = ["exec", args.pod]
+    if args.container:
+        exec_command += ["--container", args.container]
+    server = Popen(
+        kubectl(args, *exec_command, "--", "python3", "-c", SERVER_PY),
+        stdout=DEVNULL,
+    )
+    try:
+        ip = check_output(
+            kubectl(
+                args, "get", "pod", args.pod, "-o", "jsonpath={.status.podIP}"
+            )
+        ).decode("ascii").strip()
+        wait_for_server(ip)
+
+        print("{:>8} {:>10}".format("streams", "MB/s"))
+        for streams in sorted({1, args.streams}):
+            size = args.megabytes * 2**20 // streams
+            start = time()
+            with ThreadPoolExecutor(streams) as executor:
+                total = sum(executor.map(fetch, [ip] * streams, [size] *
+                                         streams))
+            elapsed = time() - start
+            print("{:>8} {:>10.2f}".format(streams, total / 2**20 / elapsed))
+
+        start = time()
+        for _ in range(args.connections):
+            fetch(ip, 0)
+        print(
+            "connections/s: {:.1f}".format(
+                args.connections / (time() - start)
+            )
+        )
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,4 +8,5 @@ if [ -z "$TELEPRESENCE_TESTS" ]; then
     [ -z "$TELEPRESENCE_OPENSHIFT" ] && [ "$TELEPRESENCE_METHOD" == "inject-tcp" ] && export TELEPRESENCE_TESTS="-n 4";
 fi
 env PATH="$PWD/cli/:$PATH" virtualenv/bin/py.test -v \
-    --timeout 360 --timeout-method thread --fulltrace $TELEPRESENCE_TESTS tests k8s-proxy/test_socks.py
+    --timeout 360 --timeout-method thread --fulltrace $TELEPRESENCE_TESTS tests k8s-proxy/test_socks.py \
+    k8s-proxy/test_agent.py
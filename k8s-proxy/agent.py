@@ -0,0 +1,91 @@
+"""
+Request/response agent, so telepresence can ask the pod questions over the
+SSH connection it already has, instead of running kubectl exec for each one.
+
+It listens on 127.0.0.1:9055 inside the pod. A request is a line of JSON with
+a "method" and its parameters. A response is a header line, "ok <length>" or
+"error <length>", followed by that many bytes:
+
+* {"method": "env"}: the environment the container started with, as
+  null-terminated KEY=value entries, so values can contain newlines.
+* {"method": "resolve", "hosts": [...]}: JSON object mapping each host to a
+  sorted list of its IPv4 addresses, or null if it can't be resolved. Hosts
+  are resolved in parallel.
+"""
+
+import json
+import socket
+from typing import Callable, Dict, List, Optional
+
+from twisted.internet import defer
+from twisted.internet.protocol import Factory
+from twisted.internet.threads import deferToThread
+from twisted.protocols.basic import LineReceiver
+
+# Written by run.sh before it changes anything:
+ENV_FILE = "/tmp/telepresence-env"
+
+
+def resolve(host: str) -> Optional[List[str]]:
+    """Return the IPv4 addresses of host, or None if lookup fails."""
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET)
+    except socket.error:
+        return None
+    return sorted(set(info[4][0] for info in infos))
+
+
+class AgentProtocol(LineReceiver):
+    delimiter = b"\n"
+
+    def lineReceived(self, line: bytes) -> None:
+        try:
+            request = json.loads(line.decode("utf-8"))
+            handler = self.factory.methods[request["method"]]
+        except (ValueError, KeyError, TypeError) as e:
+            self.failed(e)
+            return
+        d = defer.maybeDeferred(handler, request)
+        d.addCallbacks(self.respond, self.failed)
+
+    def respond(self, payload: bytes, status: bytes = b"ok") -> None:
+        self.transport.write(
+            status + b" " + str(len(payload)).encode("ascii") + b"\n" +
+            payload
+        )
+
+    def failed(self, failure) -> None:
+        print("Agent request failed: {}".format(failure))
+        self.respond(str(failure).encode("utf-8"), b"error")
+
+
+class AgentFactory(Factory):
+    protocol = AgentProtocol
+
+    def __init__(
+        self,
+        env_file: str = ENV_FILE,
+        resolve: Callable = resolve,
+        defer_to_thread: Callable = deferToThread,
+    ) -> None:
+        self.env_file = env_file
+        self.resolve = resolve
+        self.defer_to_thread = defer_to_thread
+        self.methods = {
+            "env": self.env,
+            "resolve": self.resolve_hosts,
+        }  # type: Dict[str, Callable]
+
+    def env(self, request: Dict) -> bytes:
+        with open(self.env_file, "rb") as f:
+            return f.read()
+
+    def resolve_hosts(self, request: Dict) -> defer.Deferred:
+        hosts = request["hosts"]
+        d = defer.gatherResults([
+            self.defer_to_thread(self.resolve, host) for host in hosts
+        ])
+        d.addCallback(
+            lambda ips: json.dumps(dict(zip(hosts, ips))).encode("utf-8")
+        )
+        return d
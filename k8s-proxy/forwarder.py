@@ -21,6 +21,7 @@ from twisted.internet import reactor, defer
 from twisted.internet.threads import deferToThread
 from twisted.names import client, dns, error, server
 
+import agent
 import socks
 
 DNSQueryResult = Union[defer.Deferred, Tuple[List[dns.RRHeader], List, List]]
@@ -226,6 +227,8 @@ def listen():
     protocol = dns.DNSDatagramProtocol(controller=factory)
 
     reactor.listenUDP(9053, protocol)
+    # Only reachable through SSH:
+    reactor.listenTCP(9055, agent.AgentFactory(), interface="127.0.0.1")
 
 
 predefined_namespace = os.getenv('TELEPRESENCE_CONTAINER_NAMESPACE', None)
@@ -1,5 +1,10 @@
 #!/usr/bin/env sh
 set -e
+
+# The environment the container started with, null-delimited, for agent.py to
+# hand out instead of telepresence running "kubectl exec env":
+cp "/proc/$$/environ" /tmp/telepresence-env
+
 USER_ID="$(id -u)"
 GROUP_ID="$(id -g)"
 
@@ -10,5 +15,37 @@ if [ "$USER_ID" = "0" ]; then
     chmod -R 0600 /etc/ssh/*
 fi
 
-/usr/sbin/sshd -e
+# For --method vpn-tun the client sends IP packets through a TUN device
+# tunnelled over SSH (ssh -w). They arrive on tun0 here, and get forwarded
+# and masqueraded as coming from the pod. Needs a privileged container:
+SSHD_OPTIONS=""
+if [ -n "$TELEPRESENCE_TUN" ]; then
+    mkdir -p /dev/net
+    [ -c /dev/net/tun ] || mknod /dev/net/tun c 10 200
+    ip tuntap add dev tun0 mode tun
+    ip addr add 198.18.1.2 peer 198.18.1.1 dev tun0
+    ip link set tun0 up
+    sysctl -w net.ipv4.ip_forward=1
+    iptables -t nat -A POSTROUTING -s 198.18.1.1 -j MASQUERADE
+    SSHD_OPTIONS="-o PermitTunnel=point-to-point"
+fi
+
+/usr/sbin/sshd -e $SSHD_OPTIONS
+
+# For --direct-ssh the client connects without going through kubectl
+# port-forward, so the SSH server may be reachable from outside the cluster.
+# Run a second server that only accepts the key generated by the client:
+if [ -n "$TELEPRESENCE_AUTHORIZED_KEY" ]; then
+    echo "$TELEPRESENCE_AUTHORIZED_KEY" > /tmp/authorized_keys
+    chmod 0600 /tmp/authorized_keys
+    /usr/sbin/sshd -e -p 8023 \
+        -o PidFile=/tmp/sshd-direct.pid \
+        -o AuthorizedKeysFile=/tmp/authorized_keys \
+        -o StrictModes=no \
+        -o PubkeyAuthentication=yes \
+        -o PasswordAuthentication=no \
+        -o PermitEmptyPasswords=no \
+        -o ChallengeResponseAuthentication=no
+fi
+
 exec env PYTHONPATH=/usr/src/app twistd -n -y ./forwarder.py
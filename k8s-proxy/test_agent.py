@@ -0,0 +1,79 @@
+"""
+Tests for L{agent}, the request/response agent telepresence uses instead of
+kubectl exec.
+"""
+
+import json
+import os
+import tempfile
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+import agent
+
+
+def parse_response(data):
+    header, _, payload = data.partition(b"\n")
+    status, length = header.split()
+    assert int(length) == len(payload)
+    return status, payload
+
+
+class AgentTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.env_file = tempfile.mkstemp()
+        self.addCleanup(os.remove, self.env_file)
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"A=1\0CERT=line1\nline2\0")
+        factory = agent.AgentFactory(
+            env_file=self.env_file,
+            resolve=lambda host: None if host == "nope" else ["10.0.0.1"],
+            defer_to_thread=lambda f, *args: defer.succeed(f(*args)),
+        )
+        self.proto = factory.buildProtocol(("127.0.0.1", 0))
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def request(self, request):
+        self.proto.dataReceived(json.dumps(request).encode("utf-8") + b"\n")
+        result = parse_response(self.transport.value())
+        self.transport.clear()
+        return result
+
+    def test_env(self):
+        """
+        The environment is sent as it was written, null-delimited.
+        """
+        self.assertEqual(
+            self.request({"method": "env"}),
+            (b"ok", b"A=1\0CERT=line1\nline2\0"),
+        )
+
+    def test_resolve(self):
+        """
+        All the hosts are resolved, and failures are null.
+        """
+        status, payload = self.request({
+            "method": "resolve",
+            "hosts": ["db", "nope"]
+        })
+        self.assertEqual(status, b"ok")
+        self.assertEqual(
+            json.loads(payload.decode("utf-8")), {
+                "db": ["10.0.0.1"],
+                "nope": None
+            }
+        )
+
+    def test_errors(self):
+        """
+        Unknown methods and bad requests get an error, and the connection can
+        still be used afterwards.
+        """
+        self.assertEqual(self.request({"method": "rm"})[0], b"error")
+        self.proto.dataReceived(b"not json\n")
+        self.assertEqual(parse_response(self.transport.value())[0], b"error")
+        self.transport.clear()
+        self.assertEqual(self.request({"method": "env"})[0], b"ok")
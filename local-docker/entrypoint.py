@@ -27,19 +27,29 @@ References:
 
 == Wait mode ==
 
-Wait mode should be run in same network namespace as the proxy. It will do the
-'hellotelepresence' loop used to correct DNS on the k8s proxy, and to detect
-when the proxy is working.
+Wait mode should be run in same network namespace as the proxy. It will send
+the 'hellotelepresence' DNS queries used to correct DNS on the k8s proxy, and
+to detect when the proxy is working.
 
 When the process exits with exit code 100 that means the proxy is active.
+
+
+== Routes mode ==
+
+Routes mode should be run in the proxy container, e.g. with 'docker exec'. It
+takes the same JSON-encoded object as proxy mode, and runs another
+sshuttle-telepresence that only routes the given CIDRs, for addresses that
+were noticed after the proxy started. It replaces the sshuttle started by the
+previous routes mode, if any, so there's only ever one.
 """
 
+import os
+import signal
 import sys
 from json import loads
 from subprocess import check_output, Popen
-from socket import gethostbyname, gaierror
-from time import time, sleep
 
+from telepresence.dns import wait_for_proxy_dns
 from telepresence.main import expose_local_services
 from telepresence.ssh import SSH
 from telepresence.cleanup import Subprocesses, wait_for_exit
@@ -52,55 +62,83 @@ def main():
         proxy(loads(sys.argv[2]))
     elif command == "wait":
         wait()
+    elif command == "routes":
+        routes(loads(sys.argv[2]))
+
+
+def get_host_ip(config: dict) -> str:
+    """Return the IP of the host, where the SSH server runs."""
+    if "ip" in config:
+        # Typically host is macOS:
+        return config["ip"]
+    # Typically host is Linux, use default route:
+    for line in str(check_output(["route"]), "ascii").splitlines():
+        parts = line.split()
+        if parts[0] == "default":
+            return parts[1]
+    raise RuntimeError("Couldn't find default route.")
+
+
+def sshuttle(ip: str, port: int, cidrs: list, dns: bool = True) -> list:
+    """Return sshuttle-telepresence command line."""
+    # XXX duplicates code in telepresence, remove duplication
+    command = ["sshuttle-telepresence", "-v"]
+    if dns:
+        command += ["--dns"]
+    command += [
+        "--method", "nat", "-e", (
+            "ssh -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null " +
+            "-F /dev/null"
+        )
+    ]
+    if dns:
+        command += ["--to-ns", "127.0.0.1:9053"]
+    return command + ["-r", "telepresence@{}:{}".format(ip, port)] + cidrs
 
 
 def proxy(config: dict):
     """Start sshuttle proxy to Kubernetes."""
     port = config["port"]
-    if "ip" in config:
-        # Typically host is macOS:
-        ip = config["ip"]
-    else:
-        # Typically host is Linux, use default route:
-        for line in str(check_output(["route"]), "ascii").splitlines():
-            parts = line.split()
-            if parts[0] == "default":
-                ip = parts[1]
-                break
+    ip = get_host_ip(config)
     cidrs = config["cidrs"]
     expose_ports = config["expose_ports"]
 
     # Start the sshuttle VPN-like thing:
-    # XXX duplicates code in telepresence, remove duplication
-    main_process = Popen([
-        "sshuttle-telepresence", "-v", "--dns", "--method", "nat", "-e", (
-            "ssh -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null " +
-            "-F /dev/null"
-        ), "--to-ns", "127.0.0.1:9053", "-r",
-        "telepresence@{}:{}".format(ip, port)
-    ] + cidrs)
+    main_process = Popen(sshuttle(ip, port, cidrs))
     # Start the SSH tunnels to expose local services:
     subps = Subprocesses()
     runner = Runner.open("-", "kubectl", False)
     ssh = SSH(runner, port, ip)
-    expose_local_services(subps, ssh, expose_ports)
+    expose_local_services(subps, [ssh], expose_ports)
 
     # Wait for everything to exit:
     wait_for_exit(runner, main_process, subps)
 
 
+# Process id of the sshuttle started by routes mode:
+ROUTES_PID_FILE = "/tmp/telepresence-routes.pid"
+
+
+def routes(config: dict):
+    """Route more CIDRs to Kubernetes, replacing earlier routes mode."""
+    try:
+        with open(ROUTES_PID_FILE) as f:
+            os.kill(int(f.read()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+    # exec keeps our process id:
+    with open(ROUTES_PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    os.execvp(
+        "sshuttle-telepresence",
+        sshuttle(get_host_ip(config), config["port"], config["cidrs"], False)
+    )
+
+
 def wait():
     """Wait for proxying to be live."""
-    start = time()
-    while time() - start < 10:
-        try:
-            gethostbyname("hellotelepresence")
-            sleep(1)  # just in case there's more to startup
-            sys.exit(100)
-        except gaierror:
-            sleep(0.1)
-        else:
-            sleep(0.1)
+    if wait_for_proxy_dns(10):
+        sys.exit(100)
     sys.exit("Failed to connect to proxy in remote cluster.")
 
 
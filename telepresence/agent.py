@@ -0,0 +1,112 @@
+"""
+Client for the agent in the proxy pod (k8s-proxy/agent.py), which answers
+questions about the pod over an SSH tunnel. Each request costs a round trip
+over the existing connection, rather than a new kubectl exec session through
+the API server.
+"""
+
+import json
+import socket
+from time import sleep, time
+from typing import Dict, List, Optional
+
+from telepresence.cleanup import Subprocesses
+from telepresence.runner import Runner
+from telepresence.ssh import SSH
+from telepresence.utilities import find_free_port
+
+# Port the agent listens on inside the pod:
+AGENT_PORT = 9055
+
+
+class AgentError(Exception):
+    """The agent couldn't be reached or failed to answer."""
+
+
+def parse_env(data: bytes) -> Dict[str, str]:
+    """Parse null-terminated KEY=value entries."""
+    result = {}  # type: Dict[str, str]
+    for entry in data.decode("utf-8", "replace").split("\0"):
+        if entry:
+            key, _, value = entry.partition("=")
+            result[key] = value
+    return result
+
+
+class Agent(object):
+    """Talks to the agent through a local port forwarded to it by SSH."""
+
+    def __init__(self, runner: Runner, port: int) -> None:
+        self.runner = runner
+        self.port = port
+
+    def _connect(self, timeout: float) -> socket.socket:
+        # The SSH tunnel may still be starting up:
+        start = time()
+        while True:
+            try:
+                return socket.create_connection(
+                    ("127.0.0.1", self.port), timeout
+                )
+            except ConnectionRefusedError:
+                if time() - start > timeout:
+                    raise
+                sleep(0.1)
+
+    def request(self, method: str, timeout: float = 10, **params) -> bytes:
+        """Send a request, return the payload of the response."""
+        start = time()
+        try:
+            conn = self._connect(timeout)
+            try:
+                conn.sendall(
+                    json.dumps(dict(params, method=method)).encode("utf-8") +
+                    b"\n"
+                )
+                response = conn.makefile("rb")
+                header = response.readline().split()
+                if len(header) != 2 or not header[1].isdigit():
+                    # E.g. an older proxy image with no agent, in which case
+                    # SSH accepts the connection and then drops it:
+                    raise AgentError(
+                        "Bad response header from agent: {}".format(header)
+                    )
+                payload = response.read(int(header[1]))
+            finally:
+                conn.close()
+        except OSError as e:
+            raise AgentError(str(e))
+        self.runner.write(
+            "Agent answered {} in {:.3f} seconds".format(
+                method, time() - start
+            )
+        )
+        if header[0] != b"ok":
+            raise AgentError(payload.decode("utf-8", "replace"))
+        return payload
+
+    def env(self) -> Dict[str, str]:
+        """Return the environment the proxy container started with."""
+        return parse_env(self.request("env"))
+
+    def resolve(self, hosts: List[str]) -> Dict[str, Optional[List[str]]]:
+        """
+        Resolve hostnames inside the pod, returning their IPv4 addresses, or
+        None for those that don't resolve.
+        """
+        return json.loads(
+            self.request("resolve", hosts=hosts).decode("utf-8")
+        )
+
+
+def start_agent_tunnel(
+    runner: Runner, processes: Subprocesses, ssh: SSH
+) -> Agent:
+    """Forward a local port to the agent, return an Agent that uses it."""
+    port = find_free_port()
+    tunnel_args = ["-L", "127.0.0.1:{}:127.0.0.1:{}".format(port, AGENT_PORT)]
+    processes.append(
+        ssh.popen(tunnel_args),
+        policy=ssh.tunnel_policy("Agent tunnel", tunnel_args),
+    )
+    return Agent(runner, port)
@@ -0,0 +1,229 @@
+import atexit
+import select
+import socket
+from itertools import cycle
+from queue import Queue, Empty
+from threading import Event, Thread
+from time import sleep
+from typing import List
+
+from telepresence.runner import Runner
+
+# Size of reads when copying data between sockets:
+BUFFER_SIZE = 65536
+
+
+def pipe(source: socket.socket, destination: socket.socket) -> None:
+    """Copy data from one socket to the other until EOF."""
+    try:
+        while True:
+            data = source.recv(BUFFER_SIZE)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        # Let the other side know we're done, and unblock the other pipe():
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def splice(client: socket.socket, upstream: socket.socket) -> None:
+    """Copy data in both directions between two sockets, then close them."""
+    other_direction = Thread(target=pipe, args=(upstream, client))
+    other_direction.daemon = True
+    other_direction.start()
+    pipe(client, upstream)
+    other_direction.join()
+    client.close()
+    upstream.close()
+
+
+class RoundRobinProxy(object):
+    """
+    Local TCP proxy that spreads connections over several upstream ports.
+
+    Each upstream port is typically an SSH tunnel running over its own kubectl
+    port-forward, so spreading connections across them spreads the load across
+    several API server streams.
+    """
+
+    def __init__(
+        self, runner: Runner, port: int, upstream_ports: List[int]
+    ) -> None:
+        self.runner = runner
+        self.port = port
+        self.upstream_ports = upstream_ports
+        self._next_port = cycle(upstream_ports)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen(128)
+
+    def start(self) -> None:
+        """Start accepting connections in a background thread."""
+        self.runner.write(
+            "Proxying 127.0.0.1:{} to ports {}".format(
+                self.port, self.upstream_ports
+            )
+        )
+        thread = Thread(target=self._accept_loop)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """Stop accepting connections."""
+        self.server.close()
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                # Closed
+                return
+            thread = Thread(target=self.handle, args=(client, ))
+            thread.daemon = True
+            thread.start()
+
+    def connect_upstream(self) -> socket.socket:
+        """Connect to the next upstream port."""
+        return socket.create_connection(("127.0.0.1", next(self._next_port)))
+
+    def handle(self, client: socket.socket) -> None:
+        """Proxy a single client connection."""
+        try:
+            upstream = self.connect_upstream()
+        except OSError as e:
+            self.runner.write("Failed to connect upstream: {}".format(e))
+            client.close()
+            return
+        splice(client, upstream)
+
+
+def recv_exactly(sock: socket.socket, length: int) -> bytes:
+    """Read exactly length bytes from a socket."""
+    result = b""
+    while len(result) < length:
+        data = sock.recv(length - len(result))
+        if not data:
+            raise OSError("Connection closed")
+        result += data
+    return result
+
+
+# SOCKS5 greeting offering only "no authentication", and the reply accepting
+# it:
+SOCKS_GREETING = b"\x05\x01\x00"
+SOCKS_NO_AUTH = b"\x05\x00"
+
+
+class SOCKSPool(RoundRobinProxy):
+    """
+    Local SOCKS front-end that keeps a pool of upstream connections whose
+    SOCKS greeting has already been done.
+
+    Upstream is the remote SOCKS proxy, reached via a SSH tunnel over kubectl
+    port-forward, so every round trip is slow. We answer the client's greeting
+    locally and hand it a pooled connection, so only the CONNECT (or RESOLVE)
+    round trip remains.
+    """
+
+    def __init__(
+        self, runner: Runner, port: int, upstream_ports: List[int], size: int
+    ) -> None:
+        RoundRobinProxy.__init__(self, runner, port, upstream_ports)
+        self.size = size
+        self.pool = Queue()  # type: Queue
+        self._taken = Event()
+        self._closed = False
+
+    def start(self) -> None:
+        RoundRobinProxy.start(self)
+        thread = Thread(target=self._fill_loop)
+        thread.daemon = True
+        thread.start()
+
+    def close(self) -> None:
+        self._closed = True
+        RoundRobinProxy.close(self)
+
+    def _new_connection(self) -> socket.socket:
+        """Connect upstream and do the greeting."""
+        upstream = self.connect_upstream()
+        try:
+            upstream.sendall(SOCKS_GREETING)
+            if recv_exactly(upstream, 2) != SOCKS_NO_AUTH:
+                raise OSError("Upstream SOCKS server refused greeting")
+        except OSError:
+            upstream.close()
+            raise
+        return upstream
+
+    def _fill_loop(self) -> None:
+        """Keep the pool full."""
+        delay = 0.1
+        while not self._closed:
+            if self.pool.qsize() >= self.size:
+                self._taken.wait(1)
+                self._taken.clear()
+                continue
+            try:
+                self.pool.put(self._new_connection())
+            except OSError as e:
+                # Tunnel is probably being reconnected:
+                self.runner.write("Failed to fill SOCKS pool: {}".format(e))
+                sleep(delay)
+                delay = min(delay * 2, 5)
+            else:
+                delay = 0.1
+
+    def take(self) -> socket.socket:
+        """Return an upstream connection that has done the greeting."""
+        while True:
+            try:
+                upstream = self.pool.get_nowait()
+            except Empty:
+                return self._new_connection()
+            finally:
+                self._taken.set()
+            # The upstream SOCKS server won't send anything until we do, so
+            # if it's readable it was closed, e.g. because the tunnel was
+            # reconnected:
+            if select.select([upstream], [], [], 0)[0]:
+                upstream.close()
+                continue
+            return upstream
+
+    def handle(self, client: socket.socket) -> None:
+        try:
+            version = recv_exactly(client, 1)
+            if version == b"\x05":
+                method_count = recv_exactly(client, 1)
+                methods = recv_exactly(client, method_count[0])
+                greeting = version + method_count + methods
+            else:
+                # SOCKS4/4a has no greeting; the first bytes are the request:
+                methods = b""
+                greeting = version
+        except (OSError, ValueError):
+            client.close()
+            return
+        try:
+            if version == b"\x05" and 0 in methods:
+                client.sendall(SOCKS_NO_AUTH)
+                upstream = self.take()
+            else:
+                # Something we don't do locally, let upstream deal with it:
+                upstream = self.connect_upstream()
+                upstream.sendall(greeting)
+        except OSError as e:
+            self.runner.write("Failed to connect upstream: {}".format(e))
+            client.close()
+            return
+        splice(client, upstream)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+from pathlib import Path
+from shutil import copy2
+from time import time
+from typing import Any, Optional
+
+import os
+
+
+def cache_dir() -> Path:
+    """Return the directory where Telepresence caches things."""
+    root = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(root) / "telepresence"
+
+
+class Cache(object):
+    """
+    A small JSON-backed key/value store on disk, with expiration.
+
+    Each named cache is its own file in cache_dir(). Failing to read or write
+    the file is never fatal; a broken cache just behaves like an empty one.
+    """
+
+    def __init__(self, name: str, directory: Optional[Path] = None) -> None:
+        if directory is None:
+            directory = cache_dir()
+        self.path = directory / (name + ".json")
+
+    def _load(self) -> dict:
+        try:
+            with self.path.open() as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(result, dict):
+            return {}
+        return result
+
+    def _save(self, entries: dict) -> None:
+        # Write to a temporary file and rename, so concurrent telepresence
+        # processes never see a partially written file:
+        temporary = self.path.with_name(
+            "{}.{}".format(self.path.name, os.getpid())
+        )
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Only readable by the current user, since some caches store the
+            # pod's environment, which may include secrets:
+            fd = os.open(
+                str(temporary), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(str(temporary), str(self.path))
+        except OSError:
+            pass
+
+    def get(self, key: str, ttl: float) -> Any:
+        """
+        Return the value stored for key, or None if there isn't one or it was
+        stored more than ttl seconds ago.
+        """
+        entry = self._load().get(key)
+        if not isinstance(entry, dict) or "value" not in entry:
+            return None
+        if time() - entry.get("stored", 0) > ttl:
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a JSON-serializable value for key."""
+        entries = self._load()
+        entries[key] = {"stored": time(), "value": value}
+        self._save(entries)
+
+    def delete(self, key: str) -> None:
+        """Remove key, if present."""
+        entries = self._load()
+        if entries.pop(key, None) is not None:
+            self._save(entries)
+
+
+class ContentCache(object):
+    """
+    Copies of remote files, kept across sessions so unchanged files needn't
+    be transferred again.
+
+    Files are keyed by their remote path, size and modification time. The
+    total size is kept under max_bytes by evicting the least recently used
+    files first; a file's modification time in the cache records its last
+    use. The cache directory is only accessible by the current user, since it
+    may contain secrets.
+    """
+
+    def __init__(
+        self, max_bytes: int, directory: Optional[Path] = None
+    ) -> None:
+        if directory is None:
+            directory = cache_dir() / "files"
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, path: str, size: int, mtime: int) -> Path:
+        key = "{}\0{}\0{}".format(path, size, mtime).encode("utf-8")
+        return self.directory / hashlib.sha256(key).hexdigest()
+
+    def restore(
+        self, path: str, size: int, mtime: int, destination: str
+    ) -> bool:
+        """
+        Copy the cached version of a file to destination, return whether
+        there was one.
+        """
+        cached = self._path(path, size, mtime)
+        try:
+            if cached.stat().st_size != size:
+                return False
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            copy2(str(cached), destination)
+            os.utime(destination, (mtime, mtime))
+            # Mark as recently used:
+            os.utime(str(cached))
+        except OSError:
+            return False
+        return True
+
+    def store(self, path: str, size: int, mtime: int, source: str) -> None:
+        """Add a copy of a file to the cache."""
+        if size > self.max_bytes:
+            return
+        cached = self._path(path, size, mtime)
+        temporary = cached.with_name(
+            "{}.{}".format(cached.name, os.getpid())
+        )
+        try:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            copy2(source, str(temporary))
+            os.utime(str(temporary))
+            os.replace(str(temporary), str(cached))
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """Remove least recently used files until we're within max_bytes."""
+        try:
+            files = [(entry.stat(), entry)
+                     for entry in self.directory.iterdir()]
+        except OSError:
+            return
+        total = sum(stat.st_size for (stat, _) in files)
+        for stat, entry in sorted(files, key=lambda f: f[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+            total -= stat.st_size
@@ -1,8 +1,9 @@
 import atexit
 import sys
 from subprocess import Popen, TimeoutExpired
-from time import sleep
-from typing import Optional, Callable, Dict
+from threading import RLock
+from time import sleep, time
+from typing import Optional, Callable, Dict, List, Set
 
 from telepresence.runner import Runner
 
@@ -18,19 +19,148 @@ def kill_process(process: Popen) -> None:
         process.wait()
 
 
+class RestartPolicy(object):
+    """
+    What to do when a registered subprocess exits.
+
+    Critical processes (the port-forward, SSH tunnels) are restarted in place,
+    but if they keep failing the whole session is shut down. Auxiliary
+    processes (e.g. the pod log follower) are restarted with exponential
+    backoff for as long as the session runs, and never shut it down.
+
+    Policies can be grouped: when a process with dependents (the kubectl
+    port-forward) is restarted, its dependents (the SSH tunnels running over
+    it) are restarted right after it. A dependent that can't be restarted on
+    its own triggers a restart of the whole group.
+
+    :ivar name str: Human readable description, for logging.
+    :ivar critical bool: Whether the session ends if restarting fails.
+    :ivar parent RestartPolicy: The policy this one depends on, if any.
+    :ivar dependents list: Policies that depend on this one.
+    """
+
+    def __init__(
+        self,
+        runner: Runner,
+        name: str,
+        restart: Callable[[], Popen],
+        critical: bool,
+        max_attempts: int = 3,
+        initial_delay: float = 0.5,
+        max_delay: float = 30,
+        stable_after: float = 60,
+    ) -> None:
+        """
+        :param restart: Launches a replacement process and returns it. May
+            raise an exception if the process can't be launched.
+        :param max_attempts: How many restarts in a row a critical process
+            gets before we give up.
+        :param initial_delay: Seconds to wait before the second attempt in a
+            row; doubled on each subsequent failure up to max_delay.
+        :param stable_after: If a process ran at least this many seconds
+            before dying, its earlier failures are forgotten.
+        """
+        self.runner = runner
+        self.name = name
+        self.restart = restart
+        self.critical = critical
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.failures = 0
+        self.started = time()
+        self.died = 0.0
+        self.next_attempt = 0.0
+        self.parent = None  # type: Optional[RestartPolicy]
+        self.dependents = []  # type: List[RestartPolicy]
+
+    def depends_on(self, parent: Optional["RestartPolicy"]) -> "RestartPolicy":
+        """
+        Make this policy part of parent's group, if there is a parent.
+
+        Returns self, for convenience.
+        """
+        if parent is not None:
+            self.parent = parent
+            parent.dependents.append(self)
+        return self
+
+    def process_died(self, now: float) -> None:
+        """Record that the current process exited."""
+        if now - self.started >= self.stable_after:
+            self.failures = 0
+        self.died = now
+        self.failures += 1
+        if self.failures == 1:
+            # First failure in a while, retry immediately:
+            self.next_attempt = now
+        else:
+            self.next_attempt = now + min(
+                self.initial_delay * 2**(self.failures - 2), self.max_delay
+            )
+
+    def gave_up(self) -> bool:
+        """Return whether a critical process has failed too often."""
+        return self.critical and self.failures > self.max_attempts
+
+    def escalate(self) -> bool:
+        """
+        Return whether the whole group should be restarted, rather than just
+        this process.
+
+        We try restarting a dependent on its own once; if that doesn't work the
+        problem is probably the process it depends on.
+        """
+        return self.parent is not None and self.failures > 1
+
+
+def critical(runner: Runner, name: str,
+             restart: Callable[[], Popen]) -> RestartPolicy:
+    """Policy for a process the session can't run without."""
+    return RestartPolicy(runner, name, restart, True)
+
+
+def auxiliary(runner: Runner, name: str,
+              restart: Callable[[], Popen]) -> RestartPolicy:
+    """Policy for a process the session can do without for a while."""
+    return RestartPolicy(runner, name, restart, False)
+
+
 class Subprocesses(object):
-    """Shut down subprocesses on exit."""
+    """
+    Shut down subprocesses on exit.
+
+    Processes may be added or relaunched from other threads (e.g. when new
+    routes are noticed) while the main thread checks on them, so all access
+    goes through a lock.
+    """
 
     def __init__(self):
-        Dict  # Avoid Pyflakes F401
+        Dict, List, Set  # Avoid Pyflakes F401
         self.subprocesses = {}  # type: Dict[Popen, Callable]
+        self.policies = {}  # type: Dict[Popen, RestartPolicy]
+        # Processes whose death we've already noticed, waiting for a restart:
+        self.dead = set()  # type: Set[Popen]
+        # Processes using the default killer, which needs to be recreated if
+        # the process is restarted:
+        self._default_killer = set()  # type: Set[Popen]
+        # Reentrant, since e.g. any_dead() calls killall():
+        self._lock = RLock()
         atexit.register(self.killall)
 
-    def append(self, process: Popen,
-               killer: Optional[Callable] = None) -> None:
+    def append(
+        self,
+        process: Popen,
+        killer: Optional[Callable] = None,
+        policy: Optional[RestartPolicy] = None,
+    ) -> None:
         """
         Register another subprocess to be shutdown, with optional callable that
         will kill it.
+
+        If a RestartPolicy is given the process will be restarted according to
+        it when it exits; otherwise its exit shuts down the session.
         """
         if killer is None:
 
@@ -38,27 +168,158 @@ class Subprocesses(object):
                 kill_process(process)
 
             killer = kill
-        self.subprocesses[process] = killer
+            with self._lock:
+                self._default_killer.add(process)
+        with self._lock:
+            if policy is not None:
+                policy.started = time()
+                self.policies[process] = policy
+            self.subprocesses[process] = killer
+
+    def replace(self, old: Popen, new: Popen) -> None:
+        """Register a restarted process in place of the one it replaces."""
+        with self._lock:
+            killer = self.subprocesses.pop(old)  # type: Optional[Callable]
+            policy = self.policies.pop(old, None)
+            self.dead.discard(old)
+            if old in self._default_killer:
+                self._default_killer.discard(old)
+                killer = None
+            self.append(new, killer, policy)
+
+    def relaunch(self, policy: RestartPolicy) -> None:
+        """
+        Start a new process with the policy's restart callable, e.g. because
+        its command line changed, and kill the process it replaces, if any.
+
+        Holding the lock throughout means any_dead() can't restart the old
+        process at the same time, leaving two of them running.
+        """
+        with self._lock:
+            new = policy.restart()
+            old = self._process_for(policy)
+            if old is None:
+                self.append(new, policy=policy)
+                return
+            killer = self.subprocesses[old]
+            self.replace(old, new)
+            killer()
 
     def killall(self):
         """Kill all registered subprocesses."""
-        for killer in self.subprocesses.values():
+        with self._lock:
+            killers = list(self.subprocesses.values())
+        for killer in killers:
             killer()
 
+    def _process_for(self, policy: RestartPolicy) -> Optional[Popen]:
+        """Return the currently registered process for a policy."""
+        with self._lock:
+            for process, process_policy in self.policies.items():
+                if process_policy is policy:
+                    return process
+        return None
+
+    def _restart(self, process: Popen, policy: RestartPolicy) -> None:
+        """Try to restart a dead process, if its policy says it's time."""
+        start = time()
+        if start < policy.next_attempt:
+            return
+        policy.runner.write(
+            "Restarting {} (attempt {})...".format(
+                policy.name, policy.failures
+            )
+        )
+        try:
+            new_process = policy.restart()
+        except Exception as e:
+            policy.runner.write(
+                "Failed to restart {}: {}".format(policy.name, e)
+            )
+            policy.process_died(time())
+            return
+        self.replace(process, new_process)
+        if not policy.dependents:
+            return
+        # Whatever was running over the old process is now useless, even if
+        # it hasn't noticed yet, so restart it as well:
+        for dependent in policy.dependents:
+            old = self._process_for(dependent)
+            if old is None:
+                continue
+            self.subprocesses[old]()
+            try:
+                self.replace(old, dependent.restart())
+            except Exception as e:
+                policy.runner.write(
+                    "Failed to restart {}: {}".format(dependent.name, e)
+                )
+                self.dead.add(old)
+                dependent.process_died(time())
+            else:
+                dependent.failures = 0
+        policy.runner.write(
+            "Reconnected {} and {} dependent process(es) in {:.2f} seconds"
+            " ({:.2f} seconds since it exited).".format(
+                policy.name, len(policy.dependents),
+                time() - start,
+                time() - policy.died
+            )
+        )
+
+    def _escalate(self, policy: RestartPolicy) -> None:
+        """Force a restart of the group a dependent policy belongs to."""
+        assert policy.parent is not None
+        parent_process = self._process_for(policy.parent)
+        if parent_process is not None and parent_process.poll() is None:
+            policy.runner.write(
+                "Restarting {} since {} keeps failing.".format(
+                    policy.parent.name, policy.name
+                )
+            )
+            self.subprocesses[parent_process]()
+
     def any_dead(self):
         """
         Check if any processes are dead.
 
-        If they're all alive, return None.
+        Processes with a restart policy are restarted as needed. If all the
+        remaining processes are alive, return None.
 
         If not, kill the remaining ones and return the failed process' poll()
         result.
         """
-        for p in self.subprocesses:
+        with self._lock:
+            return self._any_dead()
+
+    def _any_dead(self):
+        for p in list(self.subprocesses):
+            if p not in self.subprocesses:
+                # Replaced while we were iterating
+                continue
             code = p.poll()
-            if code is not None:
+            if code is None:
+                continue
+            policy = self.policies.get(p)
+            if policy is None:
+                self.killall()
+                return p
+            if p not in self.dead:
+                self.dead.add(p)
+                policy.process_died(time())
+                policy.runner.write(
+                    "{} ({}) exited with code {}.".format(
+                        policy.name, p.args, code
+                    )
+                )
+            if policy.escalate():
+                # Leave it dead; restarting the group will replace it:
+                self._escalate(policy)
+                continue
+            if policy.gave_up():
                 self.killall()
                 return p
+            self._restart(p, policy)
 
 
 def wait_for_exit(
@@ -80,6 +341,7 @@ def wait_for_exit(
             raise SystemExit(main_code)
         dead_process = processes.any_dead()
         if dead_process:
+            # Restarting didn't help (or the process can't be restarted).
             # Unfortunately torsocks doesn't deal well with connections
             # being lost, so best we can do is shut down.
             runner.write((
@@ -88,8 +350,8 @@ def wait_for_exit(
             ).format(dead_process.args, dead_process.returncode))
             if sys.stdout.isatty:
                 print(
-                    "Proxy to Kubernetes exited. This is typically due to"
-                    " a lost connection.",
+                    "Proxy to Kubernetes exited, and reconnecting failed."
+                    " This is typically due to a lost connection.",
                     file=sys.stderr
                 )
             raise SystemExit(3)
@@ -1,4 +1,5 @@
 import argparse
+import re
 import sys
 import webbrowser
 from traceback import print_exc
@@ -153,12 +154,15 @@ def parse_args(args=None) -> argparse.Namespace:
     parser.add_argument(
         "--method",
         "-m",
-        choices=["inject-tcp", "vpn-tcp", "container"],
+        choices=["inject-tcp", "vpn-tcp", "vpn-tun", "container"],
         help=(
             "'inject-tcp': inject process-specific shared "
             "library that proxies TCP to the remote cluster.\n"
             "'vpn-tcp': all local processes can route TCP "
             "traffic to the remote cluster. Requires root.\n"
+            "'vpn-tun': like vpn-tcp, but routes IP packets through a TUN "
+            "device and a single SSH connection. Linux only; requires root "
+            "and a privileged proxy pod.\n"
             "'container': used with --docker-run.\n"
             "\n"
             "Default is 'vpn-tcp', or 'container' when --docker-run is used.\n"
@@ -200,6 +204,20 @@ def parse_args(args=None) -> argparse.Namespace:
             "datawire/telepresence-k8s image is already running."
         )
     )
+    parser.add_argument(
+        "--swap-strategy",
+        dest="swap_strategy",
+        choices=["patch", "replace"],
+        default="patch",
+        help=(
+            "How --swap-deployment changes the Deployment. 'patch' only"
+            " changes the swapped container, replica count and labels, and"
+            " undoes just that on exit, so Kubernetes can reuse the original"
+            " ReplicaSet and keeps the original pods until the new one is"
+            " up. 'replace' deletes the Deployment and recreates it, both"
+            " ways. Default is 'patch'. OpenShift always uses 'replace'."
+        )
+    )
     parser.add_argument(
         "--context",
         default=None,
@@ -237,15 +255,217 @@ def parse_args(args=None) -> argparse.Namespace:
         action='append',
         default=[],
         help=(
-            "If you are using --method=vpn-tcp, use this to add additional "
-            "remote IPs, IP ranges, or hostnames to proxy. Kubernetes service "
-            "and pods are proxied automatically, so you only need to list "
-            "cloud resources, e.g. the hostname of a AWS RDS. "
-            "When using --method=inject-tcp "
+            "If you are using --method=vpn-tcp or vpn-tun, use this to add "
+            "additional remote IPs, IP ranges, or hostnames to proxy. "
+            "Kubernetes service and pods are proxied automatically, so you "
+            "only need to list cloud resources, e.g. the hostname of a AWS "
+            "RDS. When using --method=inject-tcp "
             "this option is unnecessary as all outgoing communication in "
             "the run subprocess will be proxied."
         )
     )
+    parser.add_argument(
+        "--max-service-prefixes",
+        metavar="N",
+        dest="max_service_prefixes",
+        type=int,
+        default=8,
+        help=(
+            "With --method vpn-tcp, vpn-tun or container, if the network"
+            " covering all known Service IPs is larger than"
+            " --max-service-addresses, route up to this many smaller ranges"
+            " around them instead. Default is 8."
+        )
+    )
+    parser.add_argument(
+        "--max-service-addresses",
+        metavar="ADDRESSES",
+        dest="max_service_addresses",
+        type=int,
+        default=2**16,
+        help=(
+            "With --method vpn-tcp, vpn-tun or container, route the single"
+            " range covering all known Service IPs if it has at most this"
+            " many addresses. Otherwise smaller ranges around them are only"
+            " merged while they stay within this many addresses. Default is"
+            " 65536."
+        )
+    )
+    parser.add_argument(
+        "--route-waste",
+        metavar="ADDRESSES",
+        dest="route_waste",
+        type=int,
+        default=0,
+        help=(
+            "With --method vpn-tcp, vpn-tun or container, merge neighbouring"
+            " IP ranges routed to the cluster into fewer, larger ranges, as"
+            " long as no more than this many addresses that weren't meant to"
+            " be routed get included. Fewer ranges means fewer routes, which"
+            " helps on clusters with many nodes. Default is 0."
+        )
+    )
+    parser.add_argument(
+        "--split-dns",
+        action="store_true",
+        help=(
+            "With --method vpn-tcp or vpn-tun, only send DNS queries for names"
+            " that may be in the cluster (Services, namespaces, the cluster"
+            " domain) to the cluster, and resolve everything else locally."
+            " Only UDP queries are split; queries over TCP, which are only"
+            " made for answers too big for UDP, go to the local nameserver."
+            " Linux only."
+        )
+    )
+    parser.add_argument(
+        "--dns-cache",
+        dest="dns_cache",
+        action="store_true",
+        help=(
+            "With --method vpn-tcp or vpn-tun, send DNS queries through a"
+            " local caching server, so repeated lookups don't have to reach"
+            " the cluster until the answer's TTL expires. This redirects the"
+            " machine's DNS queries with iptables while telepresence runs."
+            " Linux only."
+        )
+    )
+    parser.add_argument(
+        "--route-update-interval",
+        metavar="SECONDS",
+        dest="route_update_interval",
+        type=int,
+        default=30,
+        help=(
+            "With --method vpn-tcp, vpn-tun or container, check this often"
+            " for new Service IPs and changed --also-proxy addresses that"
+            " aren't routed to the cluster yet, and route them. Use 0 to"
+            " disable. Default is 30."
+        )
+    )
+    parser.add_argument(
+        "--port-forwards",
+        metavar="N",
+        dest="port_forwards",
+        type=int,
+        default=1,
+        help=(
+            "Number of kubectl port-forward connections to open to the proxy"
+            " pod. Each one is a separate stream through the Kubernetes API"
+            " server; SSH tunnels, volume mounts and SOCKS connections are"
+            " spread across them, which can increase throughput. Default is"
+            " 1."
+        )
+    )
+    parser.add_argument(
+        "--socks-pool",
+        metavar="N",
+        dest="socks_pool",
+        type=int,
+        default=0,
+        help=(
+            "With --method inject-tcp, number of connections to the remote"
+            " SOCKS proxy to keep open and ready, so new connections made by"
+            " your process only pay for one round trip to the cluster."
+            " The connections stay open for the whole session. Default is 0,"
+            " no pool."
+        )
+    )
+    parser.add_argument(
+        "--mount-profile",
+        dest="mount_profile",
+        choices=["default", "read-heavy", "consistent"],
+        default="default",
+        help=(
+            "How the sshfs mount at $TELEPRESENCE_ROOT caches the pod's"
+            " files. 'default' uses sshfs's defaults: metadata may be up to"
+            " 20 seconds out of date. 'read-heavy' caches metadata for 5"
+            " minutes and file contents until they're seen to change, for"
+            " build tools and IDEs that scan many files. 'consistent' caches"
+            " nothing, so changes in the pod are seen immediately."
+        )
+    )
+    parser.add_argument(
+        "--volume-mode",
+        dest="volume_mode",
+        choices=["all", "declared", "snapshot"],
+        default="all",
+        help=(
+            "What to mount at $TELEPRESENCE_ROOT. 'all' mounts the proxy"
+            " container's whole filesystem. 'declared' only mounts the"
+            " container's volumes (secrets, ConfigMaps, the service account"
+            " token, etc.) at their usual paths, so tools that wander around"
+            " the filesystem don't slow down the connection to the cluster."
+            " 'snapshot' copies those volumes to a local directory at"
+            " startup instead of mounting them; see --volume-resync."
+            " Default is 'all'."
+        )
+    )
+    parser.add_argument(
+        "--volume-resync",
+        metavar="SECONDS",
+        dest="volume_resync",
+        type=int,
+        default=0,
+        help=(
+            "With --volume-mode snapshot, copy files that changed in the"
+            " container's volumes this often. Default is 0, never."
+        )
+    )
+    parser.add_argument(
+        "--volume-cache-size",
+        metavar="MEGABYTES",
+        dest="volume_cache_size",
+        type=int,
+        default=0,
+        help=(
+            "With --volume-mode snapshot, keep up to this many megabytes of"
+            " copied files in ~/.cache/telepresence between sessions, so"
+            " files that haven't changed aren't copied again. Note that this"
+            " includes secrets. Default is 0, no cache."
+        )
+    )
+    parser.add_argument(
+        "--direct-ssh",
+        metavar="nodeport|loadbalancer|HOST:PORT",
+        dest="direct_ssh",
+        default=None,
+        help=(
+            "Connect to the proxy pod's SSH server directly instead of via"
+            " kubectl port-forward, so traffic doesn't go through the"
+            " Kubernetes API server. 'nodeport' and 'loadbalancer' publish"
+            " the server with a Service of that type; alternatively give an"
+            " address that reaches port 8023 of the proxy pod. The server"
+            " only accepts a key generated for this session. Falls back to"
+            " kubectl port-forward if the address can't be reached. Requires"
+            " --new-deployment or --swap-deployment."
+        )
+    )
+    parser.add_argument(
+        "--pool-size",
+        metavar="N",
+        dest="pool_size",
+        type=int,
+        default=0,
+        help=(
+            "With --new-deployment, keep this many idle proxy pods running in"
+            " the namespace, and start sessions by taking one of them instead"
+            " of waiting for a new pod to be scheduled and started. A"
+            " replacement is started in the background. Default is 0, no"
+            " pool."
+        )
+    )
+    parser.add_argument(
+        "--pool-ttl",
+        metavar="SECONDS",
+        dest="pool_ttl",
+        type=int,
+        default=3600,
+        help=(
+            "With --pool-size, Kubernetes deletes the pool's idle pods once"
+            " no telepresence has used it for this long, whether or not"
+            " telepresence is run again. Default is 3600."
+        )
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "--run-shell",
@@ -274,6 +494,15 @@ def parse_args(args=None) -> argparse.Namespace:
             "Requires --method container."
         )
     )
+    group.add_argument(
+        "--restore",
+        action="store_true",
+        help=(
+            "Instead of starting a session, swap back every Deployment that"
+            " --swap-deployment left swapped out because telepresence died"
+            " before it could restore it, e.g. after kill -9 or a crash."
+        )
+    )
     args = parser.parse_args(args)
 
     # Fill in defaults:
@@ -296,6 +525,76 @@ def parse_args(args=None) -> argparse.Namespace:
             "'--method container' is required when using '--docker-run'."
         )
 
+    if args.direct_ssh is not None:
+        if args.deployment is not None:
+            raise SystemExit(
+                "'--direct-ssh' requires '--new-deployment' or"
+                " '--swap-deployment'."
+            )
+        if args.direct_ssh not in ("nodeport", "loadbalancer") and (
+            not re.match(r"^[^:]+:\d+$", args.direct_ssh)
+        ):
+            raise SystemExit(
+                "'--direct-ssh' must be 'nodeport', 'loadbalancer' or"
+                " HOST:PORT."
+            )
+
+    if args.pool_size < 0:
+        raise SystemExit("'--pool-size' can't be negative.")
+    if args.pool_ttl <= 0:
+        raise SystemExit("'--pool-ttl' must be positive.")
+    if args.pool_size:
+        if args.new_deployment is None:
+            raise SystemExit("'--pool-size' requires '--new-deployment'.")
+        if args.direct_ssh is not None:
+            # The pod's SSH server would need this session's key up front:
+            raise SystemExit(
+                "'--pool-size' can't be used with '--direct-ssh'."
+            )
+
+    if args.method == "vpn-tun":
+        if args.deployment is not None:
+            raise SystemExit(
+                "'--method vpn-tun' requires '--new-deployment' or"
+                " '--swap-deployment'."
+            )
+        if not sys.platform.startswith("linux"):
+            raise SystemExit("'--method vpn-tun' is only supported on Linux.")
+
+    if args.split_dns:
+        if args.method not in ("vpn-tcp", "vpn-tun"):
+            raise SystemExit(
+                "'--split-dns' requires '--method vpn-tcp' or 'vpn-tun'."
+            )
+        if not sys.platform.startswith("linux"):
+            raise SystemExit("'--split-dns' is only supported on Linux.")
+
+    if args.dns_cache:
+        if args.method not in ("vpn-tcp", "vpn-tun"):
+            raise SystemExit(
+                "'--dns-cache' requires '--method vpn-tcp' or 'vpn-tun'."
+            )
+        if not sys.platform.startswith("linux"):
+            raise SystemExit("'--dns-cache' is only supported on Linux.")
+
+    if args.route_update_interval < 0:
+        raise SystemExit("'--route-update-interval' can't be negative.")
+    if args.max_service_prefixes < 1 or args.max_service_addresses < 1:
+        raise SystemExit(
+            "'--max-service-prefixes' and '--max-service-addresses' must be"
+            " positive."
+        )
+    if args.route_waste < 0:
+        raise SystemExit("'--route-waste' can't be negative.")
+    if args.volume_cache_size < 0:
+        raise SystemExit("'--volume-cache-size' can't be negative.")
+    if args.volume_resync < 0:
+        raise SystemExit("'--volume-resync' can't be negative.")
+    if args.socks_pool < 0:
+        raise SystemExit("'--socks-pool' can't be negative.")
+    if args.port_forwards < 1:
+        raise SystemExit("'--port-forwards' must be at least 1.")
+
     args.expose = PortMapping.parse(args.expose)
     return args
 
@@ -11,12 +11,14 @@ import os.path
 from tempfile import NamedTemporaryFile
 
 from telepresence import TELEPRESENCE_LOCAL_IMAGE
-from telepresence.cleanup import Subprocesses, wait_for_exit
-from telepresence.remote import RemoteInfo, mount_remote_volumes
+from telepresence.cleanup import Subprocesses, auxiliary, wait_for_exit
+from telepresence.remote import RemoteInfo, mount_remote_volumes, \
+    wait_for_volumes
 from telepresence.runner import Runner
 from telepresence.ssh import SSH
 from telepresence.utilities import random_name
-from telepresence.vpn import get_proxy_cidrs
+from telepresence.vpn import RouteUpdater, aggregate_cidrs, \
+    get_proxy_cidrs
 
 # IP that shouldn't be in use on Internet, *or* local networks:
 MAC_LOOPBACK_IP = "198.18.0.254"
@@ -61,7 +63,7 @@ def run_docker_command(
     args: argparse.Namespace,
     remote_env: Dict[str, str],
     subprocesses: Subprocesses,
-    ssh: SSH,
+    sshs: List[SSH],
 ) -> None:
     """
     --docker-run support.
@@ -71,16 +73,23 @@ def run_docker_command(
 
     :param args: Command-line args to telepresence binary.
     :param remote_env: Dictionary with environment on remote pod.
+    :param sshs: SSH instances, one per kubectl port-forward. The proxy
+        container uses the first, the volume mount the last.
     :param mount_dir: Path to local directory where remote pod's filesystem is
         mounted.
     """
     # Mount remote filesystem. We allow all users if we're using Docker because
-    # we don't know what uid the Docker container will use:
-    mount_dir, mount_cleanup = mount_remote_volumes(
+    # we don't know what uid the Docker container will use. Mounting happens
+    # in the background while the proxy container starts:
+    mount_dir, ready_marker, mount_cleanup = mount_remote_volumes(
         runner,
         remote_info,
-        ssh,
+        sshs[-1],
         True,
+        args.mount_profile,
+        args.volume_mode,
+        args.volume_resync,
+        args.volume_cache_size,
     )
 
     # Update environment:
@@ -93,13 +102,14 @@ def run_docker_command(
 
     # Start the sshuttle container:
     name = random_name()
+    cidrs = get_proxy_cidrs(
+        runner, args, remote_info, remote_env["KUBERNETES_SERVICE_HOST"]
+    )
     config = {
         "port":
-        ssh.port,
+        sshs[0].port,
         "cidrs":
-        get_proxy_cidrs(
-            runner, args, remote_info, remote_env["KUBERNETES_SERVICE_HOST"]
-        ),
+        cidrs,
         "expose_ports":
         list(args.expose.local_to_remote()),
     }
@@ -125,6 +135,7 @@ def run_docker_command(
     atexit.register(os.remove, envfile.name)
 
     # Wait for sshuttle to be running:
+    delay = 0.1
     while True:
         try:
             runner.check_call(
@@ -141,7 +152,8 @@ def run_docker_command(
             elif e.returncode == 125:
                 # Docker failure, probably due to original container not
                 # starting yet... so sleep and try again:
-                sleep(1)
+                sleep(delay)
+                delay = min(delay * 2, 1)
                 continue
             else:
                 raise
@@ -150,6 +162,40 @@ def run_docker_command(
                 "Waiting container exited prematurely. File a bug, please!"
             )
 
+    # Route Services and --also-proxy addresses that show up later with a
+    # second sshuttle in the proxy container. Each time there are more, it's
+    # restarted with all of them; the routes mode of the entrypoint replaces
+    # the previous one:
+    added_cidrs = []  # type: List[str]
+
+    def start_routes() -> Popen:
+        # We're in the background, so sudo mustn't prompt for a password:
+        sudo = ["sudo", "-n"] if SUDO_FOR_DOCKER else []
+        return runner.popen(
+            sudo + [
+                "docker", "exec", name, "python3", "/usr/bin/entrypoint.py",
+                "routes",
+                json.dumps(dict(config, cidrs=added_cidrs))
+            ]
+        )
+
+    routes_policy = auxiliary(
+        runner, "sshuttle for new routes in container", start_routes
+    )
+
+    def add_routes(new_cidrs):
+        added_cidrs[:] = aggregate_cidrs(
+            added_cidrs + new_cidrs, args.route_waste
+        )
+        subprocesses.relaunch(routes_policy)
+
+    if args.route_update_interval:
+        RouteUpdater(runner, args, remote_info, cidrs, add_routes).start()
+
+    # A bind mount only shows the user's container what's mounted when it
+    # starts, so the volumes have to be ready by then:
+    wait_for_volumes(ready_marker)
+
     # Start the container specified by the user:
     container_name = random_name()
     docker_command = docker_runify([
@@ -1,16 +1,21 @@
 import argparse
 import atexit
 import json
-from subprocess import STDOUT
-from typing import Tuple, Dict
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import STDOUT, CalledProcessError
+from typing import Tuple, Dict, List, Optional
 from uuid import uuid4
 
 from copy import deepcopy
 
 from telepresence import TELEPRESENCE_REMOTE_IMAGE
+from telepresence.journal import forget_swap, outstanding_swaps, \
+    record_swap
 from telepresence.remote import get_deployment_json
 from telepresence.runner import Runner
-from telepresence.utilities import get_alternate_nameserver
+from telepresence.utilities import get_alternate_nameserver, is_running
 
 
 def create_new_deployment(runner: Runner,
@@ -50,24 +55,85 @@ def create_new_deployment(runner: Runner,
         command.append(
             "--env=TELEPRESENCE_NAMESERVER=" + get_alternate_nameserver()
         )
-    if args.needs_root:
+    # Enable the key-authenticated SSH server for --direct-ssh:
+    if args.ssh_public_key is not None:
+        command.append(
+            "--env=TELEPRESENCE_AUTHORIZED_KEY=" + args.ssh_public_key
+        )
+    # The proxy needs to create a TUN device for --method vpn-tun:
+    if args.method == "vpn-tun":
+        command.append("--env=TELEPRESENCE_TUN=1")
+    if args.needs_root or args.method == "vpn-tun":
+        pod_spec = {
+            "securityContext": {
+                "runAsUser": 0
+            }
+        }  # type: Dict
+        if args.method == "vpn-tun":
+            # kubectl merges this with the generated container by name:
+            pod_spec["containers"] = [{
+                "name": args.new_deployment,
+                "securityContext": {
+                    "privileged": True
+                },
+            }]
         override = {
             "apiVersion": "extensions/v1beta1",
             "spec": {
                 "template": {
-                    "spec": {
-                        "securityContext": {
-                            "runAsUser": 0
-                        }
-                    }
+                    "spec": pod_spec
                 }
             }
         }
         command.append("--overrides=" + json.dumps(override))
     runner.get_kubectl(args.context, args.namespace, command)
+    if args.direct_ssh is not None:
+        publish_ssh(runner, args, args.new_deployment, run_id)
     return args.new_deployment, run_id
 
 
+def publish_ssh(
+    runner: Runner, args: argparse.Namespace, deployment_name: str,
+    run_id: str
+) -> None:
+    """
+    Create a Service that publishes the proxy pod's key-authenticated SSH
+    server (port 8023), for --direct-ssh nodeport/loadbalancer.
+
+    The name of the Service is stored in args.ssh_service.
+    """
+    service_type = {
+        "nodeport": "NodePort",
+        "loadbalancer": "LoadBalancer",
+    }.get(args.direct_ssh)
+    if service_type is None:
+        # User gave us an address, nothing to create:
+        return
+    args.ssh_service = "telepresence-ssh-" + run_id[:8]
+
+    def delete_service():
+        runner.check_kubectl(
+            args.context, args.namespace, [
+                "delete", "--ignore-not-found", "service", args.ssh_service
+            ]
+        )
+
+    atexit.register(delete_service)
+    runner.check_kubectl(
+        args.context, args.namespace, [
+            "expose",
+            "deployment",
+            deployment_name,
+            "--name=" + args.ssh_service,
+            "--type=" + service_type,
+            "--port=8023",
+            "--target-port=8023",
+            "--selector=telepresence=" + run_id,
+            "--labels=telepresence=" + run_id,
+        ]
+    )
+
+
 def swap_deployment(runner: Runner,
                     args: argparse.Namespace) -> Tuple[str, str, Dict]:
     """
@@ -107,8 +173,6 @@ def swap_deployment(runner: Runner,
             input=json.dumps(json_config).encode("utf-8"),
         )
 
-    atexit.register(apply_json, deployment_json)
-
     # If no container name was given, just use the first one:
     if not container_name:
         container_name = deployment_json["spec"]["template"]["spec"][
@@ -124,11 +188,209 @@ def swap_deployment(runner: Runner,
         TELEPRESENCE_REMOTE_IMAGE,
         args.method == "vpn-tcp" and args.in_local_vm,
         args.needs_root,
+        args.ssh_public_key,
+        args.method == "vpn-tun",
+    )
+    swap_patch = restore_patch = None
+    if args.swap_strategy == "patch":
+        swap_patch, restore_patch = swap_patches(
+            deployment_json, new_deployment_json, container_name
+        )
+    # Record how to undo the swap before making it, so --restore can undo
+    # it if we die without running atexit functions:
+    entry = record_swap(
+        run_id, runner.kubectl_cmd, args.context, args.namespace,
+        "deployment", deployment_name, deployment_json, restore_patch
     )
-    apply_json(new_deployment_json)
+    atexit.register(restore_swap, runner, entry)
+    if swap_patch is None:
+        apply_json(new_deployment_json)
+    else:
+        runner.check_kubectl(
+            args.context,
+            args.namespace, [
+                "patch", "deployment", deployment_name, "--type=json",
+                "--patch=" + json.dumps(swap_patch)
+            ],
+        )
+    if args.direct_ssh is not None:
+        publish_ssh(runner, args, deployment_name, run_id)
     return deployment_name, run_id, orig_container_json
 
 
+def restore_swap(runner: Runner, entry: Dict) -> None:
+    """
+    Undo a swap recorded by record_swap(), and forget the record.
+
+    Used both on exit and by --restore, so it only relies on the record.
+    """
+
+    def kubectl(kubectl_args, **kwargs):
+        command = runner.kubectl(
+            entry["context"], entry["namespace"], kubectl_args
+        )
+        # The swap may have been made using oc rather than kubectl:
+        command[0] = entry["kubectl"]
+        runner.check_call(command, **kwargs)
+
+    original = json.dumps(entry["original"]).encode("utf-8")
+    if entry["kind"] == "rc":
+        kubectl(["apply", "-f", "-"], input=original)
+        # Now that we've updated the replication controller, delete pods to
+        # make sure changes get applied:
+        kubectl(["delete", "pod", "--selector", "deployment=" + entry["name"]])
+    elif entry["restore_patch"] is not None:
+        kubectl([
+            "patch", "deployment", entry["name"], "--type=json",
+            "--patch=" + json.dumps(entry["restore_patch"])
+        ])
+    else:
+        # As in swap_deployment(), delete first so old ReplicaSets and Pods
+        # don't hang around. It may already be gone if we died in between:
+        kubectl([
+            "delete", "deployment", "--ignore-not-found", entry["name"]
+        ])
+        kubectl(["apply", "-f", "-"], input=original)
+    forget_swap(entry["run_id"])
+
+
+def restore_outstanding_swaps(runner: Runner) -> None:
+    """
+    --restore support: undo every recorded swap whose telepresence is no
+    longer running.
+
+    Different objects are restored in parallel. If the same object was
+    swapped more than once (a session crashed, and a later one swapped the
+    still-swapped object again), its swaps are undone newest first, so the
+    oldest record's original is what's left.
+    """
+    groups = OrderedDict()  # type: Dict[Tuple, List[Dict]]
+    for entry in outstanding_swaps():
+        key = (
+            entry["context"], entry["namespace"], entry["kind"],
+            entry["name"]
+        )
+        groups.setdefault(key, []).append(entry)
+    # Undoing an older, crashed session's swap of an object a running session
+    # has since swapped again would pull it out from under that session:
+    for key, entries in list(groups.items()):
+        live = [
+            entry for entry in entries
+            if is_running(entry["pid"], entry.get("pid_started"))
+        ]
+        if live:
+            print(
+                "Not restoring {} {}, telepresence (pid {}) is still using"
+                " it.".format(key[2], key[3], live[-1]["pid"]),
+                file=sys.stderr
+            )
+            del groups[key]
+    if not groups:
+        print("Nothing to restore.", file=sys.stderr)
+        return
+
+    def restore(entries: List[Dict]) -> Optional[Exception]:
+        try:
+            for entry in reversed(entries):
+                restore_swap(runner, entry)
+        except CalledProcessError as e:
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(len(groups), 16)) as pool:
+        errors = list(pool.map(restore, groups.values()))
+    for (context, namespace, kind, name), error in zip(groups, errors):
+        print(
+            "{} {} {} in namespace {} of context {}{}".format(
+                "Failed to restore" if error else "Restored", kind, name,
+                namespace, context, ": {}".format(error) if error else "."
+            ),
+            file=sys.stderr
+        )
+    failed = len([error for error in errors if error])
+    if failed:
+        raise SystemExit(
+            "Failed to restore {} of {}; see {} for details. Run"
+            " 'telepresence --restore' again to retry.".format(
+                failed, len(groups), runner.logfile.name
+            )
+        )
+
+
+def json_patch(old: Dict, new: Dict, path: str) -> List[Dict]:
+    """
+    Return JSON Patch (RFC 6902) operations that turn the object at path,
+    whose value is old, into new. Keys are compared one level deep, and
+    changed values replaced whole.
+    """
+    operations = []  # type: List[Dict]
+    for key in sorted(set(old) | set(new)):
+        key_path = path + "/" + key.replace("~", "~0").replace("/", "~1")
+        if key not in new:
+            operations.append({"op": "remove", "path": key_path})
+        elif key not in old:
+            operations.append({
+                "op": "add",
+                "path": key_path,
+                "value": new[key]
+            })
+        elif old[key] != new[key]:
+            operations.append({
+                "op": "replace",
+                "path": key_path,
+                "value": new[key]
+            })
+    return operations
+
+
+def swap_patches(old_deployment: Dict, new_deployment: Dict,
+                 container_name: str) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Return (JSON Patch that swaps old_deployment for new_deployment, JSON
+    Patch that swaps it back), as made by new_swapped_deployment().
+
+    Only what new_swapped_deployment() changes is patched: the swapped
+    container, the replica count and the labels. Each patch first checks the
+    container is still at the same index, so it fails rather than patching
+    the wrong one.
+    """
+    containers = old_deployment["spec"]["template"]["spec"]["containers"]
+    index = [c["name"] for c in containers].index(container_name)
+    container_path = "/spec/template/spec/containers/{}".format(index)
+    check = [{
+        "op": "test",
+        "path": container_path + "/name",
+        "value": container_name
+    }]
+    parts = [
+        ("/metadata", ["metadata"]),
+        ("/spec", ["spec"]),
+        ("/spec/template/metadata", ["spec", "template", "metadata"]),
+        (container_path, ["spec", "template", "spec", "containers", index]),
+    ]
+
+    def get(deployment, keys):
+        for key in keys:
+            deployment = deployment[key]
+        return deployment
+
+    def make(source, destination):
+        operations = list(check)
+        for path, keys in parts:
+            old, new = get(source, keys), get(destination, keys)
+            if path == "/spec":
+                # The template is handled separately, key by key:
+                old = {"replicas": old.get("replicas", 1)}
+                new = {"replicas": new.get("replicas", 1)}
+            operations += json_patch(old, new, path)
+        return operations
+
+    return (
+        make(old_deployment, new_deployment),
+        make(new_deployment, old_deployment),
+    )
+
+
 def new_swapped_deployment(
     old_deployment: Dict,
     container_to_update: str,
@@ -136,6 +398,8 @@ def new_swapped_deployment(
     telepresence_image: str,
     add_custom_nameserver: bool,
     as_root: bool,
+    authorized_key: Optional[str] = None,
+    tun: bool = False,
 ) -> Tuple[Dict, Dict]:
     """
     Create a new Deployment that uses telepresence-k8s image.
@@ -150,6 +414,10 @@ def new_swapped_deployment(
     6. Sets terminationMessagePolicy.
     7. Adds TELEPRESENCE_CONTAINER_NAMESPACE env variable so the forwarder does
        not have to access the k8s API from within the pod.
+    8. Adds TELEPRESENCE_AUTHORIZED_KEY env variable, if a key is given, which
+       enables the key-authenticated SSH server used by --direct-ssh.
+    9. Runs privileged as root and adds TELEPRESENCE_TUN env variable, if
+       requested, so the proxy can create a TUN device for --method vpn-tun.
 
     Returns dictionary that can be encoded to JSON and used with kubectl apply,
     and contents of swapped out container.
@@ -193,6 +461,20 @@ def new_swapped_deployment(
                 container["securityContext"] = {
                     "runAsUser": 0,
                 }
+            if tun:
+                container["securityContext"] = {
+                    "runAsUser": 0,
+                    "privileged": True,
+                }
+                container.setdefault("env", []).append({
+                    "name": "TELEPRESENCE_TUN",
+                    "value": "1",
+                })
+            if authorized_key is not None:
+                container.setdefault("env", []).append({
+                    "name": "TELEPRESENCE_AUTHORIZED_KEY",
+                    "value": authorized_key,
+                })
             # Add namespace environment variable to support deployments using
             # automountServiceAccountToken: false. To be used by forwarder.py
             # in the k8s-proxy.
@@ -264,8 +546,6 @@ def swap_deployment_openshift(runner: Runner, args: argparse.Namespace
             ["delete", "pod", "--selector", "deployment=" + rc_name]
         )
 
-    atexit.register(apply_json, rc_json)
-
     # If no container name was given, just use the first one:
     if not container_name:
         container_name = rc_json["spec"]["template"]["spec"]["containers"
@@ -279,5 +559,10 @@ def swap_deployment_openshift(runner: Runner, args: argparse.Namespace
         args.method == "vpn-tcp" and args.in_local_vm,
         False,
     )
+    entry = record_swap(
+        run_id, runner.kubectl_cmd, args.context, args.namespace, "rc",
+        rc_name, rc_json
+    )
+    atexit.register(restore_swap, runner, entry)
     apply_json(new_rc_json)
     return deployment_name, run_id, orig_container_json
@@ -0,0 +1,633 @@
+"""
+Just enough of the DNS protocol to check whether the proxy's DNS server is
+reachable, without starting a process or going through the OS resolver, and
+to run a local DNS stub that decides which queries go to the cluster.
+"""
+
+import atexit
+import random
+import shlex
+import socket
+import struct
+from collections import OrderedDict
+from itertools import count
+from subprocess import CalledProcessError, Popen
+from threading import Lock, Thread
+from time import time, sleep
+from typing import Dict, List, Optional, Tuple, Union
+
+import os
+
+from telepresence.cleanup import Subprocesses, auxiliary
+from telepresence.runner import Runner
+from telepresence.utilities import get_resolv_conf_namservers, \
+    get_resolv_conf_search, is_running
+
+DNS_PORT = 53
+
+# Record types and class:
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_OPT = 41
+CLASS_IN = 1
+
+# Seconds to cache a negative response that doesn't say for how long:
+NEGATIVE_TTL = 5
+
+# Used to make marker names unique, so no cache along the way can answer:
+_counter = count()
+
+
+def build_query(name: str, query_id: int, query_type: int = TYPE_A) -> bytes:
+    """Return a recursive DNS query packet for the given name."""
+    # ID, flags (recursion desired), 1 question, no other records:
+    header = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    question = b""
+    for label in name.rstrip(".").split("."):
+        encoded = label.encode("idna")
+        question += bytes([len(encoded)]) + encoded
+    question += b"\x00" + struct.pack("!HH", query_type, CLASS_IN)
+    return header + question
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    """Return the offset after the (possibly compressed) name at offset."""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # Compression pointer; the name ends here:
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_question(data: bytes) -> Optional[Tuple[str, int]]:
+    """Return the name and type asked about in a query, or None."""
+    labels = []
+    offset = 12
+    try:
+        if struct.unpack("!H", data[4:6])[0] < 1:
+            return None
+        while data[offset]:
+            length = data[offset]
+            if length & 0xC0:
+                return None
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        query_type = struct.unpack("!H", data[offset + 1:offset + 3])[0]
+        return (b".".join(labels).decode("ascii").lower(), query_type)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        return None
+
+
+def is_negative(data: bytes) -> bool:
+    """Return whether a response is an error or has no answers."""
+    flags, _, answers = struct.unpack("!HHH", data[2:8])
+    return bool(flags & 0x000F) or answers == 0
+
+
+def _records(data: bytes) -> List[Tuple[int, int, int, int]]:
+    """
+    Return the type, offset of the TTL, offset of the data and length of the
+    data of each resource record in a response.
+
+    Raises IndexError or struct.error if the response is malformed.
+    """
+    questions, answers, authority, additional = struct.unpack(
+        "!HHHH", data[4:12]
+    )
+    offset = 12
+    for _ in range(questions):
+        offset = _skip_name(data, offset) + 4
+    result = []
+    for _ in range(answers + authority + additional):
+        offset = _skip_name(data, offset)
+        record_type, _, _, length = struct.unpack(
+            "!HHIH", data[offset:offset + 10]
+        )
+        result.append((record_type, offset + 4, offset + 10, length))
+        offset += 10 + length
+    if offset > len(data):
+        raise IndexError("Truncated record")
+    return result
+
+
+def response_ttl(data: bytes) -> Optional[int]:
+    """
+    Return for how many seconds a response may be cached, or None if it
+    shouldn't be, e.g. because it's a server failure.
+
+    Answers are cached for their lowest TTL. Negative responses are cached
+    for as long as the SOA record in them says (RFC 2308), or NEGATIVE_TTL.
+    """
+    try:
+        flags, _, answers, authority = struct.unpack("!HHHH", data[2:10])
+        records = _records(data)
+    except (IndexError, struct.error):
+        return None
+    rcode = flags & 0x000F
+    # Truncated, or an error other than NXDOMAIN:
+    if flags & 0x0200 or rcode not in (0, 3):
+        return None
+
+    def ttl(record):
+        return struct.unpack("!I", data[record[1]:record[1] + 4])[0]
+
+    if rcode == 0 and answers:
+        return min(ttl(record) for record in records[:answers])
+    for record in records[answers:answers + authority]:
+        record_type, _, offset, length = record
+        if record_type == TYPE_SOA and length >= 20:
+            minimum = struct.unpack(
+                "!I", data[offset + length - 4:offset + length]
+            )[0]
+            return min(ttl(record), minimum)
+    return NEGATIVE_TTL
+
+
+def parse_response(data: bytes, query_id: int) -> Optional[List[str]]:
+    """
+    Return the IPv4 addresses in a response to the query with the given ID,
+    or None if the packet isn't such a response.
+
+    An error response, e.g. NXDOMAIN, gives an empty list.
+    """
+    if len(data) < 12:
+        return None
+    response_id, flags, _, answers = struct.unpack("!HHHH", data[:8])
+    if response_id != query_id or not flags & 0x8000:
+        return None
+    if flags & 0x000F:
+        return []
+    try:
+        records = _records(data)[:answers]
+    except (IndexError, struct.error):
+        return None
+    return [
+        socket.inet_ntoa(data[offset:offset + 4])
+        for (record_type, _, offset, length) in records
+        if record_type == TYPE_A and length == 4
+    ]
+
+
+def query(
+    server: str, name: str, timeout: float, port: int = DNS_PORT
+) -> List[str]:
+    """
+    Send a single A query to a DNS server over UDP, and return the addresses
+    in the answer.
+
+    Raises socket.timeout if there's no answer in time.
+    """
+    query_id = random.randint(0, 0xFFFF)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(build_query(name, query_id), (server, port))
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise socket.timeout()
+            sock.settimeout(remaining)
+            result = parse_response(sock.recv(4096), query_id)
+            if result is not None:
+                return result
+    finally:
+        sock.close()
+
+
+def marker_name() -> str:
+    """
+    Return a new name of the marker the proxy's DNS server answers.
+
+    It's qualified with the first search domain, just like the OS resolver
+    would do, since that's how the proxy learns which suffix to strip.
+    """
+    name = "hellotelepresence{}".format(next(_counter))
+    search = get_resolv_conf_search()
+    if search:
+        name += "." + search[0]
+    return name
+
+
+def wait_for_proxy_dns(timeout: float) -> bool:
+    """
+    Wait until DNS queries reach the proxy's DNS server, e.g. because sshuttle
+    started capturing them. Return whether that happened within timeout.
+
+    We query the first nameserver in /etc/resolv.conf, which is what sshuttle
+    captures, retrying quickly at first and backing off to once a second.
+    """
+    server = get_resolv_conf_namservers()[0]
+    delay = 0.05
+    start = time()
+    while time() - start < timeout:
+        attempt = time()
+        try:
+            if query(server, marker_name(), delay):
+                return True
+        except OSError:
+            # Timeout, or sshuttle is still setting up the firewall
+            pass
+        # Don't hammer the real nameserver with NXDOMAIN responses:
+        sleep(max(0, delay - (time() - attempt)))
+        delay = min(delay * 1.5, 1)
+    return False
+
+
+# Nameserver address that doesn't exist; sshuttle captures queries sent to it
+# (--ns-hosts) and forwards them to the proxy's DNS server:
+CLUSTER_NAMESERVER = "198.18.0.53"
+
+# Where to send a query:
+REMOTE = "remote"
+LOCAL = "local"
+
+
+class SplitDomains(object):
+    """
+    Decide which names are looked up in the cluster and which locally.
+
+    Names in the cluster domain only exist in the cluster. Single-label names,
+    and names ending in a namespace or 'svc', might be Services, so they're
+    tried in the cluster and then locally. The OS resolver may have added a
+    search domain from resolv.conf to any of these, which the proxy's DNS
+    server strips again. Everything else is looked up locally.
+    """
+
+    def __init__(
+        self,
+        namespaces: List[str],
+        search: List[str],
+        cluster_domain: str = "cluster.local"
+    ) -> None:
+        self.namespaces = set(namespaces) | {"svc"}
+        self.search = search
+        self.cluster_domain = cluster_domain
+
+    def upstreams(self, name: str) -> List[str]:
+        """Return where to look up the name, in order."""
+        name = name.rstrip(".").lower()
+        if name == self.cluster_domain or name.endswith(
+            "." + self.cluster_domain
+        ):
+            return [REMOTE]
+        for suffix in self.search:
+            if name.endswith("." + suffix):
+                name = name[:-len(suffix) - 1]
+                break
+        labels = name.split(".")
+        if len(labels) == 1 or (
+            len(labels) == 2 and labels[1] in self.namespaces
+        ):
+            return [REMOTE, LOCAL]
+        return [LOCAL]
+
+
+class RemoteDomains(object):
+    """Look up every name in the cluster, like sshuttle --dns does."""
+
+    def upstreams(self, name: str) -> List[str]:
+        """Return where to look up the name, in order."""
+        return [REMOTE]
+
+
+def _with_question_of(query: bytes, response: bytes) -> bytes:
+    """
+    Return a response for another query with the same question, with that
+    query's ID and spelling of the name (some resolvers randomize its case).
+    """
+    end = _skip_name(query, 12) + 4
+    if response[12:end].lower() != query[12:end].lower():
+        return query[:2] + response[2:]
+    return query[:2] + response[2:12] + query[12:end] + response[end:]
+
+
+class DNSCache(object):
+    """
+    Responses to recent queries, kept for as long as response_ttl() says.
+
+    Cached responses are handed out with their TTLs counting down, so clients
+    that cache too don't keep answers for longer than they should.
+    """
+
+    # Oldest responses are dropped beyond this many:
+    MAX_ENTRIES = 4096
+
+    def __init__(self) -> None:
+        Dict  # Avoid Pyflakes F401
+        self.entries = OrderedDict(
+        )  # type: OrderedDict[Tuple[str, int], Tuple[float, bytes, List[int]]]
+        self.lock = Lock()
+
+    def get(self, question: Tuple[str, int]) -> Optional[bytes]:
+        """Return the cached response to a question, if there is one."""
+        with self.lock:
+            entry = self.entries.get(question)
+            if entry is None:
+                return None
+            expires, response, ttl_offsets = entry
+            remaining = int(expires - time())
+            if remaining <= 0:
+                del self.entries[question]
+                return None
+        result = bytearray(response)
+        for offset in ttl_offsets:
+            result[offset:offset + 4] = struct.pack("!I", remaining)
+        return bytes(result)
+
+    def put(self, question: Tuple[str, int], response: bytes) -> None:
+        """Cache a response, if it may be cached."""
+        ttl = response_ttl(response)
+        if not ttl:
+            return
+        # OPT pseudo-records use the TTL field for flags:
+        ttl_offsets = [
+            offset for (record_type, offset, _, _) in _records(response)
+            if record_type != TYPE_OPT
+        ]
+        with self.lock:
+            self.entries.pop(question, None)
+            self.entries[question] = (time() + ttl, response, ttl_offsets)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+
+class _Pending(object):
+    """A question we're waiting for an upstream to answer."""
+
+    def __init__(
+        self, question: Tuple[str, int], client: Tuple[str, int], data: bytes,
+        upstreams: List[str]
+    ) -> None:
+        self.question = question
+        self.data = data
+        # Everyone who asked this question, and their queries:
+        self.clients = [(client, data)]
+        self.upstreams = upstreams
+        self.deadline = 0.0
+
+
+class StubResolver(object):
+    """
+    Local DNS server that forwards each query to the cluster or the local
+    nameserver, as decided by a SplitDomains or RemoteDomains.
+
+    All upstream queries are sent from a single socket, so the firewall rules
+    that send DNS traffic to the stub can leave the stub's own queries alone.
+    If an upstream has no answer and there's another one to try, we ask that
+    one instead.
+
+    Unless disabled, answers (including negative ones) are cached, and a
+    question that's already being asked upstream isn't asked again; everyone
+    who asked gets the one answer.
+    """
+
+    # Seconds to wait for an upstream before trying the next one:
+    UPSTREAM_TIMEOUT = 2
+
+    def __init__(
+        self,
+        runner: Runner,
+        domains: Union[SplitDomains, RemoteDomains],
+        remote: Tuple[str, int],
+        local: Tuple[str, int],
+        cache: bool = True,
+    ) -> None:
+        self.runner = runner
+        self.domains = domains
+        self.addresses = {REMOTE: remote, LOCAL: local}
+        self.cache = DNSCache() if cache else None
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.bind(("0.0.0.0", 0))
+        self.upstream_port = self.upstream.getsockname()[1]
+        self.upstream.settimeout(0.5)
+        self.pending = {}  # type: Dict[int, _Pending]
+        self.in_flight = {}  # type: Dict[Tuple[str, int], _Pending]
+        self.lock = Lock()
+        self._next_id = count(random.randint(0, 0xFFFF))
+
+    def start(self) -> None:
+        """Start answering queries in background threads."""
+        self.runner.write(
+            "DNS stub listening on 127.0.0.1:{}, querying from port {}".format(
+                self.port, self.upstream_port
+            )
+        )
+        for target in (self._serve_clients, self._serve_upstreams):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        self.server.close()
+        self.upstream.close()
+
+    def _serve_clients(self) -> None:
+        while True:
+            try:
+                data, client = self.server.recvfrom(4096)
+            except OSError:
+                # Closed
+                return
+            question = parse_question(data)
+            if question is None:
+                continue
+            self.resolve(client, data, question)
+
+    def resolve(
+        self, client: Tuple[str, int], data: bytes, question: Tuple[str, int]
+    ) -> None:
+        """
+        Answer a client's query from the cache, or send it to the first
+        upstream for the name asked about.
+        """
+        if self.cache is not None:
+            response = self.cache.get(question)
+            if response is not None:
+                self._reply(client, data, response)
+                return
+        with self.lock:
+            pending = self.in_flight.get(question)
+            if pending is not None:
+                pending.clients.append((client, data))
+                return
+            pending = _Pending(
+                question, client, data, self.domains.upstreams(question[0])
+            )
+            if self.cache is not None:
+                self.in_flight[question] = pending
+        self._send(pending)
+
+    def _send(self, pending: _Pending) -> None:
+        upstream_id = next(self._next_id) & 0xFFFF
+        pending.deadline = time() + self.UPSTREAM_TIMEOUT
+        with self.lock:
+            self.pending[upstream_id] = pending
+        try:
+            self.upstream.sendto(
+                struct.pack("!H", upstream_id) + pending.data[2:],
+                self.addresses[pending.upstreams[0]]
+            )
+        except OSError as e:
+            self.runner.write("Failed to forward DNS query: {}".format(e))
+
+    def _next_upstream(self, pending: _Pending) -> bool:
+        """Try the next upstream, if there is one."""
+        if len(pending.upstreams) < 2:
+            return False
+        pending.upstreams = pending.upstreams[1:]
+        self._send(pending)
+        return True
+
+    def _reply(
+        self, client: Tuple[str, int], data: bytes, response: bytes
+    ) -> None:
+        try:
+            self.server.sendto(_with_question_of(data, response), client)
+        except (OSError, IndexError):
+            pass
+
+    def _done(self, pending: _Pending) -> None:
+        """Stop collecting clients for a question we're done asking."""
+        with self.lock:
+            if self.in_flight.get(pending.question) is pending:
+                del self.in_flight[pending.question]
+
+    def answer(self, pending: _Pending, response: bytes) -> None:
+        """Send a response to everyone who asked the question, and cache it."""
+        if self.cache is not None:
+            try:
+                self.cache.put(pending.question, response)
+            except (IndexError, struct.error):
+                pass
+        self._done(pending)
+        for client, data in pending.clients:
+            self._reply(client, data, response)
+
+    def _serve_upstreams(self) -> None:
+        while True:
+            try:
+                response = self.upstream.recv(4096)
+            except socket.timeout:
+                response = None
+            except OSError:
+                # Closed
+                return
+            if response is not None and len(response) >= 12:
+                upstream_id = struct.unpack("!H", response[:2])[0]
+                with self.lock:
+                    pending = self.pending.pop(upstream_id, None)
+                if pending is not None:
+                    if not (
+                        is_negative(response) and self._next_upstream(pending)
+                    ):
+                        self.answer(pending, response)
+            # Give up on upstreams that don't answer:
+            now = time()
+            with self.lock:
+                expired = [(i, p) for (i, p) in self.pending.items()
+                           if p.deadline < now]
+                for upstream_id, _ in expired:
+                    del self.pending[upstream_id]
+            for _, pending in expired:
+                if not self._next_upstream(pending):
+                    self._done(pending)
+
+
+# Comment on the iptables rules added by redirect_dns(), followed by the pid
+# of the telepresence that added them:
+RULE_TAG = "telepresence-"
+
+
+def _tagged_rules(runner: Runner) -> List[Tuple[int, List[str]]]:
+    """
+    Return the NAT OUTPUT rules redirect_dns() added, as the pid of the
+    telepresence that added them and the arguments that delete the rule.
+    """
+    result = []
+    for line in runner.get_output([
+        "sudo", "iptables", "-t", "nat", "-S", "OUTPUT"
+    ]).splitlines():
+        parts = shlex.split(line)
+        if not parts or parts[0] != "-A" or "--comment" not in parts:
+            continue
+        comment = parts[parts.index("--comment") + 1]
+        if comment.startswith(RULE_TAG) and comment[len(RULE_TAG):].isdigit():
+            result.append((int(comment[len(RULE_TAG):]), ["-D"] + parts[1:]))
+    return result
+
+
+def _delete_rules(runner: Runner, rules: List[List[str]]) -> None:
+    for rule in rules:
+        try:
+            runner.check_call(["sudo", "iptables", "-t", "nat"] + rule)
+        except CalledProcessError as e:
+            runner.write("Failed to delete iptables rule: {}".format(e))
+
+
+def remove_stale_rules(runner: Runner) -> None:
+    """
+    Delete rules left behind by a telepresence that's no longer running,
+    e.g. because it was killed with SIGKILL before it could clean up.
+    """
+    _delete_rules(
+        runner, [
+            rule for (pid, rule) in _tagged_rules(runner)
+            if not is_running(pid)
+        ]
+    )
+
+
+def redirect_dns(
+    runner: Runner, subprocesses: Subprocesses, stub: StubResolver
+) -> None:
+    """
+    Send UDP DNS queries for the nameservers in /etc/resolv.conf to the stub,
+    except the stub's own, using iptables. Linux only; needs sudo.
+
+    TCP queries, which resolvers only make when a UDP answer was truncated,
+    aren't redirected, and go to the nameservers as usual.
+
+    The rules are tagged with our pid. Besides being deleted on exit, they're
+    deleted by a watchdog process if we die without cleaning up, and failing
+    that by remove_stale_rules() the next time telepresence runs.
+    """
+    remove_stale_rules(runner)
+    tag = RULE_TAG + str(os.getpid())
+    rules = []
+    for nameserver in get_resolv_conf_namservers():
+        rule = [
+            "OUTPUT", "-p", "udp", "-d", nameserver, "--dport", "53", "!",
+            "--sport",
+            str(stub.upstream_port), "-m", "comment", "--comment", tag, "-j",
+            "REDIRECT", "--to-ports",
+            str(stub.port)
+        ]
+        runner.check_call(["sudo", "iptables", "-t", "nat", "-I"] + rule)
+        rules.append(["-D"] + rule)
+
+    def watchdog() -> Popen:
+        # Runs as root, so it can check on us and delete the rules. Once we've
+        # exited it deletes them whether or not we did, so it needn't be
+        # killed:
+        script = "while kill -0 {} 2>/dev/null; do sleep 1; done".format(
+            os.getpid()
+        )
+        for rule in rules:
+            script += "; iptables -t nat {} 2>/dev/null".format(
+                " ".join(shlex.quote(arg) for arg in rule)
+            )
+        return runner.popen(["sudo", "sh", "-c", script])
+
+    subprocesses.append(
+        watchdog(),
+        lambda: _delete_rules(runner, rules),
+        auxiliary(runner, "DNS redirect watchdog", watchdog),
+    )
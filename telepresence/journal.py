@@ -0,0 +1,103 @@
+"""
+Journal of swapped Deployments.
+
+Before --swap-deployment changes anything it records how to undo the swap,
+and the record is removed once the swap has been undone on exit. If
+telepresence is killed, or the machine crashes, before that happens, the
+record stays behind for telepresence --restore to undo.
+"""
+
+import json
+import sys
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional
+
+import os
+
+from telepresence.cache import cache_dir
+from telepresence.utilities import process_start_time
+
+
+def journal_dir() -> Path:
+    """Return the directory where swap records are kept."""
+    return cache_dir() / "swaps"
+
+
+def _path(run_id: str, directory: Optional[Path]) -> Path:
+    return (directory or journal_dir()) / (run_id + ".json")
+
+
+def record_swap(
+    run_id: str,
+    kubectl_cmd: str,
+    context: str,
+    namespace: str,
+    kind: str,
+    name: str,
+    original: Dict,
+    restore_patch: Optional[List[Dict]] = None,
+    directory: Optional[Path] = None,
+) -> Dict:
+    """
+    Record how to undo a swap, and return the record.
+
+    kind is "deployment" or "rc", name is the object that gets swapped, and
+    original is its JSON before the swap. If restore_patch is given, undoing
+    the swap means applying that JSON Patch rather than recreating original.
+    """
+    entry = {
+        "run_id": run_id,
+        "kubectl": kubectl_cmd,
+        "context": context,
+        "namespace": namespace,
+        "kind": kind,
+        "name": name,
+        "original": original,
+        "restore_patch": restore_patch,
+        "pid": os.getpid(),
+        "pid_started": process_start_time(os.getpid()),
+        "created": time(),
+    }
+    path = _path(run_id, directory)
+    temporary = path.with_name(path.name + ".tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Only readable by the current user, since the original object may
+        # include secrets in its environment variables:
+        fd = os.open(
+            str(temporary), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(temporary), str(path))
+    except OSError as e:
+        print(
+            "Failed to record the swap in {} ({}), so if telepresence dies"
+            " without restoring {} you will need to restore it manually.".
+            format(path, e, name),
+            file=sys.stderr
+        )
+    return entry
+
+
+def forget_swap(run_id: str, directory: Optional[Path] = None) -> None:
+    """Remove the record of a swap that has been undone."""
+    try:
+        _path(run_id, directory).unlink()
+    except OSError:
+        pass
+
+
+def outstanding_swaps(directory: Optional[Path] = None) -> List[Dict]:
+    """Return the records of swaps that haven't been undone, oldest first."""
+    entries = []
+    for path in (directory or journal_dir()).glob("*.json"):
+        try:
+            with path.open() as f:
+                entries.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(entries, key=lambda entry: entry.get("created", 0))
@@ -3,7 +3,7 @@ import atexit
 import sys
 from subprocess import CalledProcessError, Popen
 from time import time, sleep
-from typing import Dict
+from typing import Dict, List
 
 import os
 from shutil import rmtree, copy
@@ -13,6 +13,7 @@ from telepresence.cleanup import Subprocesses, kill_process, wait_for_exit
 from telepresence.remote import RemoteInfo, mount_remote_volumes
 from telepresence.runner import Runner
 from telepresence.ssh import SSH
+from telepresence.tun import connect_tun
 from telepresence.vpn import connect_sshuttle
 
 
@@ -117,9 +118,15 @@ def setup_torsocks(runner, env, socks_port, unsupported_tools_path):
 def run_local_command(
     runner: Runner, remote_info: RemoteInfo, args: argparse.Namespace,
     env_overrides: Dict[str, str], subprocesses: Subprocesses, socks_port: int,
-    ssh: SSH
+    sshs: List[SSH]
 ) -> None:
-    """--run-shell/--run support, run command locally."""
+    """
+    --run-shell/--run support, run command locally.
+
+    :param sshs: SSH instances, one per kubectl port-forward. sshuttle uses
+        the first and the volume mount the last, so with more than one
+        port-forward they don't compete.
+    """
     env = os.environ.copy()
     env.update(env_overrides)
 
@@ -132,11 +139,14 @@ def run_local_command(
     unsupported_tools_path = get_unsupported_tools(args.method != "inject-tcp")
     env["PATH"] = unsupported_tools_path + ":" + env["PATH"]
 
-    # Mount remote filesystem:
-    mount_dir, mount_cleanup = mount_remote_volumes(
-        runner, remote_info, ssh, False
+    # Mount remote filesystem. This happens in the background, so programs
+    # that need the volumes straight away should wait for the ready marker:
+    mount_dir, ready_marker, mount_cleanup = mount_remote_volumes(
+        runner, remote_info, sshs[-1], False, args.mount_profile,
+        args.volume_mode, args.volume_resync, args.volume_cache_size
     )
     env["TELEPRESENCE_ROOT"] = mount_dir
+    env["TELEPRESENCE_ROOT_READY"] = ready_marker
 
     # Make sure we use "bash", no "/bin/bash", so we get the copied version on
     # OS X:
@@ -151,7 +161,12 @@ def run_local_command(
         setup_torsocks(runner, env, socks_port, unsupported_tools_path)
         p = Popen(["torsocks"] + command, env=env)
     elif args.method == "vpn-tcp":
-        connect_sshuttle(runner, remote_info, args, subprocesses, env, ssh)
+        connect_sshuttle(
+            runner, remote_info, args, subprocesses, env, sshs[0]
+        )
+        p = Popen(command, env=env)
+    elif args.method == "vpn-tun":
+        connect_tun(runner, remote_info, args, subprocesses, env, sshs[0])
         p = Popen(command, env=env)
 
     def terminate_if_alive():
@@ -10,20 +10,28 @@ import signal
 import os
 import re
 import sys
-from typing import List, Tuple, Dict
+from typing import List, Optional, Tuple, Dict
 from shutil import which
-from subprocess import (CalledProcessError, check_output, STDOUT, DEVNULL)
+from subprocess import (
+    CalledProcessError, check_output, Popen, STDOUT, DEVNULL
+)
 from time import sleep, time
 
-from telepresence.cleanup import Subprocesses
+from telepresence.agent import AgentError, start_agent_tunnel
+from telepresence.cleanup import Subprocesses, auxiliary, critical, \
+    kill_process
 from telepresence.cli import parse_args, handle_unexpected_errors
-from telepresence.deployment import create_new_deployment, swap_deployment, \
-    swap_deployment_openshift
+from telepresence.balancer import RoundRobinProxy, SOCKSPool
+from telepresence.deployment import create_new_deployment, \
+    restore_outstanding_swaps, swap_deployment, swap_deployment_openshift
 from telepresence.container import MAC_LOOPBACK_IP, run_docker_command
 from telepresence.local import run_local_command
-from telepresence.remote import RemoteInfo, get_remote_info
+from telepresence.pool import use_pool
+from telepresence.remote import RemoteInfo, cache_remote_info, \
+    get_cached_remote_info, get_direct_ssh_address, get_remote_info, \
+    get_resource_versions
 from telepresence.runner import Runner
-from telepresence.ssh import SSH
+from telepresence.ssh import SSH, generate_key
 from telepresence.startup import kubectl_or_oc, require_command
 from telepresence.usage_tracking import call_scout
 from telepresence.utilities import find_free_port
@@ -57,11 +65,18 @@ def get_env_variables(runner: Runner, remote_info: RemoteInfo,
     """
     Generate environment variables that match kubernetes.
     """
-    # Get the environment:
-    remote_env = _get_remote_env(
-        runner, context, remote_info.namespace, remote_info.pod_name,
-        remote_info.container_name
-    )
+    # Get the environment, from the agent if the pod has one:
+    remote_env = None  # type: Optional[Dict[str, str]]
+    if remote_info.agent is not None:
+        try:
+            remote_env = remote_info.agent.env()
+        except AgentError as e:
+            runner.write("Agent failed to get environment: {}".format(e))
+    if remote_env is None:
+        remote_env = _get_remote_env(
+            runner, context, remote_info.namespace, remote_info.pod_name,
+            remote_info.container_name
+        )
     # Tell local process about the remote setup, useful for testing and
     # debugging:
     result = {
@@ -78,12 +93,13 @@ def get_env_variables(runner: Runner, remote_info: RemoteInfo,
 
 
 def expose_local_services(
-    processes: Subprocesses, ssh: SSH, port_numbers: List[Tuple[int, int]]
+    processes: Subprocesses, sshs: List[SSH],
+    port_numbers: List[Tuple[int, int]]
 ) -> None:
     """Create SSH tunnels from remote proxy pod to local host.
 
     :param processes: A `Subprocesses` instance.
-    :param ssh: A 'SSH` instance.
+    :param sshs: List of `SSH` instances; tunnels are spread across them.
     :param port_numbers: List of pairs of (local port, remote port).
     """
     output = sys.stderr.isatty()
@@ -94,7 +110,7 @@ def expose_local_services(
             " ports you want to forward.",
             file=sys.stderr
         )
-    for local_port, remote_port in port_numbers:
+    for i, (local_port, remote_port) in enumerate(sorted(port_numbers)):
         if output:
             print(
                 "Forwarding remote port {} to local port {}.".format(
@@ -103,51 +119,146 @@ def expose_local_services(
                 ),
                 file=sys.stderr
             )
+        ssh = sshs[i % len(sshs)]
+        tunnel_args = [
+            "-R", "*:{}:127.0.0.1:{}".format(remote_port, local_port)
+        ]
         processes.append(
-            ssh.popen([
-                "-R", "*:{}:127.0.0.1:{}".format(remote_port, local_port)
-            ])
+            ssh.popen(tunnel_args),
+            policy=ssh.tunnel_policy(
+                "SSH tunnel for port {}".format(remote_port), tunnel_args
+            ),
         )
     if output:
         print("", file=sys.stderr)
 
 
+def forward_ssh_port(
+    runner: Runner, processes: Subprocesses, remote_info: RemoteInfo,
+    context: str
+) -> SSH:
+    """
+    Start a kubectl port-forward to the proxy pod's SSH server.
+
+    Returns SSH instance that connects via the port-forward.
+    """
+    ssh = SSH(runner, find_free_port())
+
+    def port_forward() -> Popen:
+        return runner.popen(
+            runner.kubectl(
+                context, remote_info.namespace, [
+                    "port-forward", remote_info.pod_name,
+                    "{}:8022".format(ssh.port)
+                ]
+            )
+        )
+
+    def reconnect() -> Popen:
+        # Same pod, same local port, so everything already pointing at the
+        # port (sshfs, sshuttle, the SSH tunnels) can just reconnect:
+        process = port_forward()
+        try:
+            ssh.wait(timeout=10)
+        except RuntimeError:
+            kill_process(process)
+            raise
+        return process
+
+    ssh.connection_policy = critical(
+        runner, "kubectl port-forward to port {}".format(ssh.port), reconnect
+    )
+    processes.append(port_forward(), policy=ssh.connection_policy)
+    return ssh
+
+
+def connect_direct(
+    runner: Runner, remote_info: RemoteInfo, args: argparse.Namespace
+) -> Optional[SSH]:
+    """
+    Connect to the proxy pod's SSH server directly, bypassing the API server.
+
+    Returns SSH instance, or None if the server can't be reached, in which case
+    we fall back to kubectl port-forward.
+    """
+    try:
+        host, port = get_direct_ssh_address(runner, remote_info, args)
+        ssh = SSH(runner, port, host, args.ssh_identity)
+        ssh.wait(timeout=20)
+    except (CalledProcessError, RuntimeError, KeyError) as e:
+        runner.write("Direct SSH connection failed: {}".format(e))
+        if sys.stderr.isatty():
+            print(
+                "Couldn't connect to the proxy pod directly, falling back to"
+                " kubectl port-forward.",
+                file=sys.stderr
+            )
+        return None
+    runner.write("Connected directly to SSH at {}:{}".format(host, port))
+    return ssh
+
+
 def connect(
     runner: Runner, remote_info: RemoteInfo, cmdline_args: argparse.Namespace
-) -> Tuple[Subprocesses, int, SSH]:
+) -> Tuple[Subprocesses, int, List[SSH]]:
     """
     Start all the processes that handle remote proxying.
 
-    Return (Subprocesses, local port of SOCKS proxying tunnel, SSH instance).
+    Return (Subprocesses, local port of SOCKS proxying tunnel, SSH instances).
+
+    There is one SSH instance per kubectl port-forward (see --port-forwards).
+    The first one carries the main proxying traffic (sshuttle or SOCKS), the
+    last one the volume mount. If --direct-ssh works the direct connection is
+    used instead, except for the container method's proxy container.
     """
     processes = Subprocesses()
-    # Keep local copy of pod logs, for debugging purposes:
-    processes.append(
-        runner.popen(
+
+    # Keep local copy of pod logs, for debugging purposes. Losing the log
+    # stream is no reason to end the session, so just restart it:
+    def follow_logs(extra_args: Optional[List[str]] = None) -> Popen:
+        return runner.popen(
             runner.kubectl(
                 cmdline_args.context, remote_info.namespace, [
                     "logs", "-f", remote_info.pod_name, "--container",
                     remote_info.container_name
-                ]
+                ] + (extra_args or [])
             ),
             bufsize=0,
         )
-    )
-
-    ssh = SSH(runner, find_free_port())
 
-    # forward remote port to here, by tunneling via remote SSH server:
     processes.append(
-        runner.popen(
-            runner.kubectl(
-                cmdline_args.context, remote_info.namespace, [
-                    "port-forward", remote_info.pod_name,
-                    "{}:8022".format(ssh.port)
-                ]
-            )
+        follow_logs(),
+        policy=auxiliary(
+            runner,
+            "Pod log follower",
+            # Don't dump logs we already have all over again:
+            lambda: follow_logs(["--tail=0"]),
         )
     )
+
+    direct = None
+    if cmdline_args.direct_ssh is not None:
+        direct = connect_direct(runner, remote_info, cmdline_args)
+    if direct is not None and cmdline_args.method != "container":
+        # Everything can go direct, no need for the API server at all:
+        sshs = [direct]
+    else:
+        # forward remote port to here, by tunneling via remote SSH server.
+        # Each kubectl port-forward is a separate stream through the API
+        # server, so using more than one gives us more throughput:
+        sshs = [
+            forward_ssh_port(
+                runner, processes, remote_info, cmdline_args.context
+            ) for _ in range(cmdline_args.port_forwards)
+        ]
+        if direct is not None:
+            # The proxy container still uses the port-forward, but the volume
+            # mount (which uses the last one) can go direct:
+            sshs.append(direct)
     if cmdline_args.method == "container":
+        # The proxy container only needs to reach the first SSH server; the
+        # volume mount runs on the host.
+        ssh = sshs[0]
         # kubectl port-forward currently only listens on loopback. So we
         # portforward from the docker0 interface on Linux, and the lo0 alias we
         # added on OS X, to loopback (until we can use kubectl port-forward
@@ -190,38 +301,62 @@ def connect(
                 ["sudo", "ifconfig", "lo0", "-alias", MAC_LOOPBACK_IP]
             )
             docker_interface = MAC_LOOPBACK_IP
+        socat_command = [
+            "socat", "TCP4-LISTEN:{},bind={},reuseaddr,fork".format(
+                ssh.port,
+                docker_interface,
+            ), "TCP4:127.0.0.1:{}".format(ssh.port)
+        ]
         processes.append(
-            runner.popen([
-                "socat", "TCP4-LISTEN:{},bind={},reuseaddr,fork".format(
-                    ssh.port,
-                    docker_interface,
-                ), "TCP4:127.0.0.1:{}".format(ssh.port)
-            ])
+            runner.popen(socat_command),
+            policy=critical(
+                runner, "socat", lambda: runner.popen(socat_command)
+            ),
         )
 
-    ssh.wait()
+    for ssh in sshs:
+        ssh.wait()
+
+    # Ask the pod about itself over SSH rather than with kubectl exec:
+    remote_info.agent = start_agent_tunnel(runner, processes, sshs[0])
 
     # In Docker mode this happens inside the local Docker container:
     if cmdline_args.method != "container":
         expose_local_services(
             processes,
-            ssh,
+            sshs,
             cmdline_args.expose.local_to_remote(),
         )
 
     socks_port = find_free_port()
     if cmdline_args.method == "inject-tcp":
-        # start tunnel to remote SOCKS proxy:
-        processes.append(
-            ssh.popen(["-L",
-                       "127.0.0.1:{}:127.0.0.1:9050".format(socks_port)]),
-        )
+        # start tunnels to remote SOCKS proxy, one per port-forward:
+        front_end = len(sshs) > 1 or cmdline_args.socks_pool > 0
+        tunnel_ports = [find_free_port() for _ in sshs
+                        ] if front_end else [socks_port]
+        for ssh, port in zip(sshs, tunnel_ports):
+            socks_args = ["-L", "127.0.0.1:{}:127.0.0.1:9050".format(port)]
+            processes.append(
+                ssh.popen(socks_args),
+                policy=ssh.tunnel_policy("SOCKS tunnel", socks_args),
+            )
+        # torsocks only knows about one port, so we may need a local
+        # front-end to spread its connections across the tunnels. If there's
+        # a pool the front-end also does the SOCKS greeting ahead of time,
+        # saving a round trip on each connection:
+        if cmdline_args.socks_pool > 0:
+            SOCKSPool(
+                runner, socks_port, tunnel_ports, cmdline_args.socks_pool
+            ).start()
+        elif front_end:
+            RoundRobinProxy(runner, socks_port, tunnel_ports).start()
 
-    return processes, socks_port, ssh
+    return processes, socks_port, sshs
 
 
 def start_proxy(runner: Runner, args: argparse.Namespace
-                ) -> Tuple[Subprocesses, Dict[str, str], int, SSH, RemoteInfo]:
+                ) -> Tuple[Subprocesses, Dict[str, str], int, List[SSH],
+                           RemoteInfo]:
     """Start the kubectl port-forward and SSH clients that do the proxying."""
     if sys.stdout.isatty() and args.method != "container":
         print(
@@ -230,7 +365,7 @@ def start_proxy(runner: Runner, args: argparse.Namespace
             file=sys.stderr,
             end=" ",
         )
-        if args.method == "vpn-tcp":
+        if args.method in ("vpn-tcp", "vpn-tun"):
             print(
                 "All processes are affected, only one telepresence"
                 " can run per machine, and you can't use other VPNs."
@@ -259,9 +394,21 @@ def start_proxy(runner: Runner, args: argparse.Namespace
 
     run_id = None
 
+    # --direct-ssh uses key authentication, with a key only we know:
+    args.ssh_identity = args.ssh_public_key = None
+    if args.direct_ssh is not None:
+        args.ssh_identity, args.ssh_public_key = generate_key(runner)
+
+    pooled = None
     if args.new_deployment is not None:
         # This implies --new-deployment:
-        args.deployment, run_id = create_new_deployment(runner, args)
+        if args.pool_size:
+            pooled = use_pool(runner, args)
+        if pooled is not None:
+            remote_info, run_id = pooled
+            args.deployment = remote_info.deployment_name
+        else:
+            args.deployment, run_id = create_new_deployment(runner, args)
 
     if args.swap_deployment is not None:
         # This implies --swap-deployment
@@ -288,28 +435,49 @@ def start_proxy(runner: Runner, args: argparse.Namespace
         else:
             deployment_type = "deploymentconfig"
 
-    remote_info = get_remote_info(
-        runner,
-        args.deployment,
-        args.context,
-        args.namespace,
-        deployment_type,
-        run_id=run_id,
-    )
+    # An existing Deployment that hasn't changed since last time needn't be
+    # looked at all over again:
+    cached = None
+    if run_id is None:
+        cached = get_cached_remote_info(
+            runner, args.deployment, args.context, args.namespace,
+            deployment_type
+        )
+    if cached is not None:
+        remote_info, env = cached
+    elif pooled is None:
+        remote_info = get_remote_info(
+            runner,
+            args.deployment,
+            args.context,
+            args.namespace,
+            deployment_type,
+            run_id=run_id,
+        )
+        if run_id is None:
+            versions = get_resource_versions(
+                runner, args.context, args.namespace, deployment_type,
+                args.deployment, remote_info.pod_name
+            )
 
-    processes, socks_port, ssh = connect(runner, remote_info, args)
+    processes, socks_port, sshs = connect(runner, remote_info, args)
 
-    # Get the environment variables we want to copy from the remote pod; it may
-    # take a few seconds for the SSH proxies to get going:
-    start = time()
-    while time() - start < 10:
-        try:
-            env = get_env_variables(runner, remote_info, args.context)
-            break
-        except CalledProcessError:
-            sleep(0.25)
+    if cached is None:
+        # Get the environment variables we want to copy from the remote pod;
+        # it may take a few seconds for the SSH proxies to get going:
+        start = time()
+        while time() - start < 10:
+            try:
+                env = get_env_variables(runner, remote_info, args.context)
+                break
+            except CalledProcessError:
+                sleep(0.25)
+        if run_id is None:
+            cache_remote_info(
+                runner, remote_info, deployment_type, versions, env
+            )
 
-    return processes, env, socks_port, ssh, remote_info
+    return processes, env, socks_port, sshs, remote_info
 
 
 def main():
@@ -337,6 +505,14 @@ def main():
         else:
             raise SystemExit("Found neither 'kubectl' nor 'oc' in your $PATH.")
 
+        if args.restore:
+            if args.logfile != "-":
+                args.logfile = os.path.abspath(args.logfile)
+            restore_outstanding_swaps(
+                Runner.open(args.logfile, prelim_command, args.verbose)
+            )
+            return
+
         # Usage tracking
         try:
             kubectl_version_output = str(
@@ -393,6 +569,7 @@ def main():
         for cluster_setting in kubectl_config["clusters"]:
             if cluster_setting["name"] == cluster:
                 server = cluster_setting["cluster"]["server"]
+        args.cluster_server = server
 
         # Log file path should be absolute since some processes may run in
         # different directories:
@@ -406,6 +583,12 @@ def main():
             )
         )
 
+        if args.direct_ssh is not None and runner.kubectl_cmd == "oc":
+            raise SystemExit("--direct-ssh is not supported on OpenShift.")
+        if args.method == "vpn-tun" and runner.kubectl_cmd == "oc":
+            # OpenShift doesn't support running as root:
+            raise SystemExit("--method vpn-tun is not supported on OpenShift.")
+
         # Figure out if we need capability that allows for ports < 1024:
         if any([p < 1024 for p in args.expose.remote()]):
             if runner.kubectl_cmd == "oc":
@@ -475,8 +658,11 @@ def main():
         # Need conntrack for sshuttle on Linux:
         if sys.platform.startswith("linux") and args.method == "vpn-tcp":
             require_command(runner, "conntrack")
+        # Need ip to set up the TUN device and its routes:
+        if args.method == "vpn-tun":
+            require_command(runner, "ip")
 
-        subprocesses, env, socks_port, ssh, remote_info = start_proxy(
+        subprocesses, env, socks_port, sshs, remote_info = start_proxy(
             runner, args
         )
         if args.method == "container":
@@ -486,11 +672,11 @@ def main():
                 args,
                 env,
                 subprocesses,
-                ssh,
+                sshs,
             )
         else:
             run_local_command(
-                runner, remote_info, args, env, subprocesses, socks_port, ssh
+                runner, remote_info, args, env, subprocesses, socks_port, sshs
             )
 
     go()
@@ -0,0 +1,292 @@
+"""
+Warm pool of proxy pods for --new-deployment.
+
+Starting a proxy pod means scheduling it, pulling the image and starting the
+SSH server and forwarder, which is most of the time telepresence takes to
+start. With --pool-size, each namespace gets a Job that keeps that many idle
+proxy pods running. A session claims one by relabelling it: once it no longer
+has the pool's label the Job lets go of it, and starts a replacement in the
+background. The claimed pod is deleted on exit, like a Deployment created by
+--new-deployment would be.
+
+The pool is a Job rather than a Deployment so that it expires by itself: each
+session that uses it pushes its activeDeadlineSeconds back to --pool-ttl
+seconds from now, and once no session has done so for that long Kubernetes
+deletes its idle pods, even if telepresence is never run again. The finished
+Job is deleted by Kubernetes too where the TTL controller is enabled, or else
+replaced by the next session that uses the pool.
+"""
+
+import argparse
+import atexit
+import hashlib
+import json
+from subprocess import CalledProcessError
+from threading import Thread
+from calendar import timegm
+from time import strptime, time
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from telepresence import TELEPRESENCE_REMOTE_IMAGE
+from telepresence.remote import RemoteInfo
+from telepresence.runner import Runner
+from telepresence.utilities import get_alternate_nameserver
+
+# Label on pool Jobs and their idle pods, whose value identifies the pod
+# configuration:
+POOL_LABEL = "telepresence-pool"
+
+
+def pool_job(args: argparse.Namespace) -> Dict:
+    """
+    Return the Job for the pool of pods that suit this session.
+
+    Sessions that need differently configured pods get different pools.
+    """
+    List  # Avoid Pyflakes F401
+    env = []  # type: List[Dict[str, str]]
+    # If we're on local VM we need to use different nameserver to prevent
+    # infinite loops caused by sshuttle:
+    if args.method == "vpn-tcp" and args.in_local_vm:
+        env.append({
+            "name": "TELEPRESENCE_NAMESERVER",
+            "value": get_alternate_nameserver()
+        })
+    container = {
+        "name": "telepresence",
+        "image": TELEPRESENCE_REMOTE_IMAGE,
+        "resources": {
+            "limits": {
+                "cpu": "100m",
+                "memory": "256Mi"
+            },
+            "requests": {
+                "cpu": "25m",
+                "memory": "64Mi"
+            },
+        },
+        "env": env,
+    }  # type: Dict
+    # Job pods can't use the default restart policy, Always:
+    pod_spec = {
+        "containers": [container],
+        "restartPolicy": "OnFailure"
+    }  # type: Dict
+    # The proxy needs to create a TUN device for --method vpn-tun:
+    if args.method == "vpn-tun":
+        env.append({"name": "TELEPRESENCE_TUN", "value": "1"})
+        container["securityContext"] = {"privileged": True}
+    if args.needs_root or args.method == "vpn-tun":
+        pod_spec["securityContext"] = {"runAsUser": 0}
+    key = hashlib.sha256(
+        json.dumps(pod_spec, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:12]
+    labels = {POOL_LABEL: key}
+    return {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {
+            "name": "telepresence-pool-" + key,
+            "labels": labels,
+        },
+        "spec": {
+            "parallelism": args.pool_size,
+            "activeDeadlineSeconds": args.pool_ttl,
+            "ttlSecondsAfterFinished": 0,
+            # Our own selector, rather than one generated from the Job's uid,
+            # so removing POOL_LABEL is all it takes to claim a pod:
+            "manualSelector": True,
+            "selector": {
+                "matchLabels": labels
+            },
+            "template": {
+                "metadata": {
+                    "labels": labels
+                },
+                "spec": pod_spec,
+            },
+        },
+    }
+
+
+def claim_pod(
+    runner: Runner, args: argparse.Namespace, job: Dict, run_id: str
+) -> Optional[str]:
+    """
+    Take a ready pod from the pool, labelling it with run_id. Return its name,
+    or None if no pod is ready.
+    """
+    key = job["metadata"]["labels"][POOL_LABEL]
+    try:
+        pods = json.loads(
+            runner.get_kubectl(
+                args.context, args.namespace, [
+                    "get", "pod", "-o", "json",
+                    "--selector={}={}".format(POOL_LABEL, key)
+                ]
+            )
+        )["items"]
+    except CalledProcessError:
+        return None
+    for pod in pods:
+        statuses = pod["status"].get("containerStatuses", [])
+        if pod["status"]["phase"] != "Running" or not all(
+            status["ready"] for status in statuses
+        ) or pod["metadata"].get("deletionTimestamp"):
+            continue
+        name = pod["metadata"]["name"]
+        try:
+            # Another session may be claiming the same pod; only one of us
+            # gets to change this version of it:
+            runner.check_kubectl(
+                args.context, args.namespace, [
+                    "label", "pod", name, POOL_LABEL + "-",
+                    "telepresence=" + run_id, "--resource-version=" +
+                    pod["metadata"]["resourceVersion"]
+                ]
+            )
+        except CalledProcessError:
+            continue
+        runner.write("Claimed pod {} from the pool".format(name))
+        return name
+    return None
+
+
+def job_finished(job: Dict) -> bool:
+    """Return whether a Job has failed (e.g. expired) or completed."""
+    return any(
+        condition["type"] in ("Failed", "Complete")
+        and condition["status"] == "True"
+        for condition in job.get("status", {}).get("conditions", [])
+    )
+
+
+def update_pool(runner: Runner, args: argparse.Namespace, job: Dict) -> None:
+    """
+    Create or resize our pool, and push its deadline back so it lives for
+    another args.pool_ttl seconds.
+    """
+    name = job["metadata"]["name"]
+    try:
+        try:
+            current = json.loads(
+                runner.get_kubectl(
+                    args.context, args.namespace,
+                    ["get", "job", name, "-o", "json"]
+                )
+            )  # type: Optional[Dict]
+        except CalledProcessError:
+            # Not created yet, or already deleted by the TTL controller:
+            current = None
+        if current is not None and job_finished(current):
+            runner.write("Replacing expired pool {}".format(name))
+            runner.check_kubectl(
+                args.context, args.namespace,
+                ["delete", "job", "--ignore-not-found", name]
+            )
+            current = None
+        if current is None:
+            runner.check_kubectl(
+                args.context,
+                args.namespace, ["create", "-f", "-"],
+                input=json.dumps(job).encode("utf-8")
+            )
+            return
+        # The deadline counts from when the Job started:
+        started = current.get("status", {}).get("startTime")
+        age = 0
+        if started is not None:
+            age = int(time()) - timegm(strptime(started, "%Y-%m-%dT%H:%M:%SZ"))
+        patch = {
+            "spec": {
+                "parallelism": args.pool_size,
+                "activeDeadlineSeconds": max(age, 0) + args.pool_ttl,
+            }
+        }
+        runner.check_kubectl(
+            args.context, args.namespace, [
+                "patch", "job", name, "--type=merge",
+                "--patch=" + json.dumps(patch)
+            ]
+        )
+    except (CalledProcessError, ValueError) as e:
+        runner.write("Failed to update pool: {}".format(e))
+
+
+def expose_pod(
+    runner: Runner, args: argparse.Namespace, name: str, run_id: str
+) -> None:
+    """
+    Create the Service that kubectl run --expose would have, selecting the
+    claimed pod by its run_id label.
+    """
+    ports = sorted(args.expose.remote())
+    if not ports:
+        return
+    service = {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {
+            "name": name,
+            "labels": {
+                "telepresence": run_id
+            },
+        },
+        "spec": {
+            "selector": {
+                "telepresence": run_id
+            },
+            "ports": [{
+                "name": "port-{}".format(port),
+                "port": port,
+                "targetPort": port,
+                "protocol": "TCP",
+            } for port in ports],
+        },
+    }
+    runner.check_kubectl(
+        args.context,
+        args.namespace, ["apply", "-f", "-"],
+        input=json.dumps(service).encode("utf-8")
+    )
+
+
+def use_pool(runner: Runner,
+             args: argparse.Namespace) -> Optional[Tuple[RemoteInfo, str]]:
+    """
+    --pool-size support: claim a pod from the pool instead of creating a new
+    Deployment, and keep the pool going in the background.
+
+    Returns (RemoteInfo for the claimed pod, its unique K8s label), or None if
+    the pool has no ready pods, e.g. the first time it's used.
+    """
+    job = pool_job(args)
+    run_id = str(uuid4())
+    name = claim_pod(runner, args, job, run_id)
+    updater = Thread(target=update_pool, args=(runner, args, job))
+    updater.daemon = True
+    updater.start()
+    if name is None:
+        return None
+
+    def remove_claimed_pod():
+        runner.get_kubectl(
+            args.context, args.namespace, [
+                "delete",
+                "--ignore-not-found",
+                "all",
+                "--selector=telepresence=" + run_id,
+            ]
+        )
+
+    atexit.register(remove_claimed_pod)
+    expose_pod(runner, args, args.new_deployment, run_id)
+    return RemoteInfo(
+        runner,
+        args.context,
+        args.namespace,
+        job["metadata"]["name"],
+        name,
+        job,
+    ), run_id
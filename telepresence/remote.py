@@ -1,12 +1,19 @@
+import argparse
 import json
+import os
 import sys
 from subprocess import STDOUT, CalledProcessError
 from time import time, sleep
-from typing import Optional, Dict, Tuple, Callable
+from typing import Optional, Dict, List, Tuple, Callable
 
+from shlex import quote
+from shutil import rmtree
 from tempfile import mkdtemp
+from threading import Event, Thread
 
 from telepresence import __version__
+from telepresence.agent import Agent
+from telepresence.cache import Cache, ContentCache
 from telepresence.runner import Runner
 from telepresence.ssh import SSH
 
@@ -22,6 +29,7 @@ class RemoteInfo(object):
     :ivar deployment_config dict: The decoded k8s object (i.e. JSON/YAML).
     :ivar container_config dict: The container within the Deployment JSON.
     :ivar container_name str: The name of the container.
+    :ivar agent Agent: Client for the agent in the pod, once connected.
     """
 
     def __init__(
@@ -47,6 +55,8 @@ class RemoteInfo(object):
             )
         self.container_config = containers[0]  # type: Dict
         self.container_name = self.container_config["name"]  # type: str
+        Agent  # Avoid Pyflakes F401
+        self.agent = None  # type: Optional[Agent]
 
     def remote_telepresence_version(self) -> str:
         """Return the version used by the remote Telepresence container."""
@@ -130,6 +140,16 @@ def wait_for_pod(runner: Runner, remote_info: RemoteInfo) -> None:
     )
 
 
+def check_remote_version(remote_info: RemoteInfo) -> None:
+    """Ensure remote container is running same version as we are."""
+    if remote_info.remote_telepresence_version() != __version__:
+        raise SystemExit((
+            "The remote datawire/telepresence-k8s container is " +
+            "running version {}, but this tool is version {}. " +
+            "Please make sure both are running the same version."
+        ).format(remote_info.remote_telepresence_version(), __version__))
+
+
 def get_remote_info(
     runner: Runner,
     deployment_name: str,
@@ -194,15 +214,7 @@ def get_remote_info(
                     name,
                     deployment,
                 )
-                # Ensure remote container is running same version as we are:
-                if remote_info.remote_telepresence_version() != __version__:
-                    raise SystemExit((
-                        "The remote datawire/telepresence-k8s container is " +
-                        "running version {}, but this tool is version {}. " +
-                        "Please make sure both are running the same version."
-                    ).format(
-                        remote_info.remote_telepresence_version(), __version__
-                    ))
+                check_remote_version(remote_info)
                 # Wait for pod to be running:
                 wait_for_pod(runner, remote_info)
                 return remote_info
@@ -216,40 +228,444 @@ def get_remote_info(
     )
 
 
-def mount_remote_volumes(
-    runner: Runner, remote_info: RemoteInfo, ssh: SSH, allow_all_users: bool
-) -> Tuple[str, Callable]:
+# How long cached remote info is reused for, in seconds, as long as the
+# Deployment and pod haven't changed:
+REMOTE_INFO_CACHE_TTL = 24 * 60 * 60
+
+
+def _remote_info_cache() -> Cache:
+    return Cache("remote-info")
+
+
+def _remote_info_key(
+    context: str, namespace: str, deployment_type: str, deployment_name: str
+) -> str:
+    return " ".join([context, namespace, deployment_type, deployment_name])
+
+
+def get_resource_versions(
+    runner: Runner, context: str, namespace: str, deployment_type: str,
+    deployment_name: str, pod_name: str
+) -> Optional[List[str]]:
     """
-    sshfs is used to mount the remote system locally.
+    Return the resourceVersions of the Deployment and the pod, or None if
+    either can't be found. Any change to either object changes its version.
+    """
+    try:
+        return runner.get_kubectl(
+            context, namespace, [
+                "get", "{}/{}".format(deployment_type, deployment_name),
+                "pod/" + pod_name, "-o",
+                "jsonpath={.items[*].metadata.resourceVersion}"
+            ]
+        ).split()
+    except CalledProcessError:
+        return None
 
-    Allowing all users may require root, so we use sudo in that case.
 
-    Returns (path to mounted directory, callable that will unmount it).
+def get_cached_remote_info(
+    runner: Runner, deployment_name: str, context: str, namespace: str,
+    deployment_type: str
+) -> Optional[Tuple[RemoteInfo, Dict[str, str]]]:
+    """
+    Return the RemoteInfo and environment stored by cache_remote_info() for
+    this Deployment, or None if there are none or the Deployment or its pod
+    have changed since.
+
+    This costs one kubectl get, instead of fetching the Deployment, finding
+    its pod, waiting for it and getting its environment.
+    """
+    cache = _remote_info_cache()
+    key = _remote_info_key(
+        context, namespace, deployment_type, deployment_name
+    )
+    cached = cache.get(key, REMOTE_INFO_CACHE_TTL)
+    if cached is None:
+        return None
+    versions = get_resource_versions(
+        runner, context, namespace, deployment_type, deployment_name,
+        cached["pod_name"]
+    )
+    if versions != cached["versions"]:
+        runner.write(
+            "Cached remote info is out of date: {} != {}".format(
+                versions, cached["versions"]
+            )
+        )
+        cache.delete(key)
+        return None
+    remote_info = RemoteInfo(
+        runner, context, namespace, deployment_name, cached["pod_name"],
+        cached["deployment"]
+    )
+    check_remote_version(remote_info)
+    runner.write(
+        "Using cached remote info for pod {}".format(remote_info.pod_name)
+    )
+    return remote_info, cached["env"]
+
+
+def cache_remote_info(
+    runner: Runner, remote_info: RemoteInfo, deployment_type: str,
+    versions: Optional[List[str]], env: Dict[str, str]
+) -> None:
+    """
+    Store remote_info and the pod's environment, for get_cached_remote_info()
+    to reuse while the Deployment and pod have the given resourceVersions.
+    """
+    if versions is None:
+        return
+    _remote_info_cache().set(
+        _remote_info_key(
+            remote_info.context, remote_info.namespace, deployment_type,
+            remote_info.deployment_name
+        ), {
+            "versions": versions,
+            "pod_name": remote_info.pod_name,
+            "deployment": remote_info.deployment_config,
+            "env": env,
+        }
+    )
+
+
+def get_direct_ssh_address(
+    runner: Runner, remote_info: RemoteInfo, args: argparse.Namespace
+) -> Tuple[str, int]:
+    """
+    Return (host, port) of the proxy pod's key-authenticated SSH server, as
+    reachable from this machine without going through the API server.
+    """
+    if args.direct_ssh not in ("nodeport", "loadbalancer"):
+        host, port = args.direct_ssh.rsplit(":", 1)
+        return host, int(port)
+
+    def get(kind: str, name: str) -> Dict:
+        return json.loads(
+            runner.get_kubectl(
+                remote_info.context, remote_info.namespace,
+                ["get", kind, name, "-o", "json"]
+            )
+        )
+
+    if args.direct_ssh == "nodeport":
+        service = get("service", args.ssh_service)
+        port = service["spec"]["ports"][0]["nodePort"]
+        pod = get("pod", remote_info.pod_name)
+        node = get("node", pod["spec"]["nodeName"])
+        addresses = {
+            address["type"]: address["address"]
+            for address in node["status"].get("addresses", [])
+        }
+        for address_type in ("ExternalIP", "InternalIP", "Hostname"):
+            if address_type in addresses:
+                return addresses[address_type], port
+        return pod["status"]["hostIP"], port
+
+    # LoadBalancer; cloud providers can take a while to allocate one:
+    start = time()
+    while time() - start < 120:
+        service = get("service", args.ssh_service)
+        ingress = service["status"].get("loadBalancer", {}).get("ingress")
+        if ingress:
+            return ingress[0].get("ip") or ingress[0]["hostname"], 8023
+        sleep(1)
+    raise RuntimeError("LoadBalancer for SSH was not allocated in time.")
+
+
+# sshfs -o options for each --mount-profile, trading freshness of what's
+# seen locally for fewer round trips to the pod:
+MOUNT_PROFILES = {
+    # sshfs's own defaults: attributes and directory listings may be up to 20
+    # seconds out of date.
+    "default": [],
+    # For build tools and IDEs that stat and read many files that rarely
+    # change: attributes, directory listings and missing files are cached for
+    # 5 minutes, and file contents are kept until a change in size or
+    # modification time is noticed. Also uses the fastest common ciphers.
+    "read-heavy": [
+        "cache_timeout=300",
+        "entry_timeout=300",
+        "attr_timeout=300",
+        "negative_timeout=300",
+        "auto_cache",
+        "Ciphers=aes128-gcm@openssh.com,chacha20-poly1305@openssh.com,"
+        "aes128-ctr",
+    ],
+    # Nothing is cached, so changes made in the pod are seen immediately, at
+    # the cost of a round trip for every operation.
+    "consistent": [
+        "cache=no",
+        "entry_timeout=0",
+        "attr_timeout=0",
+    ],
+}
+
+
+def get_volume_mount_paths(runner: Runner,
+                           remote_info: RemoteInfo) -> List[str]:
+    """
+    Return the paths where the proxy container has volumes mounted.
+
+    We look at the pod rather than the Deployment, so volumes Kubernetes
+    adds, like the service account token, are included. Paths inside another
+    one are left out, since they're visible through it anyway.
+    """
+    try:
+        pod = json.loads(
+            runner.get_kubectl(
+                remote_info.context, remote_info.namespace,
+                ["get", "pod", remote_info.pod_name, "-o", "json"]
+            )
+        )
+        containers = pod["spec"]["containers"]
+    except (CalledProcessError, ValueError, KeyError):
+        containers = [remote_info.container_config]
+    mounts = []  # type: List[Dict]
+    for container in containers:
+        if container["name"] == remote_info.container_name:
+            mounts = container.get("volumeMounts", [])
+    result = []  # type: List[str]
+    for path in sorted(set(m["mountPath"].rstrip("/") for m in mounts)):
+        if not any(path.startswith(parent + "/") for parent in result):
+            result.append(path)
+    return result
+
+
+def get_remote_directories(runner: Runner, ssh: SSH,
+                           paths: List[str]) -> List[str]:
+    """
+    Return which of the given paths are directories in the proxy container;
+    the others are usually single files mounted with subPath.
+    """
+    script = 'for p in {}; do [ -d "$p" ] && echo "$p"; done; true'.format(
+        " ".join(quote(path) for path in paths)
+    )
+    return runner.get_output(ssh.command([script])).splitlines()
+
+
+class VolumeSnapshot(object):
+    """
+    A local copy of the proxy container's volumes, streamed over SSH as a
+    compressed tar.
+
+    Resyncing only transfers files that changed since the last sync, using a
+    marker file in the container. Files deleted in the container are kept.
+    If there's a ContentCache, files found there aren't transferred at all,
+    and transferred files are added to it.
+    """
+
+    # Marker in the container; files newer than it need resyncing:
+    MARKER = "/tmp/telepresence-snapshot"
+
+    def __init__(
+        self,
+        runner: Runner,
+        ssh: SSH,
+        paths: List[str],
+        directory: str,
+        cache: Optional[ContentCache] = None,
+    ) -> None:
+        self.runner = runner
+        self.ssh = ssh
+        # Relative to /, for tar -C /:
+        self.paths = " ".join(quote(path.lstrip("/")) for path in paths)
+        self.directory = directory
+        self.cache = cache
+        self.stopped = Event()
+
+    def _list(self, changed_only: bool) -> List[Tuple[str, int, int, bool]]:
+        """
+        Return path, size, modification time and whether it's a regular file
+        for everything but directories in the volumes, or only for what
+        changed since the last listing.
+        """
+        if not self.paths:
+            # find with no paths would list the container's whole filesystem:
+            return []
+        newer = "-newer " + self.MARKER if changed_only else ""
+        output = self.runner.get_output(
+            self.ssh.command([
+                "touch {marker}.new && cd / && "
+                "find {paths} ! -type d {newer} "
+                "-exec stat -c '%s %Y %f %n' {{}} + && "
+                "mv {marker}.new {marker}".format(
+                    marker=self.MARKER, paths=self.paths, newer=newer
+                )
+            ])
+        )
+        result = []
+        for line in output.splitlines():
+            size, mtime, mode, path = line.split(" ", 3)
+            is_file = int(mode, 16) & 0o170000 == 0o100000
+            result.append((path, int(size), int(mtime), is_file))
+        return result
+
+    def _fetch(self, paths: List[str]) -> None:
+        """Stream the given paths, relative to /, into the directory."""
+        ssh_command = self.ssh.command(["cd / && tar -czf - -T -"])
+        script = "{} | tar -xzf - -C {}".format(
+            " ".join(quote(arg) for arg in ssh_command), quote(self.directory)
+        )
+        names = "".join(path + "\n" for path in paths)
+        self.runner.check_call(["bash", "-o", "pipefail", "-c", script],
+                               input=names.encode("utf-8"))
+
+    def _copy(self, changed_only: bool) -> List[str]:
+        entries = self._list(changed_only)
+        missing = []
+        for path, size, mtime, is_file in entries:
+            local_path = os.path.join(self.directory, path)
+            if not (
+                is_file and self.cache is not None
+                and self.cache.restore(path, size, mtime, local_path)
+            ):
+                missing.append(path)
+        if missing:
+            self._fetch(missing)
+        if self.cache is not None:
+            self.runner.write(
+                "{} of {} volume files found in cache".format(
+                    len(entries) - len(missing), len(entries)
+                )
+            )
+            fetched = set(missing)
+            for path, size, mtime, is_file in entries:
+                if is_file and path in fetched:
+                    self.cache.store(
+                        path, size, mtime, os.path.join(self.directory, path)
+                    )
+            self.cache.evict()
+        return [entry[0] for entry in entries]
+
+    def sync(self) -> List[str]:
+        """Copy all the volumes, return the paths copied."""
+        return self._copy(False)
+
+    def resync(self) -> List[str]:
+        """Copy the files that changed since the last sync, return them."""
+        return self._copy(True)
+
+    def start(self, interval: float) -> None:
+        """Resync every interval seconds in a background thread."""
+
+        def loop():
+            while not self.stopped.wait(interval):
+                try:
+                    changed = self.resync()
+                except (CalledProcessError, OSError, ValueError) as e:
+                    self.runner.write("Failed to resync volumes: {}".format(e))
+                else:
+                    if changed:
+                        self.runner.write("Resynced {}".format(changed))
+
+        thread = Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def snapshot_volumes(
+    runner: Runner, remote_info: RemoteInfo, ssh: SSH, directory: str,
+    resync_interval: int, cache_megabytes: int
+) -> Tuple[bool, Callable]:
+    """
+    Copy the container's volumes into directory.
+
+    Unless cache_megabytes is 0, files are also kept in a ContentCache of
+    that size for later sessions.
+
+    Returns (whether copying succeeded, callable that deletes the copy).
+    """
+    start = time()
+    cache = None
+    if cache_megabytes:
+        cache = ContentCache(cache_megabytes * 2**20)
+    try:
+        snapshot = VolumeSnapshot(
+            runner, ssh, get_volume_mount_paths(runner, remote_info),
+            directory, cache
+        )
+        snapshot.sync()
+    except (CalledProcessError, ValueError):
+        print(
+            "Copying remote volumes failed, they will be unavailable in this"
+            " session. Please report a bug, attaching telepresence.log to"
+            " the bug report:"
+            " https://github.com/datawire/telepresence/issues/new",
+            file=sys.stderr
+        )
+        return False, lambda: rmtree(directory, ignore_errors=True)
+    runner.write("Copied volumes in {:.1f} seconds".format(time() - start))
+    if resync_interval:
+        snapshot.start(resync_interval)
+
+    def cleanup():
+        snapshot.stop()
+        rmtree(directory, ignore_errors=True)
+
+    return True, cleanup
+
+
+def sshfs_volumes(
+    runner: Runner, remote_info: RemoteInfo, ssh: SSH, directory: str,
+    allow_all_users: bool, profile: str, volume_mode: str
+) -> Tuple[bool, Callable]:
+    """
+    Mount the container's filesystem, or with volume_mode "declared" just its
+    volumes, into directory using sshfs.
+
+    Returns (whether mounting succeeded, callable that will unmount).
     """
-    # Docker for Mac only shares some folders; the default TMPDIR on OS X is
-    # not one of them, so make sure we use /tmp:
-    mount_dir = mkdtemp(dir="/tmp")
     sudo_prefix = ["sudo"] if allow_all_users else []
     middle = ["-o", "allow_other"] if allow_all_users else []
+    ssh_options = []
+    for option in ssh.options() + MOUNT_PROFILES[profile]:
+        ssh_options += ["-o", option]
+    mounted = []  # type: List[str]
+    succeeded = True
     try:
-        runner.check_call(
-            sudo_prefix + [
-                "sshfs",
-                "-p",
-                str(ssh.port),
-                # Don't load config file so it doesn't break us:
-                "-F",
-                "/dev/null",
-                # Don't validate host key:
-                "-o",
-                "StrictHostKeyChecking=no",
-                # Don't store host key:
-                "-o",
-                "UserKnownHostsFile=/dev/null",
-            ] + middle + ["telepresence@localhost:/", mount_dir]
-        )
-        mounted = True
+        if volume_mode == "declared":
+            paths = get_volume_mount_paths(runner, remote_info)
+            directories = get_remote_directories(runner, ssh, paths)
+            runner.write("Mounting volumes at {}".format(paths))
+        else:
+            paths = directories = ["/"]
+        for path in paths:
+            local_path = os.path.join(directory, path.lstrip("/"))
+            if path not in directories:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                runner.check_call([
+                    "scp", "-q", "-P",
+                    str(ssh.port), "-F", "/dev/null"
+                ] + ["-o" + option for option in ssh.options()] + [
+                    "telepresence@{}:{}".format(ssh.host, path), local_path
+                ])
+                continue
+            os.makedirs(local_path, exist_ok=True)
+            runner.check_call(
+                sudo_prefix + [
+                    "sshfs",
+                    "-p",
+                    str(ssh.port),
+                    # Don't load config file so it doesn't break us:
+                    "-F",
+                    "/dev/null",
+                ] + ssh_options + [
+                    # Survive the port-forward being reconnected:
+                    "-o",
+                    "reconnect",
+                    "-o",
+                    "ServerAliveInterval=1",
+                    "-o",
+                    "ServerAliveCountMax=10",
+                ] + middle +
+                ["telepresence@{}:{}".format(ssh.host, path), local_path]
+            )
+            mounted.append(local_path)
     except CalledProcessError:
+        succeeded = False
         print(
             "Mounting remote volumes failed, they will be unavailable"
             " in this session. If you are running"
@@ -260,17 +676,115 @@ def mount_remote_volumes(
             " https://github.com/datawire/telepresence/issues/new",
             file=sys.stderr
         )
-        mounted = False
-
-    def no_cleanup():
-        pass
 
     def cleanup():
-        if sys.platform.startswith("linux"):
-            runner.check_call(
-                sudo_prefix + ["fusermount", "-z", "-u", mount_dir]
+        for local_path in reversed(mounted):
+            if sys.platform.startswith("linux"):
+                runner.check_call(
+                    sudo_prefix + ["fusermount", "-z", "-u", local_path]
+                )
+            else:
+                runner.get_output(sudo_prefix + ["umount", "-f", local_path])
+
+    return succeeded, cleanup
+
+
+def wait_for_volumes(ready_marker: str, timeout: float = 300) -> bool:
+    """
+    Wait for mount_remote_volumes() to finish, returning whether the volumes
+    are available.
+    """
+    start = time()
+    delay = 0.05
+    while time() - start < timeout:
+        if os.path.exists(ready_marker):
+            with open(ready_marker) as f:
+                return f.read().strip() == "ok"
+        sleep(delay)
+        delay = min(delay * 2, 0.5)
+    return False
+
+
+def mount_remote_volumes(
+    runner: Runner,
+    remote_info: RemoteInfo,
+    ssh: SSH,
+    allow_all_users: bool,
+    profile: str = "default",
+    volume_mode: str = "all",
+    resync_interval: int = 0,
+    cache_megabytes: int = 0,
+) -> Tuple[str, str, Callable]:
+    """
+    Make the remote container's filesystem available locally, in the
+    background so that connecting to sshfs or copying files doesn't delay
+    starting the user's process.
+
+    Allowing all users may require root, so we use sudo in that case. The
+    profile is one of MOUNT_PROFILES.
+
+    With volume_mode "all" the container's whole filesystem is mounted. With
+    "declared" only the container's volume mounts are, each with its own
+    sshfs at the same path under the mount directory; mounts that are single
+    files get copied instead. With "snapshot" the volumes are copied once
+    instead of mounted, and resynced every resync_interval seconds if that's
+    not 0, using a cache of cache_megabytes that persists across sessions.
+
+    The ready marker is a file, outside the mount directory since a mount
+    would hide it, that gets created once mounting finishes. It contains "ok"
+    if the volumes are available and "failed" otherwise; wait_for_volumes()
+    waits for it.
+
+    Returns (path to mounted directory, path to ready marker, callable that
+    will unmount it).
+    """
+    # Docker for Mac only shares some folders; the default TMPDIR on OS X is
+    # not one of them, so make sure we use /tmp:
+    mount_dir = mkdtemp(dir="/tmp")
+    ready_marker = os.path.join(mkdtemp(), "ready")
+    cleanups = []  # type: List[Callable]
+
+    def mount():
+        start = time()
+        succeeded = False
+        try:
+            if volume_mode == "snapshot":
+                succeeded, cleanup = snapshot_volumes(
+                    runner, remote_info, ssh, mount_dir, resync_interval,
+                    cache_megabytes
+                )
+            else:
+                succeeded, cleanup = sshfs_volumes(
+                    runner, remote_info, ssh, mount_dir, allow_all_users,
+                    profile, volume_mode
+                )
+            cleanups.append(cleanup)
+        except Exception as e:
+            # Nothing else will notice an exception in this thread:
+            print(
+                "Making remote volumes available failed: {}".format(e),
+                file=sys.stderr
             )
-        else:
-            runner.get_output(sudo_prefix + ["umount", "-f", mount_dir])
+        finally:
+            runner.write(
+                "Volumes available after {:.1f} seconds: {}".format(
+                    time() - start, succeeded
+                )
+            )
+            # Write then rename, so readers never see a partial marker:
+            with open(ready_marker + ".tmp", "w") as f:
+                f.write("ok\n" if succeeded else "failed\n")
+            os.rename(ready_marker + ".tmp", ready_marker)
+
+    thread = Thread(target=mount)
+    thread.daemon = True
+    thread.start()
+
+    def cleanup():
+        # Don't leave behind mounts that finish after we're asked to unmount:
+        thread.join()
+        for unmount in cleanups:
+            unmount()
+        rmtree(os.path.dirname(ready_marker), ignore_errors=True)
 
-    return mount_dir, cleanup if mounted else no_cleanup
+    return mount_dir, ready_marker, cleanup
@@ -1,4 +1,5 @@
 import sys
+from itertools import count
 from subprocess import Popen, PIPE, STDOUT, DEVNULL, CalledProcessError, \
     check_output
 from time import time, ctime
@@ -21,7 +22,9 @@ class Runner(object):
         self.kubectl_cmd = kubectl_cmd
         self.verbose = verbose
         self.start_time = time()
-        self.counter = 0
+        # Commands may be run from several threads; next() on a count is
+        # atomic, unlike incrementing an int:
+        self.counter = count(1)
         self.write("Telepresence launched at {}".format(ctime()))
         self.write("  {}".format(sys.argv))
 
@@ -72,7 +75,7 @@ class Runner(object):
 
     def check_call(self, *args, **kwargs):
         """Run a subprocess, make sure it exited with 0."""
-        self.counter = track = self.counter + 1
+        track = next(self.counter)
         self.write("[{}] Running: {}... ".format(track, args))
         if "input" not in kwargs and "stdin" not in kwargs:
             kwargs["stdin"] = DEVNULL
@@ -88,7 +91,7 @@ class Runner(object):
         """Return (stripped) command result as unicode string."""
         if stderr is None:
             stderr = self.logfile
-        self.counter = track = self.counter + 1
+        track = next(self.counter)
         self.write("[{}] Capturing: {}...".format(track, args))
         kwargs["stdin"] = DEVNULL
         kwargs["stderr"] = stderr
@@ -98,7 +101,7 @@ class Runner(object):
 
     def popen(self, *args, stdin=DEVNULL, **kwargs) -> Popen:
         """Return Popen object."""
-        self.counter = track = self.counter + 1
+        track = next(self.counter)
         self.write("[{}] Launching: {}...".format(track, args))
         kwargs["stdin"] = stdin
         return self.launch_command(track, *args, **kwargs)
@@ -1,19 +1,54 @@
+import atexit
+from shutil import rmtree
 from subprocess import Popen, CalledProcessError
+from tempfile import mkdtemp
 from time import time, sleep
-from typing import List
+from typing import List, Optional, Tuple
 
+import os
+
+from telepresence.cleanup import RestartPolicy
 from telepresence.runner import Runner
 
 
 class SSH(object):
-    """Run ssh to k8s-proxy with appropriate arguments."""
+    """
+    Run ssh to k8s-proxy with appropriate arguments.
+
+    :ivar connection_policy RestartPolicy: Policy of the process (e.g. kubectl
+        port-forward) that makes the SSH server reachable, if any. Long-running
+        SSH sessions should depend on it so they're reconnected along with it.
+    :ivar identity str: Path to private key file, if the server requires key
+        authentication (the direct SSH endpoint does).
+    """
 
     def __init__(
-        self, runner: Runner, port: int, host: str = "localhost"
+        self,
+        runner: Runner,
+        port: int,
+        host: str = "localhost",
+        identity: Optional[str] = None,
     ) -> None:
         self.runner = runner
         self.port = port
         self.host = host
+        self.identity = identity
+        self.connection_policy = None  # type: Optional[RestartPolicy]
+
+    def options(self) -> List[str]:
+        """
+        Return the ssh -o options needed to connect, for use by programs that
+        run ssh themselves (sshfs, sshuttle).
+        """
+        result = [
+            # Don't validate host key:
+            "StrictHostKeyChecking=no",
+            # Don't store host key:
+            "UserKnownHostsFile=/dev/null",
+        ]
+        if self.identity is not None:
+            result += ["IdentityFile=" + self.identity, "IdentitiesOnly=yes"]
+        return result
 
     def command(
         self, additional_args: List[str], prepend_arguments: List[str] = []
@@ -30,10 +65,7 @@ class SSH(object):
             "/dev/null",
             # SSH with no warnings:
             "-vv" if self.runner.verbose else "-q",
-            # Don't validate host key:
-            "-oStrictHostKeyChecking=no",
-            # Don't store host key:
-            "-oUserKnownHostsFile=/dev/null",
+        ] + ["-o" + option for option in self.options()] + [
             "-p",
             str(self.port),
             "telepresence@" + self.host,
@@ -58,10 +90,20 @@ class SSH(object):
             )
         )
 
-    def wait(self) -> None:
+    def tunnel_policy(self, name: str,
+                      additional_args: List[str]) -> RestartPolicy:
+        """
+        Return a RestartPolicy for a popen() with the given arguments, which
+        is reconnected along with the SSH server's connection.
+        """
+        return RestartPolicy(
+            self.runner, name, lambda: self.popen(additional_args), True
+        ).depends_on(self.connection_policy)
+
+    def wait(self, timeout: float = 30) -> None:
         """Return when SSH server can be reached."""
         start = time()
-        while time() - start < 30:
+        while time() - start < timeout:
             try:
                 self.runner.check_call(self.command(["/bin/true"]))
             except CalledProcessError:
@@ -69,3 +111,19 @@ class SSH(object):
             else:
                 return
         raise RuntimeError("SSH isn't starting.")
+
+
+def generate_key(runner: Runner) -> Tuple[str, str]:
+    """
+    Generate a throwaway SSH key pair, deleted on exit.
+
+    Returns (path to private key file, public key).
+    """
+    key_dir = mkdtemp()
+    atexit.register(rmtree, key_dir, True)
+    path = os.path.join(key_dir, "id_ed25519")
+    runner.check_call([
+        "ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", path
+    ])
+    with open(path + ".pub") as f:
+        return path, f.read().strip()
@@ -0,0 +1,150 @@
+import argparse
+import atexit
+import getpass
+import ipaddress
+import socket
+from subprocess import Popen
+from typing import Dict, List, Union
+
+import os
+
+from telepresence.cleanup import Subprocesses
+from telepresence.dns import RemoteDomains, SplitDomains, StubResolver, \
+    redirect_dns, wait_for_proxy_dns
+from telepresence.remote import RemoteInfo
+from telepresence.runner import Runner
+from telepresence.ssh import SSH
+from telepresence.utilities import get_resolv_conf_namservers, \
+    get_resolv_conf_search
+from telepresence.vpn import RouteUpdater, get_namespaces, get_proxy_cidrs
+
+# Addresses of the two ends of the tunnel. k8s-proxy/run.sh sets up the
+# remote end with the same addresses.
+LOCAL_TUN_IP = "198.18.1.1"
+REMOTE_TUN_IP = "198.18.1.2"
+
+
+def free_tun_device() -> int:
+    """Return the lowest N such that there's no tunN network interface."""
+    index = 0
+    while os.path.exists("/sys/class/net/tun{}".format(index)):
+        index += 1
+    return index
+
+
+def tun_ssh_args(index: int) -> List[str]:
+    """
+    Return ssh arguments that forward IP packets between local device tunN
+    and the proxy's tun0.
+    """
+    return [
+        "-oTunnel=point-to-point",
+        # Give up, and so get restarted, if the tunnel can't be opened:
+        "-oExitOnForwardFailure=yes",
+        "-w",
+        "{}:0".format(index),
+    ]
+
+
+def route_commands(device: str, cidrs: List[str]) -> List[List[str]]:
+    """Return the commands that route the given CIDRs via device."""
+    return [["ip", "route", "add", cidr, "dev", device] for cidr in cidrs]
+
+
+def create_tun_device(runner: Runner, index: int) -> str:
+    """
+    Create and configure the local end of the tunnel, owned by us so ssh
+    doesn't need root, and deleted on exit (along with its routes).
+    """
+    device = "tun{}".format(index)
+    runner.check_call([
+        "sudo", "ip", "tuntap", "add", "dev", device, "mode", "tun", "user",
+        getpass.getuser()
+    ])
+    atexit.register(
+        runner.check_call, ["sudo", "ip", "link", "delete", device]
+    )
+    runner.check_call([
+        "sudo", "ip", "addr", "add", LOCAL_TUN_IP, "peer", REMOTE_TUN_IP,
+        "dev", device
+    ])
+    runner.check_call(["sudo", "ip", "link", "set", device, "up"])
+    return device
+
+
+def keep_direct_route(runner: Runner, host: str, cidrs: List[str]) -> None:
+    """
+    Make sure the SSH connection to host, with --direct-ssh, doesn't get
+    routed through the tunnel it carries.
+    """
+    ip = socket.gethostbyname(host)
+    address = ipaddress.ip_address(ip)
+    if not any(address in ipaddress.ip_network(cidr) for cidr in cidrs):
+        return
+    route = runner.get_output(["ip", "-o", "route", "get", ip]).split()
+    command = ["ip", "route", "add", ip + "/32"]
+    for keyword in ("via", "dev"):
+        if keyword in route:
+            command += [keyword, route[route.index(keyword) + 1]]
+    runner.check_call(["sudo"] + command)
+    atexit.register(
+        runner.check_call, ["sudo", "ip", "route", "delete", ip + "/32"]
+    )
+
+
+def connect_tun(
+    runner: Runner, remote_info: RemoteInfo, args: argparse.Namespace,
+    subprocesses: Subprocesses, env: Dict[str, str], ssh: SSH
+):
+    """
+    Connect to Kubernetes by routing IP packets through a TUN device to the
+    proxy pod, over a single SSH connection.
+
+    Unlike sshuttle, nothing on this machine handles individual connections;
+    the kernel hands packets to ssh and the proxy pod's kernel forwards them.
+    """
+    # Make sure we have sudo credentials in advance:
+    Popen(["sudo", "true"]).wait()
+    cidrs = get_proxy_cidrs(
+        runner, args, remote_info, env["KUBERNETES_SERVICE_HOST"]
+    )
+    index = free_tun_device()
+    device = create_tun_device(runner, index)
+    if ssh.host != "localhost":
+        keep_direct_route(runner, ssh.host, cidrs)
+    for command in route_commands(device, cidrs):
+        runner.check_call(["sudo"] + command)
+
+    tunnel_args = tun_ssh_args(index)
+    subprocesses.append(
+        ssh.popen(tunnel_args),
+        policy=ssh.tunnel_policy("TUN tunnel", tunnel_args),
+    )
+
+    # The proxy's DNS server is reachable through the tunnel, so a local
+    # stub can send queries there directly:
+    Union  # Avoid Pyflakes F401
+    domains = RemoteDomains()  # type: Union[SplitDomains, RemoteDomains]
+    if args.split_dns:
+        domains = SplitDomains(
+            get_namespaces(runner, args), get_resolv_conf_search()
+        )
+    stub = StubResolver(
+        runner, domains, (REMOTE_TUN_IP, 9053),
+        (get_resolv_conf_namservers()[0], 53), args.dns_cache
+    )
+    stub.start()
+    redirect_dns(runner, subprocesses, stub)
+
+    def add_routes(new_cidrs):
+        # We're in the background and mustn't prompt for a password:
+        for command in route_commands(device, new_cidrs):
+            runner.check_call(["sudo", "-n"] + command)
+
+    if args.route_update_interval:
+        RouteUpdater(runner, args, remote_info, cidrs, add_routes).start()
+
+    # Detect the tunnel being up when DNS queries start reaching the proxy,
+    # which will also tell it which search suffix to filter out:
+    if not wait_for_proxy_dns(20):
+        raise SystemExit("Failed to connect to proxy in remote cluster.")
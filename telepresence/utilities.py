@@ -1,6 +1,8 @@
 import socket
+import sys
+from subprocess import CalledProcessError, check_output
 from time import time
-from typing import List
+from typing import List, Optional
 
 import os
 
@@ -36,6 +38,18 @@ def get_resolv_conf_namservers() -> List[str]:
     return result
 
 
+def get_resolv_conf_search() -> List[str]:
+    """Return list of search domains in /etc/resolv.conf."""
+    result = []  # type: List[str]
+    with open("/etc/resolv.conf") as f:
+        for line in f:
+            parts = line.lower().split()
+            # The last search or domain line wins:
+            if len(parts) >= 2 and parts[0] in ("search", "domain"):
+                result = parts[1:]
+    return result
+
+
 def get_alternate_nameserver() -> str:
     """Get a public nameserver that isn't in /etc/resolv.conf."""
     banned = get_resolv_conf_namservers()
@@ -48,3 +62,42 @@ def get_alternate_nameserver() -> str:
         if nameserver not in banned:
             return nameserver
     raise RuntimeError("All known public nameservers are in /etc/resolv.conf.")
+
+
+def process_start_time(pid: int) -> Optional[str]:
+    """
+    Return an identifier of when a process started, which together with its
+    pid identifies it even across reboots, or None if it can't be found.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as f:
+                boot_id = f.read().strip()
+            with open("/proc/{}/stat".format(pid)) as f:
+                # The command name may contain spaces, but is in parentheses;
+                # the start time is the 22nd field:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return "{} {}".format(boot_id, fields[19])
+        except (OSError, IndexError):
+            return None
+    try:
+        return check_output(["ps", "-o", "lstart=", "-p",
+                             str(pid)]).decode("utf-8").strip() or None
+    except (OSError, CalledProcessError):
+        return None
+
+
+def is_running(pid: int, started: Optional[str] = None) -> bool:
+    """
+    Return whether a process is still running.
+
+    If started is given, the process must also have that
+    process_start_time(), since pids get reused, e.g. after a reboot.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return started is None or process_start_time(pid) == started
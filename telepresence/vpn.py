@@ -2,49 +2,421 @@ import argparse
 import ipaddress
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import CalledProcessError, Popen
-from time import time, sleep
-from typing import List, Dict
+from time import sleep
+from threading import Thread
+from typing import Callable, List, Dict, Optional, Set, Tuple, TypeVar, \
+    Union
 
+from telepresence.agent import AgentError
+from telepresence.cache import Cache
+from telepresence.dns import CLUSTER_NAMESERVER, RemoteDomains, \
+    SplitDomains, StubResolver, redirect_dns, wait_for_proxy_dns
 from telepresence.ssh import SSH
-from telepresence.cleanup import Subprocesses
+from telepresence.cleanup import Subprocesses, auxiliary, critical
 from telepresence.remote import RemoteInfo
-from telepresence.utilities import random_name
+from telepresence.utilities import get_resolv_conf_namservers, \
+    get_resolv_conf_search, random_name
 from telepresence.runner import Runner
 
 
-def covering_cidr(ips: List[str]) -> str:
+# Default limits for covering_cidrs(), see --max-service-prefixes and
+# --max-service-addresses: at most this many prefixes, unless that would mean
+# routing more than this many addresses:
+MAX_PREFIXES = 8
+MAX_ADDRESSES = 2**16
+
+
+# Either kind of network, but all the same kind:
+_Network = TypeVar("_Network", ipaddress.IPv4Network, ipaddress.IPv6Network)
+
+
+def _common_supernet(a: _Network, b: _Network) -> _Network:
+    """Return the smallest network containing both networks."""
+    result = a
+    while not (
+        result.network_address <= b.network_address
+        and b.broadcast_address <= result.broadcast_address
+    ):
+        result = result.supernet()
+    return result
+
+
+def _cheapest_merge(networks: List[_Network]) -> Tuple[int, _Network]:
     """
-    Given list of IPs, return CIDR that covers them all.
+    Given sorted, non-overlapping networks, find the merge of two neighbours
+    that covers the fewest extra addresses.
 
-    Presumes it's at least a /24.
+    Returns the number of extra addresses and the merged network, which may
+    swallow networks beyond the pair, too.
+    """
+    best = None
+    for i in range(len(networks) - 1):
+        merged = _common_supernet(networks[i], networks[i + 1])
+        # Networks inside the merged one are contiguous around the pair:
+        start, end = i, i + 2
+        while start > 0 and networks[start - 1].overlaps(merged):
+            start -= 1
+        while end < len(networks) and networks[end].overlaps(merged):
+            end += 1
+        added = merged.num_addresses - sum(
+            n.num_addresses for n in networks[start:end]
+        )
+        if best is None or added < best[0]:
+            best = (added, merged)
+    assert best is not None
+    return best
+
+
+def covering_cidrs(
+    ips: List[str],
+    max_prefixes: int = MAX_PREFIXES,
+    max_addresses: float = MAX_ADDRESSES
+) -> List[str]:
+    """
+    Given list of IPs, return a small list of CIDRs that covers them all.
+
+    Presumes each IP is in at least a /24. Neighbouring networks are merged,
+    cheapest merge first, until there are at most max_prefixes of them, but
+    never so that more than max_addresses are covered in total; the
+    address limit wins if the two conflict.
     """
 
     def collapse(ns):
-        return list(ipaddress.collapse_addresses(ns))
+        return sorted(ipaddress.collapse_addresses(ns))
 
     assert len(ips) > 0
     networks = collapse([
         ipaddress.IPv4Interface(ip + "/24").network for ip in ips
     ])
-    # Increase network size until it combines everything:
+    total = sum(n.num_addresses for n in networks)
+    while len(networks) > max_prefixes:
+        added, merged = _cheapest_merge(networks)
+        if total + added > max_addresses:
+            break
+        networks = collapse(networks + [merged])
+        total += added
+    return [n.with_prefixlen for n in networks]
+
+
+def _aggregate(networks: List[_Network],
+               waste: int) -> Tuple[List[_Network], int]:
+    """
+    Collapse and merge networks of one IP version for aggregate_cidrs().
+
+    Returns the merged networks and the waste budget that's left.
+    """
+    networks = sorted(ipaddress.collapse_addresses(networks))
     while len(networks) > 1:
-        networks = collapse([networks[0].supernet()] + networks[1:])
-    return networks[0].with_prefixlen
+        added, merged = _cheapest_merge(networks)
+        if added > waste:
+            break
+        networks = sorted(ipaddress.collapse_addresses(networks + [merged]))
+        waste -= added
+    return networks, waste
 
 
-# Script to dump resolved IPs to stdout as JSON list:
+def aggregate_cidrs(cidrs: List[str], waste: int = 0) -> List[str]:
+    """
+    Return the smallest equivalent list of CIDRs.
+
+    IPs become single-address networks, networks that are covered by others
+    are dropped and neighbouring networks are merged. Then, while there is
+    waste budget left, neighbours are merged into a larger network even if
+    that covers up to waste addresses that weren't in the original list.
+    """
+    # collapse_addresses() can't mix IPv4 and IPv6:
+    ipv4 = []  # type: List[ipaddress.IPv4Network]
+    ipv6 = []  # type: List[ipaddress.IPv6Network]
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        if isinstance(network, ipaddress.IPv4Network):
+            ipv4.append(network)
+        else:
+            ipv6.append(network)
+    ipv4, waste = _aggregate(ipv4, waste)
+    ipv6, waste = _aggregate(ipv6, waste)
+    return [n.with_prefixlen for n in ipv4] + [n.with_prefixlen for n in ipv6]
+
+
+def covering_cidr(ips: List[str]) -> str:
+    """
+    Given list of IPs, return CIDR that covers them all.
+
+    Presumes it's at least a /24.
+    """
+    return covering_cidrs(ips, 1, float("inf"))[0]
+
+
+def service_cidrs(
+    ips: List[str],
+    max_prefixes: int = MAX_PREFIXES,
+    max_addresses: int = MAX_ADDRESSES
+) -> List[str]:
+    """
+    Guess the Service IP range from a sample of Service IPs.
+
+    The single network covering them all is the best guess, since it's likely
+    to include Services created later, so that's used if it covers at most
+    max_addresses. Otherwise the IPs are covered by a few smaller networks.
+    """
+    single = covering_cidr(ips)
+    if ipaddress.ip_network(single).num_addresses <= max_addresses:
+        return [single]
+    return covering_cidrs(ips, max_prefixes, max_addresses)
+
+
+# Script to resolve hostnames concurrently and dump all their IPv4 addresses
+# to stdout as a JSON object mapping hostname to list of IPs, or to null if
+# resolution failed:
 
 _GET_IPS_PY = """
 import socket, sys, json
+from concurrent.futures import ThreadPoolExecutor
 
-result = []
-for host in sys.argv[1:]:
-    result.append(socket.gethostbyname(host))
+def resolve(host):
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET)
+    except socket.error:
+        return None
+    return sorted(set(info[4][0] for info in infos))
+
+hosts = sys.argv[1:]
+with ThreadPoolExecutor(max_workers=16) as pool:
+    result = dict(zip(hosts, pool.map(resolve, hosts)))
 sys.stdout.write(json.dumps(result))
 sys.stdout.flush()
 """
 
+# How long resolved --also-proxy hostnames are reused for, in seconds:
+HOSTNAME_CACHE_TTL = 10 * 60
+
+
+def _hostname_cache() -> Cache:
+    return Cache("also-proxy")
+
+
+def resolve_in_cluster(
+    runner: Runner, args: argparse.Namespace, remote_info: RemoteInfo,
+    hostnames: List[str]
+) -> Dict[str, List[str]]:
+    """
+    Resolve hostnames inside the proxy pod, so we get cloud-local IP addresses
+    for cloud resources.
+
+    Returns all IPv4 addresses for each hostname. Recent results are reused,
+    and the rest are looked up with a single request to the agent in the pod,
+    or a kubectl exec if the pod has no agent.
+    """
+    cache = _hostname_cache()
+
+    def key(hostname: str) -> str:
+        # Short names resolve according to the namespace's search domains:
+        return "{} {} {} {}".format(
+            args.context, args.cluster_server, args.namespace, hostname
+        )
+
+    result = {}  # type: Dict[str, List[str]]
+    for hostname in hostnames:
+        cached = cache.get(key(hostname), HOSTNAME_CACHE_TTL)
+        if cached:
+            result[hostname] = cached
+    missing = [h for h in hostnames if h not in result]
+    if not missing:
+        return result
+
+    resolved = None  # type: Optional[Dict[str, Optional[List[str]]]]
+    if remote_info.agent is not None:
+        try:
+            resolved = remote_info.agent.resolve(missing)
+        except AgentError as e:
+            runner.write("Agent failed to resolve {}: {}".format(missing, e))
+    if resolved is None:
+        resolved = json.loads(
+            runner.get_kubectl(
+                args.context, args.namespace, [
+                    "exec", "--container=" + remote_info.container_name,
+                    remote_info.pod_name, "--", "python3", "-c", _GET_IPS_PY
+                ] + missing
+            )
+        )
+    failed = [h for h in missing if not resolved.get(h)]
+    found = {h: ips for (h, ips) in resolved.items() if ips}
+    if failed:
+        raise SystemExit(
+            "We failed to do a DNS lookup inside Kubernetes for the "
+            "hostname(s) you listed in "
+            "--also-proxy ({}). Maybe you mistyped one of them?".format(
+                ", ".join(failed)
+            )
+        )
+    for hostname in missing:
+        result[hostname] = found[hostname]
+        cache.set(key(hostname), found[hostname])
+    return result
+
+
+def split_also_proxy(also_proxy: List[str]) -> Tuple[List[str], List[str]]:
+    """Separate --also-proxy hostnames from IPs and IP ranges."""
+    hostnames = []
+    ip_ranges = []
+    for proxy_target in also_proxy:
+        try:
+            addr = ipaddress.ip_network(proxy_target)
+        except ValueError:
+            hostnames.append(proxy_target)
+        else:
+            ip_ranges.append(str(addr))
+    return hostnames, ip_ranges
+
+
+def get_cluster_cidrs(
+    runner: Runner,
+    max_prefixes: int = MAX_PREFIXES,
+    max_addresses: int = MAX_ADDRESSES
+) -> Tuple[List[str], List[str]]:
+    """
+    Discover the IP ranges used by the cluster.
+
+    Returns a list of pod CIDRs and a list of (guessed) Service CIDRs, whose
+    size is limited by max_prefixes and max_addresses. This takes a number of
+    kubectl calls, and may create and delete some Services.
+    """
+    Set  # Avoid Pyflakes F401
+    pod_cidrs = set()  # type: Set[str]
+
+    def get_items(kind):
+        return json.loads(
+            runner.get_output([runner.kubectl_cmd, "get", kind, "-o", "json"])
+        )["items"]
+
+    # FIXME: Add test(s) here so we don't crash on, e.g., ExternalName
+    def get_service_ips(services):
+        return [
+            svc["spec"]["clusterIP"] for svc in services
+            if svc["spec"].get("clusterIP", "None") != "None"
+        ]
+
+    # None of these kubectl calls depend on each other, so run them
+    # concurrently:
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        nodes = pool.submit(get_items, "nodes")
+        services = pool.submit(get_items, "services")
+
+        # Get pod IPs from nodes if possible, otherwise use pod IPs as
+        # heuristic:
+        try:
+            for node in nodes.result():
+                pod_cidr = node["spec"].get("podCIDR")
+                if pod_cidr is not None:
+                    pod_cidrs.add(pod_cidr)
+        except CalledProcessError as e:
+            runner.write("Failed to get nodes: {}".format(e))
+            # Fallback to using pod IPs:
+            pod_ips = []
+            for pod in get_items("pods"):
+                try:
+                    pod_ips.append(pod["status"]["podIP"])
+                except KeyError:
+                    # Apparently a problem on OpenShift
+                    pass
+            if pod_ips:
+                pod_cidrs.update(
+                    covering_cidrs(pod_ips, max_prefixes, max_addresses)
+                )
+
+        # Add service IP range, based on heuristic of constructing CIDR from
+        # existing Service IPs. We create more services if there are less
+        # than 8, to ensure some coverage of the IP range:
+        service_ips = get_service_ips(services.result())
+        new_services = [
+            "{}-{}".format(random_name(), i)
+            for i in range(max(0, 8 - len(service_ips)))
+        ]
+
+        def create_service(name):
+            runner.check_call([
+                runner.kubectl_cmd, "create", "service", "clusterip", name,
+                "--tcp=3000"
+            ])
+
+        def delete_service(name):
+            runner.check_call([
+                runner.kubectl_cmd, "delete", "service", name
+            ])
+
+        if new_services:
+            list(pool.map(create_service, new_services))
+            service_ips = get_service_ips(get_items("services"))
+            list(pool.map(delete_service, new_services))
+
+    return sorted(pod_cidrs), service_cidrs(
+        service_ips, max_prefixes, max_addresses
+    )
+
+
+# How long discovered cluster IP ranges are reused for, in seconds:
+CIDR_CACHE_TTL = 24 * 60 * 60
+# How long cached pod ranges are reused for if we can't check them against the
+# nodes' pod ranges:
+UNCHECKED_POD_CIDR_TTL = 10 * 60
+
+
+def _cidr_cache() -> Cache:
+    return Cache("cidrs")
+
+
+def _in_cidrs(ip: str, cidrs: List[str]) -> bool:
+    """Return whether the IP is inside one of the CIDRs."""
+    try:
+        return any(
+            ipaddress.ip_address(ip) in ipaddress.ip_network(cidr)
+            for cidr in cidrs
+        )
+    except ValueError:
+        return False
+
+
+def get_node_pod_cidrs(runner: Runner) -> List[str]:
+    """
+    Return the nodes' pod CIDRs, or an empty list if nodes can't be listed or
+    don't say. Much cheaper than get_cluster_cidrs().
+    """
+    try:
+        output = runner.get_output([
+            runner.kubectl_cmd, "get", "nodes", "-o",
+            "jsonpath={.items[*].spec.podCIDR}"
+        ])
+    except CalledProcessError as e:
+        runner.write("Failed to get nodes: {}".format(e))
+        return []
+    return output.split()
+
+
+def _pod_cidrs_current(
+    runner: Runner, pod_cidrs: List[str], recent: bool
+) -> bool:
+    """
+    Return whether cached pod CIDRs cover every node's pod range, i.e. no
+    nodes with new ranges were added since, e.g. by an autoscaler.
+
+    If the nodes' ranges aren't available they're only trusted if recent.
+    """
+    node_cidrs = get_node_pod_cidrs(runner)
+    if not node_cidrs:
+        return recent
+    try:
+        cached = [ipaddress.ip_network(cidr) for cidr in pod_cidrs]
+        return all(
+            any(
+                node.network_address in network
+                and node.broadcast_address in network for network in cached
+            ) for node in map(ipaddress.ip_network, node_cidrs)
+        )
+    except ValueError:
+        return False
+
 
 def get_proxy_cidrs(
     runner: Runner, args: argparse.Namespace, remote_info: RemoteInfo,
@@ -62,123 +434,240 @@ def get_proxy_cidrs(
     long-term solution for service CIDR.
     """
 
-    # Run script to convert --also-proxy hostnames to IPs, doing name
-    # resolution inside Kubernetes, so we get cloud-local IP addresses for
-    # cloud resources:
+    # Convert --also-proxy hostnames to IPs, doing name resolution inside
+    # Kubernetes:
     def resolve_ips():
-        # Separate hostnames from IPs and IP ranges
-        hostnames = []
-        ip_ranges = []
+        hostnames, ip_ranges = split_also_proxy(args.also_proxy)
+        resolved_ips = []
+        for ips in resolve_in_cluster(runner, args, remote_info,
+                                      hostnames).values():
+            resolved_ips += ips
+        return resolved_ips + ip_ranges
 
-        for proxy_target in args.also_proxy:
-            try:
-                addr = ipaddress.ip_network(proxy_target)
-            except ValueError:
-                pass
-            else:
-                ip_ranges.append(str(addr))
-                continue
+    # Resolve --also-proxy in the background while we look at the cluster:
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        resolved = pool.submit(resolve_ips)
 
-            hostnames.append(proxy_target)
+        # Different limits give different ranges:
+        cache_key = "{} {} {} {}".format(
+            args.context, args.cluster_server, args.max_service_prefixes,
+            args.max_service_addresses
+        )
+        cached = _cidr_cache().get(cache_key, CIDR_CACHE_TTL)
+        if cached is not None and _in_cidrs(
+            service_address, cached.get("service_cidrs", [])
+        ) and _pod_cidrs_current(
+            runner, cached.get("pod_cidrs", []),
+            _cidr_cache().get(cache_key, UNCHECKED_POD_CIDR_TTL) is not None
+        ):
+            runner.write("Using cached cluster IP ranges: {}".format(cached))
+            pod_cidrs = cached["pod_cidrs"]
+            guessed_cidrs = cached["service_cidrs"]
+        else:
+            pod_cidrs, guessed_cidrs = get_cluster_cidrs(
+                runner, args.max_service_prefixes, args.max_service_addresses
+            )
+            _cidr_cache().set(
+                cache_key, {
+                    "pod_cidrs": pod_cidrs,
+                    "service_cidrs": guessed_cidrs
+                }
+            )
 
-        resolved_ips = json.loads(
-            runner.get_kubectl(
-                args.context, args.namespace, [
-                    "exec", "--container=" + remote_info.container_name,
-                    remote_info.pod_name, "--", "python3", "-c", _GET_IPS_PY
-                ] + hostnames
+        try:
+            result = set(resolved.result())
+        except CalledProcessError as e:
+            runner.write(str(e))
+            raise SystemExit(
+                "We failed to do a DNS lookup inside Kubernetes for the "
+                "hostname(s) you listed in "
+                "--also-proxy ({}). Maybe you mistyped one of them?".format(
+                    ", ".join(args.also_proxy)
+                )
             )
+
+    result.update(pod_cidrs)
+    result.update(guessed_cidrs)
+    aggregated = aggregate_cidrs(list(result), args.route_waste)
+    runner.write(
+        "Routing {} CIDRs as {}: {}".format(
+            len(result), len(aggregated), aggregated
         )
-        return resolved_ips + ip_ranges
+    )
 
-    try:
-        result = set(resolve_ips())
-    except CalledProcessError as e:
-        runner.write(str(e))
-        raise SystemExit(
-            "We failed to do a DNS lookup inside Kubernetes for the "
-            "hostname(s) you listed in "
-            "--also-proxy ({}). Maybe you mistyped one of them?".format(
-                ", ".join(args.also_proxy)
+    if sys.stderr.isatty():
+        if args.route_update_interval:
+            print(
+                "Guessing that Services IP range is {}. Services started"
+                " after this point outside this range will be routed within"
+                " {} seconds.\n".format(
+                    ", ".join(guessed_cidrs), args.route_update_interval
+                ),
+                file=sys.stderr
+            )
+        else:
+            print(
+                "Guessing that Services IP range is {}. Services started"
+                " after this point will be inaccessible if are outside this"
+                " range; delete {} and restart telepresence if you can't"
+                " access a new Service.\n".format(
+                    ", ".join(guessed_cidrs), _cidr_cache().path
+                ),
+                file=sys.stderr
             )
-        )
 
-    # Get pod IPs from nodes if possible, otherwise use pod IPs as heuristic:
+    return aggregated
+
+
+def get_namespaces(runner: Runner, args: argparse.Namespace) -> List[str]:
+    """Return names of the cluster's namespaces, as far as we can tell."""
     try:
-        nodes = json.loads(
-            runner.get_output([
-                runner.kubectl_cmd, "get", "nodes", "-o", "json"
-            ])
-        )["items"]
+        return runner.get_kubectl(
+            args.context, args.namespace,
+            ["get", "namespaces", "-o", "jsonpath={.items[*].metadata.name}"]
+        ).split()
     except CalledProcessError as e:
-        runner.write("Failed to get nodes: {}".format(e))
-        # Fallback to using pod IPs:
-        pods = json.loads(
-            runner.get_output([
-                runner.kubectl_cmd, "get", "pods", "-o", "json"
-            ])
-        )["items"]
-        pod_ips = []
-        for pod in pods:
+        runner.write("Failed to list namespaces: {}".format(e))
+        return [args.namespace, "default", "kube-system"]
+
+
+def start_sshuttle(
+    runner: Runner, subprocesses: Subprocesses, ssh: SSH, command: List[str]
+) -> None:
+    """Start sshuttle, and restart it if it exits."""
+    # sshuttle's SSH connection dies with the port-forward, so restart it
+    # along with it:
+    subprocesses.append(
+        runner.popen(command),
+        policy=critical(runner, "sshuttle", lambda: runner.popen(command)).
+        depends_on(ssh.connection_policy)
+    )
+
+
+class RouteUpdater(object):
+    """
+    Notice Service IPs and --also-proxy addresses that aren't routed to the
+    cluster, and route them too.
+
+    sshuttle can't change its routes once running, so new routes are handed
+    to a callable that typically restarts a second sshuttle that routes
+    everything added so far.
+    """
+
+    def __init__(
+        self,
+        runner: Runner,
+        args: argparse.Namespace,
+        remote_info: RemoteInfo,
+        routed: List[str],
+        add_routes: Callable[[List[str]], None],
+    ) -> None:
+        self.runner = runner
+        self.args = args
+        self.remote_info = remote_info
+        self.routed = [ipaddress.ip_network(cidr) for cidr in routed]
+        self.add_routes = add_routes
+
+    def start(self) -> None:
+        """Check for new addresses periodically in a background thread."""
+        thread = Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            sleep(self.args.route_update_interval)
             try:
-                pod_ips.append(pod["status"]["podIP"])
-            except KeyError:
-                # Apparently a problem on OpenShift
-                pass
-        if pod_ips:
-            result.add(covering_cidr(pod_ips))
-    else:
-        for node in nodes:
-            pod_cidr = node["spec"].get("podCIDR")
-            if pod_cidr is not None:
-                result.add(pod_cidr)
-
-    # Add service IP range, based on heuristic of constructing CIDR from
-    # existing Service IPs. We create more services if there are less than 8,
-    # to ensure some coverage of the IP range:
-    def get_service_ips():
-        services = json.loads(
-            runner.get_output([
-                runner.kubectl_cmd, "get", "services", "-o", "json"
-            ])
-        )["items"]
-        # FIXME: Add test(s) here so we don't crash on, e.g., ExternalName
+                self.update()
+            except (CalledProcessError, OSError, ValueError, SystemExit) as e:
+                self.runner.write("Failed to update routes: {}".format(e))
+
+    def _routed(self, ip: str) -> bool:
+        address = ipaddress.ip_address(ip)
+        return any(address in network for network in self.routed)
+
+    def get_service_ips(self) -> List[str]:
         return [
-            svc["spec"]["clusterIP"] for svc in services
-            if svc["spec"].get("clusterIP", "None") != "None"
+            ip for ip in self.runner.get_kubectl(
+                self.args.context, self.args.namespace, [
+                    "get", "services", "--all-namespaces", "-o",
+                    "jsonpath={.items[*].spec.clusterIP}"
+                ]
+            ).split() if ip != "None"
         ]
 
-    service_ips = get_service_ips()
-    new_services = []  # type: List[str]
-    # Ensure we have at least 8 ClusterIP Services:
-    while len(service_ips) + len(new_services) < 8:
-        new_service = random_name()
-        runner.check_call([
-            runner.kubectl_cmd, "create", "service", "clusterip", new_service,
-            "--tcp=3000"
-        ])
-        new_services.append(new_service)
-    if new_services:
-        service_ips = get_service_ips()
-    # Store Service CIDR:
-    service_cidr = covering_cidr(service_ips)
-    result.add(service_cidr)
-    # Delete new services:
-    for new_service in new_services:
-        runner.check_call([
-            runner.kubectl_cmd, "delete", "service", new_service
-        ])
+    def get_also_proxy_ips(self) -> List[str]:
+        # Cached results expire, so this re-resolves them periodically:
+        hostnames, _ = split_also_proxy(self.args.also_proxy)
+        result = []  # type: List[str]
+        for ips in resolve_in_cluster(
+            self.runner, self.args, self.remote_info, hostnames
+        ).values():
+            result += ips
+        return result
 
-    if sys.stderr.isatty():
-        print(
-            "Guessing that Services IP range is {}. Services started after"
-            " this point will be inaccessible if are outside this range;"
-            " restart telepresence if you can't access a "
-            "new Service.\n".format(service_cidr),
-            file=sys.stderr
-        )
+    def update(self) -> List[str]:
+        """Route any new addresses, and return the new CIDRs."""
+        service_ips = [
+            ip for ip in self.get_service_ips() if not self._routed(ip)
+        ]
+        also_proxy_ips = [
+            ip for ip in self.get_also_proxy_ips() if not self._routed(ip)
+        ]
+        cidrs = [ip + "/32" for ip in also_proxy_ips]
+        if service_ips:
+            # Cover the neighbourhood of new Service IPs, as on startup:
+            cidrs += covering_cidrs(
+                service_ips, self.args.max_service_prefixes,
+                self.args.max_service_addresses
+            )
+        if not cidrs:
+            return []
+        cidrs = aggregate_cidrs(cidrs, self.args.route_waste)
+        self.runner.write("Routing new addresses via {}".format(cidrs))
+        self.add_routes(cidrs)
+        self.routed += [ipaddress.ip_network(cidr) for cidr in cidrs]
+        return cidrs
 
-    return list(result)
+
+def sshuttle_command(
+    ssh: SSH,
+    cidrs: List[str],
+    dns: bool = True,
+    ns_hosts: Optional[List[str]] = None
+) -> List[str]:
+    """
+    Return command line to run sshuttle over the given SSH connection.
+
+    Only one sshuttle should handle DNS; others just add routes. By default
+    it captures queries to the nameservers in /etc/resolv.conf, or to
+    ns_hosts if given.
+    """
+    sshuttle_method = "auto"
+    if sys.platform.startswith("linux"):
+        # sshuttle tproxy mode seems to have issues:
+        sshuttle_method = "nat"
+    result = ["sshuttle-telepresence", "-v"]
+    if dns and ns_hosts:
+        result += ["--ns-hosts", ",".join(ns_hosts)]
+    elif dns:
+        result += ["--dns"]
+    result += [
+        "--method",
+        sshuttle_method,
+        "-e",
+        " ".join(["ssh", "-F", "/dev/null"] +
+                 ["-o" + option for option in ssh.options()]),
+    ]
+    if dns:
+        # DNS proxy running on remote pod:
+        result += ["--to-ns", "127.0.0.1:9053"]
+    result += ["-r", "telepresence@{}:{}".format(ssh.host, ssh.port)]
+    if ssh.host != "localhost":
+        # Direct connection to the cluster; make sure we don't try to route
+        # our own SSH connection through itself:
+        result += ["-x", ssh.host]
+    return result + cidrs
 
 
 def connect_sshuttle(
@@ -189,53 +678,56 @@ def connect_sshuttle(
     # Make sure we have sudo credentials by doing a small sudo in advance
     # of sshuttle using it:
     Popen(["sudo", "true"]).wait()
-    sshuttle_method = "auto"
-    if sys.platform.startswith("linux"):
-        # sshuttle tproxy mode seems to have issues:
-        sshuttle_method = "nat"
-    subprocesses.append(
-        runner.popen([
-            "sshuttle-telepresence",
-            "-v",
-            "--dns",
-            "--method",
-            sshuttle_method,
-            "-e",
-            (
-                "ssh -oStrictHostKeyChecking=no " +
-                "-oUserKnownHostsFile=/dev/null -F /dev/null"
-            ),
-            # DNS proxy running on remote pod:
-            "--to-ns",
-            "127.0.0.1:9053",
-            "-r",
-            "telepresence@localhost:" + str(ssh.port),
-        ] + get_proxy_cidrs(
-            runner, args, remote_info, env["KUBERNETES_SERVICE_HOST"]
-        ))
+    cidrs = get_proxy_cidrs(
+        runner, args, remote_info, env["KUBERNETES_SERVICE_HOST"]
     )
+    if args.split_dns or args.dns_cache:
+        # A local stub, which may cache answers, sends queries for cluster
+        # names (or all names, without --split-dns) to a fake nameserver that
+        # sshuttle captures:
+        Union  # Avoid Pyflakes F401
+        domains = RemoteDomains()  # type: Union[SplitDomains, RemoteDomains]
+        if args.split_dns:
+            domains = SplitDomains(
+                get_namespaces(runner, args), get_resolv_conf_search()
+            )
+        stub = StubResolver(
+            runner, domains, (CLUSTER_NAMESERVER, 53),
+            (get_resolv_conf_namservers()[0], 53), args.dns_cache
+        )
+        stub.start()
+        redirect_dns(runner, subprocesses, stub)
+        command = sshuttle_command(ssh, cidrs, ns_hosts=[CLUSTER_NAMESERVER])
+    else:
+        command = sshuttle_command(ssh, cidrs)
+    start_sshuttle(runner, subprocesses, ssh, command)
 
-    # sshuttle will take a while to startup. We can detect it being up when
-    # DNS resolution of services starts working. We use a specific single
-    # segment so any search/domain statements in resolv.conf are applied,
-    # which then allows the DNS proxy to detect the suffix domain and
-    # filter it out.
-    def get_hellotelepresence(counter=iter(range(10000))):
-        # On Macs, and perhaps elsewhere, there is OS-level caching of
-        # NXDOMAIN, so bypass caching by sending new domain each time. Another,
-        # less robust alternative, is to `killall -HUP mDNSResponder`.
-        runner.get_output([
-            "python3", "-c",
-            "import socket; socket.gethostbyname('hellotelepresence{}')".
-            format(next(counter))
-        ])
+    # Routes added during the session all go through a second sshuttle,
+    # which is restarted with the longer list each time:
+    added_cidrs = []  # type: List[str]
+    routes_policy = auxiliary(
+        runner, "sshuttle for new routes", lambda: runner.popen(
+            sshuttle_command(ssh, added_cidrs, dns=False)
+        )
+    ).depends_on(ssh.connection_policy)
 
-    start = time()
-    while time() - start < 20:
-        try:
-            get_hellotelepresence()
-            sleep(1)  # just in case there's more to startup
-            break
-        except CalledProcessError:
-            sleep(0.1)
-    get_hellotelepresence()
+    def add_routes(new_cidrs):
+        # sshuttle uses sudo, but we're in the background and mustn't prompt
+        # for a password:
+        if runner.popen(["sudo", "-n", "true"]).wait() != 0:
+            raise OSError(
+                "sudo needs a password, can't start sshuttle for new routes"
+            )
+        added_cidrs[:] = aggregate_cidrs(
+            added_cidrs + new_cidrs, args.route_waste
+        )
+        subprocesses.relaunch(routes_policy)
+
+    if args.route_update_interval:
+        RouteUpdater(runner, args, remote_info, cidrs, add_routes).start()
+
+    # sshuttle will take a while to startup. We can detect it being up when
+    # DNS queries start reaching the proxy, which will also tell it which
+    # search suffix to filter out:
+    if not wait_for_proxy_dns(20):
+        raise SystemExit("Failed to connect to proxy in remote cluster.")
@@ -2,19 +2,39 @@
 Unit tests (in-memory, small units of code).
 """
 
+import socket
+import subprocess
 import sys
 import tempfile
+import threading
+import time
+import argparse
 import ipaddress
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from hypothesis import strategies as st, given, example
+import pytest
 import yaml
 
+import telepresence.agent
+import telepresence.balancer
+import telepresence.cache
+import telepresence.cleanup
 import telepresence.cli
 import telepresence.container
 import telepresence.deployment
+import telepresence.dns
+import telepresence.journal
 import telepresence.runner
+import telepresence.utilities
 import telepresence.vpn
 import telepresence.main
+import telepresence.pool
+import telepresence.remote
 
 COMPLEX_DEPLOYMENT = """\
 apiVersion: extensions/v1beta1
@@ -177,6 +197,119 @@ def test_swap_deployment_changes():
     ) == (expected, original["spec"]["template"]["spec"]["containers"][1])
 
 
+def _apply_json_patch(document, operations):
+    """Just enough of RFC 6902 for the patches telepresence makes."""
+    document = json.loads(json.dumps(document))
+    for operation in operations:
+        keys = [
+            key.replace("~1", "/").replace("~0", "~")
+            for key in operation["path"].split("/")[1:]
+        ]
+        parent = document
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        if operation["op"] == "test":
+            assert parent[keys[-1]] == operation["value"]
+        elif operation["op"] == "remove":
+            del parent[keys[-1]]
+        else:
+            parent[keys[-1]] = operation["value"]
+    return document
+
+
+def test_swap_deployment_patches():
+    """
+    The swap patch makes the same changes as the swapped Deployment, touching
+    only the swapped container, and the restore patch undoes them.
+    """
+    original = yaml.safe_load(COMPLEX_DEPLOYMENT)
+    swapped, _ = telepresence.deployment.new_swapped_deployment(
+        original,
+        "nginxhttps",
+        "random_id_123",
+        "datawire/telepresence-k8s:0.777",
+        False,
+        False,
+    )
+    swap, restore = telepresence.deployment.swap_patches(
+        original, swapped, "nginxhttps"
+    )
+    assert _apply_json_patch(original, swap) == swapped
+    assert _apply_json_patch(swapped, restore) == original
+    assert swap[0] == {
+        "op": "test",
+        "path": "/spec/template/spec/containers/1/name",
+        "value": "nginxhttps"
+    }
+    paths = [operation["path"] for operation in swap[1:]]
+    assert all(
+        path.startswith("/spec/template/spec/containers/1/")
+        for path in paths
+        if path not in ("/metadata/labels", "/spec/replicas",
+                        "/spec/template/metadata/labels")
+    )
+
+
+def test_restore_outstanding_swaps(tmpdir, monkeypatch):
+    """
+    --restore undoes the recorded swaps of telepresence processes that are
+    gone, newest first for the same Deployment, and forgets them. A
+    Deployment a running telepresence swapped is left alone, even if an
+    older session that swapped it too is gone.
+    """
+    directory = Path(str(tmpdir))
+    monkeypatch.setattr(telepresence.journal, "journal_dir", lambda: directory)
+    calls = []
+
+    class Runner(FakeRunner):
+        kubectl_cmd = "kubectl"
+
+        def kubectl(self, context, namespace, args):
+            return ["kubectl", "--context", context, "--namespace", namespace
+                    ] + args
+
+        def check_call(self, args, input=None):
+            calls.append(args)
+
+    def record(run_id, name, restore_patch):
+        telepresence.journal.record_swap(
+            run_id, "kubectl", "ctx", "default", "deployment", name,
+            {"metadata": {"name": name}}, restore_patch
+        )
+
+    record("first", "web", [{"op": "test", "path": "/first"}])
+    record("second", "web", [{"op": "test", "path": "/second"}])
+    record("replaced", "db", None)
+    record("crashed", "queue", [{"op": "test", "path": "/crashed"}])
+    record("running", "queue", [])
+    record("reused", "cache", [])
+    dead = _exited_process().pid
+    order = ["first", "second", "replaced", "crashed", "running", "reused"]
+    for entry in telepresence.journal.outstanding_swaps():
+        entry["created"] = order.index(entry["run_id"])
+        if entry["run_id"] == "reused":
+            # Our pid, but the process that had it before a reboot, say:
+            entry["pid_started"] = "another boot"
+        elif entry["run_id"] != "running":
+            entry["pid"] = dead
+        with (directory / (entry["run_id"] + ".json")).open("w") as f:
+            json.dump(entry, f)
+
+    telepresence.deployment.restore_outstanding_swaps(Runner())
+    web = [c[-1] for c in calls if c[5:8] == ["patch", "deployment", "web"]]
+    assert web == [
+        '--patch=[{"op": "test", "path": "/second"}]',
+        '--patch=[{"op": "test", "path": "/first"}]',
+    ]
+    assert ["delete", "deployment", "--ignore-not-found", "db"] in [
+        c[5:] for c in calls
+    ]
+    assert not [c for c in calls if "queue" in c]
+    assert ["patch", "deployment", "cache"] in [c[5:8] for c in calls]
+    assert [e["run_id"] for e in telepresence.journal.outstanding_swaps()
+            ] == ["crashed", "running"]
+
+
 def test_portmapping():
     """
     Manually set exposed ports always override automatically exposed ports.
@@ -218,6 +351,70 @@ def test_covering_cidr(ips):
             assert not all([ip in subnet for ip in ips])
 
 
+@given(ips, st.integers(min_value=1, max_value=10))
+@example(["10.0.0.1", "10.200.0.1"], 8)
+@example(["10.0.0.1", "10.0.1.1", "10.0.3.1", "10.200.0.1"], 2)
+def test_covering_cidrs(ips, max_prefixes):
+    """
+    covering_cidrs() covers the given IPs with a few CIDRs, never covering
+    more than the limit on addresses to do so.
+    """
+    max_addresses = 2**16
+    cidrs = telepresence.vpn.covering_cidrs(ips, max_prefixes, max_addresses)
+    networks = [ipaddress.IPv4Network(cidr) for cidr in cidrs]
+    assert all([n.prefixlen <= 24 for n in networks])
+    # All IPs in given CIDRs:
+    assert all([
+        any([ipaddress.IPv4Address(ip) in n for n in networks]) for ip in ips
+    ])
+    # No overlaps:
+    assert list(ipaddress.collapse_addresses(networks)) == sorted(networks)
+    # Either few enough prefixes, or merging more would cover too much:
+    total = sum([n.num_addresses for n in networks])
+    slash24s = {ipaddress.IPv4Interface(ip + "/24").network for ip in ips}
+    if len(networks) > max_prefixes:
+        # Merging any two more networks would cover too much:
+        for a, b in zip(networks, networks[1:]):
+            supernet = a
+            while b.network_address not in supernet:
+                supernet = supernet.supernet()
+            merged = ipaddress.collapse_addresses(networks + [supernet])
+            assert sum([n.num_addresses for n in merged]) > max_addresses
+    assert total <= max(max_addresses, 256 * len(slash24s))
+    # Never worse than a single covering CIDR:
+    single = ipaddress.IPv4Network(telepresence.vpn.covering_cidr(ips))
+    assert total <= single.num_addresses
+
+
+def test_covering_cidrs_far_apart():
+    """Far apart IPs don't get merged into one huge CIDR."""
+    assert telepresence.vpn.covering_cidrs(["10.0.0.1", "10.200.0.1"]) == [
+        "10.0.0.0/24", "10.200.0.0/24"
+    ]
+    assert telepresence.vpn.covering_cidrs([
+        "10.0.0.1", "10.0.1.1", "10.0.3.1", "10.200.0.1"
+    ], max_prefixes=2) == ["10.0.0.0/22", "10.200.0.0/24"]
+
+
+def test_service_cidrs():
+    """
+    The Service IP range is the single network covering the known Service
+    IPs if that's small enough, or a few smaller networks if not.
+    """
+    service_cidrs = telepresence.vpn.service_cidrs
+    assert service_cidrs(["10.0.0.1", "10.0.200.1"]) == ["10.0.0.0/16"]
+    assert service_cidrs(["10.0.0.1", "10.200.0.1"]) == [
+        "10.0.0.0/24", "10.200.0.0/24"
+    ]
+    assert service_cidrs(["10.0.0.1", "10.200.0.1"],
+                         max_addresses=2**24) == ["10.0.0.0/8"]
+    assert service_cidrs(["10.0.0.1", "10.0.1.1", "10.0.3.1", "10.200.0.1"],
+                         max_prefixes=2,
+                         max_addresses=2**11) == [
+                             "10.0.0.0/22", "10.200.0.0/24"
+                         ]
+
+
 def test_runner_file():
     """Test some reasonable values for the log file"""
     # stdout
@@ -283,3 +480,1312 @@ def test_default_operation():
     assert args.new_deployment is not None
     assert args.deployment is None
     assert args.swap_deployment is None
+
+
+class FakeRunner(object):
+    """Just enough of a Runner for code that only logs."""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+
+
+def _exited_process():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process
+
+
+def test_auxiliary_process_restarted():
+    """
+    An auxiliary process that exits is restarted rather than ending the
+    session.
+    """
+    processes = telepresence.cleanup.Subprocesses()
+    restarted = []
+
+    def restart():
+        process = subprocess.Popen(["sleep", "10"])
+        restarted.append(process)
+        return process
+
+    processes.append(
+        _exited_process(),
+        policy=telepresence.cleanup.auxiliary(FakeRunner(), "aux", restart)
+    )
+    try:
+        assert processes.any_dead() is None
+        assert list(processes.subprocesses) == restarted
+    finally:
+        processes.killall()
+
+
+def test_relaunch_replaces_process():
+    """
+    relaunch() starts a new process for a policy and kills the one it
+    replaces, so there's only ever one.
+    """
+    processes = telepresence.cleanup.Subprocesses()
+    started = []
+
+    def start():
+        process = subprocess.Popen(["sleep", "10"])
+        started.append(process)
+        return process
+
+    policy = telepresence.cleanup.auxiliary(FakeRunner(), "aux", start)
+    try:
+        processes.relaunch(policy)
+        processes.relaunch(policy)
+        assert list(processes.subprocesses) == [started[1]]
+        assert started[0].poll() is not None
+        assert processes.any_dead() is None
+    finally:
+        processes.killall()
+
+
+def test_relaunch_waits_for_restart():
+    """
+    relaunch() from another thread waits while any_dead() is restarting the
+    same process, so the two don't end up running side by side.
+    """
+    processes = telepresence.cleanup.Subprocesses()
+    started = []
+    relauncher = threading.Thread(
+        target=lambda: processes.relaunch(policy)
+    )
+
+    def start():
+        if not started:
+            # any_dead() is restarting the process; routes change meanwhile:
+            relauncher.start()
+            relauncher.join(0.2)
+            assert relauncher.is_alive()
+        process = subprocess.Popen(["sleep", "10"])
+        started.append(process)
+        return process
+
+    policy = telepresence.cleanup.auxiliary(FakeRunner(), "aux", start)
+    processes.append(_exited_process(), policy=policy)
+    try:
+        assert processes.any_dead() is None
+        relauncher.join()
+        assert list(processes.subprocesses) == [started[1]]
+        assert started[0].poll() is not None
+    finally:
+        processes.killall()
+
+
+def test_critical_process_gives_up():
+    """
+    A critical process is restarted in place, but if it keeps dying the
+    session is ended.
+    """
+    processes = telepresence.cleanup.Subprocesses()
+    policy = telepresence.cleanup.critical(
+        FakeRunner(), "crit", _exited_process
+    )
+    policy.initial_delay = 0
+    processes.append(_exited_process(), policy=policy)
+    results = [processes.any_dead() for _ in range(policy.max_attempts + 1)]
+    assert results[:-1] == [None] * policy.max_attempts
+    assert results[-1] is not None
+
+
+def test_dependents_restarted_with_parent():
+    """
+    When a process with dependents is restarted, its dependents are restarted
+    along with it even if they are still running.
+    """
+    runner = FakeRunner()
+    processes = telepresence.cleanup.Subprocesses()
+
+    def sleeper():
+        return subprocess.Popen(["sleep", "10"])
+
+    parent = telepresence.cleanup.critical(runner, "parent", sleeper)
+    dependent = telepresence.cleanup.critical(runner, "dependent", sleeper)
+    dependent.depends_on(parent)
+    processes.append(_exited_process(), policy=parent)
+    original_dependent = sleeper()
+    processes.append(original_dependent, policy=dependent)
+    try:
+        assert processes.any_dead() is None
+        assert original_dependent.poll() is not None
+        assert len(processes.subprocesses) == 2
+        assert all(p.poll() is None for p in processes.subprocesses)
+        assert any("Reconnected parent" in line for line in runner.lines)
+    finally:
+        processes.killall()
+
+
+def test_round_robin_proxy():
+    """
+    RoundRobinProxy spreads connections across its upstream ports in turn.
+    """
+    servers = []
+    for _ in range(2):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(5)
+        servers.append(server)
+    upstream_ports = [server.getsockname()[1] for server in servers]
+    port = telepresence.utilities.find_free_port()
+    proxy = telepresence.balancer.RoundRobinProxy(
+        FakeRunner(), port, upstream_ports
+    )
+    proxy.start()
+    try:
+        for server in servers + servers:
+            client = socket.create_connection(("127.0.0.1", port))
+            server.settimeout(5)
+            accepted, _ = server.accept()
+            accepted.sendall(b"hello")
+            assert client.recv(5) == b"hello"
+            accepted.close()
+            client.close()
+    finally:
+        proxy.close()
+        for server in servers:
+            server.close()
+
+
+def test_swap_deployment_authorized_key():
+    """
+    When given a public key, the swapped Deployment enables the direct SSH
+    server with it.
+    """
+    original = yaml.safe_load(COMPLEX_DEPLOYMENT)
+    new, _ = telepresence.deployment.new_swapped_deployment(
+        original,
+        "nginxhttps",
+        "random_id_123",
+        "datawire/telepresence-k8s:0.777",
+        False,
+        False,
+        "ssh-ed25519 AAAA test",
+    )
+    container = new["spec"]["template"]["spec"]["containers"][1]
+    assert {
+        "name": "TELEPRESENCE_AUTHORIZED_KEY",
+        "value": "ssh-ed25519 AAAA test"
+    } in container["env"]
+
+
+def test_socks_pool():
+    """
+    SOCKSPool answers the client's SOCKS greeting itself and passes the rest
+    of the conversation to an upstream connection that already did the
+    greeting.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    server.settimeout(5)
+    greeted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            assert conn.recv(3) == b"\x05\x01\x00"
+            conn.sendall(b"\x05\x00")
+            greeted.append(conn)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    port = telepresence.utilities.find_free_port()
+    pool = telepresence.balancer.SOCKSPool(
+        FakeRunner(), port, [server.getsockname()[1]], 2
+    )
+    pool.start()
+    try:
+        deadline = time.time() + 5
+        while len(greeted) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(greeted) == 2
+        client = socket.create_connection(("127.0.0.1", port))
+        client.sendall(b"\x05\x02\x00\x02")
+        assert client.recv(2) == b"\x05\x00"
+        client.sendall(b"CONNECT")
+        upstream = greeted[0]
+        upstream.settimeout(5)
+        assert upstream.recv(7) == b"CONNECT"
+        client.close()
+    finally:
+        pool.close()
+        server.close()
+
+
+def test_socks_pool_passes_socks4_through():
+    """
+    SOCKSPool passes SOCKS4 requests, which have no greeting, to upstream
+    untouched.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    server.settimeout(5)
+    request = b"\x04\x01\x00\x50\x7f\x00\x00\x01user\x00"
+    port = telepresence.utilities.find_free_port()
+    pool = telepresence.balancer.SOCKSPool(
+        FakeRunner(), port, [server.getsockname()[1]], 0
+    )
+    pool.start()
+    try:
+        client = socket.create_connection(("127.0.0.1", port))
+        client.settimeout(5)
+        client.sendall(request)
+        upstream, _ = server.accept()
+        upstream.settimeout(5)
+        assert telepresence.balancer.recv_exactly(
+            upstream, len(request)
+        ) == request
+        upstream.sendall(b"\x00\x5a\x00\x50\x7f\x00\x00\x01")
+        assert telepresence.balancer.recv_exactly(
+            client, 8
+        ) == b"\x00\x5a\x00\x50\x7f\x00\x00\x01"
+        client.close()
+        upstream.close()
+    finally:
+        pool.close()
+        server.close()
+
+
+def test_cache_expires(tmpdir):
+    """Cache entries are returned until they are older than the TTL."""
+    cache = telepresence.cache.Cache("test", Path(str(tmpdir)))
+    assert cache.get("key", 60) is None
+    cache.set("key", {"a": [1, 2]})
+    assert cache.get("key", 60) == {"a": [1, 2]}
+    assert cache.get("key", -1) is None
+    # Stored on disk, so a new instance sees it:
+    assert telepresence.cache.Cache("test", Path(str(tmpdir))).get(
+        "key", 60
+    ) == {"a": [1, 2]}
+    cache.delete("key")
+    assert cache.get("key", 60) is None
+
+
+def test_remote_info_cached(tmpdir, monkeypatch):
+    """
+    Remote info and environment are reused while the Deployment and pod
+    resourceVersions are unchanged, with a single kubectl call.
+    """
+    cache = telepresence.cache.Cache("remote-info", Path(str(tmpdir)))
+    monkeypatch.setattr(
+        telepresence.remote, "_remote_info_cache", lambda: cache
+    )
+    versions = ["100", "200"]
+    calls = []
+
+    class Runner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            calls.append(args)
+            assert args[:3] == ["get", "deployment/myapp", "pod/myapp-1"]
+            return " ".join(versions)
+
+    runner = Runner()
+    container = {
+        "name": "app",
+        "image": "datawire/telepresence-k8s:" + telepresence.__version__,
+    }
+    deployment = {"spec": {"template": {"spec": {"containers": [container]}}}}
+
+    def get_cached():
+        return telepresence.remote.get_cached_remote_info(
+            runner, "myapp", "ctx", "default", "deployment"
+        )
+
+    assert get_cached() is None
+    remote_info = telepresence.remote.RemoteInfo(
+        runner, "ctx", "default", "myapp", "myapp-1", deployment
+    )
+    telepresence.remote.cache_remote_info(
+        runner, remote_info, "deployment", list(versions), {"A": "1"}
+    )
+    # The environment may hold secrets:
+    assert os.stat(str(cache.path)).st_mode & 0o777 == 0o600
+
+    cached_info, env = get_cached()
+    assert len(calls) == 1
+    assert (cached_info.pod_name, cached_info.container_name) == (
+        "myapp-1", "app"
+    )
+    assert env == {"A": "1"}
+    # The pod restarted, say:
+    versions[1] = "201"
+    assert get_cached() is None
+    versions[1] = "200"
+    assert get_cached() is None
+
+
+def test_pool_claims_ready_pod(monkeypatch):
+    """
+    --pool-size takes a ready pod from the pool by relabelling it, skipping
+    pods that aren't ready or that another session claimed first, and keeps
+    the pool going by pushing its deadline back.
+    """
+    args = telepresence.cli.parse_args([
+        "--pool-size", "2", "--new-deployment", "myapp", "--expose", "8080",
+        "--run", "true"
+    ])
+    args.in_local_vm = False
+    args.needs_root = False
+    job = telepresence.pool.pool_job(args)
+    name = job["metadata"]["name"]
+    key = job["metadata"]["labels"]["telepresence-pool"]
+
+    def pod(pod_name, ready):
+        return {
+            "metadata": {
+                "name": pod_name,
+                "resourceVersion": "1"
+            },
+            "status": {
+                "phase": "Running",
+                "containerStatuses": [{
+                    "ready": ready
+                }]
+            },
+        }
+
+    calls = []
+
+    class Runner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            calls.append(args)
+            if args[:2] == ["get", "pod"]:
+                assert args[-1] == "--selector=telepresence-pool=" + key
+                pods = [
+                    pod("starting", False),
+                    pod("taken", True),
+                    pod("idle", True)
+                ]
+                return json.dumps({"items": pods})
+            if args[:3] == ["get", "job", name]:
+                return json.dumps({
+                    "status": {
+                        "startTime": "1970-01-01T00:16:40Z"
+                    }
+                })
+
+        def check_kubectl(self, context, namespace, args, input=None):
+            calls.append(args)
+            if args[:3] == ["label", "pod", "taken"]:
+                raise subprocess.CalledProcessError(1, args)
+
+    class SyncThread(object):
+        def __init__(self, target, args):
+            self.target, self.args = target, args
+
+        def start(self):
+            self.target(*self.args)
+
+    exit_functions = []
+    monkeypatch.setattr(telepresence.pool, "Thread", SyncThread)
+    monkeypatch.setattr(telepresence.pool, "time", lambda: 1100.5)
+    monkeypatch.setattr(
+        telepresence.pool.atexit, "register", exit_functions.append
+    )
+    remote_info, run_id = telepresence.pool.use_pool(Runner(), args)
+    assert (remote_info.deployment_name, remote_info.pod_name) == (
+        name, "idle"
+    )
+    assert remote_info.container_name == "telepresence"
+    assert [c[2] for c in calls if c[0] == "label"] == ["taken", "idle"]
+    assert [
+        "label", "pod", "idle", "telepresence-pool-",
+        "telepresence=" + run_id, "--resource-version=1"
+    ] in calls
+    # The pool started 100 seconds ago, and should live for another hour:
+    assert [
+        "patch", "job", name, "--type=merge",
+        '--patch={"spec": {"parallelism": 2, "activeDeadlineSeconds": 3700}}'
+    ] in calls
+    exit_functions[0]()
+    assert calls[-1] == [
+        "delete", "--ignore-not-found", "all",
+        "--selector=telepresence=" + run_id
+    ]
+
+
+def test_pool_replaces_expired_job():
+    """
+    A pool Job that expired, or doesn't exist yet, is (re)created with a
+    deadline --pool-ttl seconds away.
+    """
+    args = telepresence.cli.parse_args([
+        "--pool-size", "1", "--pool-ttl", "60", "--new-deployment", "myapp",
+        "--run", "true"
+    ])
+    args.in_local_vm = False
+    args.needs_root = False
+    job = telepresence.pool.pool_job(args)
+    assert job["spec"]["activeDeadlineSeconds"] == 60
+    assert job["spec"]["template"]["spec"]["restartPolicy"] == "OnFailure"
+    calls = []
+    created = []
+
+    class Runner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            return json.dumps({
+                "status": {
+                    "conditions": [{
+                        "type": "Failed",
+                        "status": "True",
+                        "reason": "DeadlineExceeded"
+                    }]
+                }
+            })
+
+        def check_kubectl(self, context, namespace, args, input=None):
+            calls.append(args)
+            if input is not None:
+                created.append(json.loads(input.decode("utf-8")))
+
+    telepresence.pool.update_pool(Runner(), args, job)
+    assert calls == [
+        ["delete", "job", "--ignore-not-found", job["metadata"]["name"]],
+        ["create", "-f", "-"],
+    ]
+    assert created == [job]
+
+
+def test_cluster_cidrs_cached(tmpdir, monkeypatch):
+    """
+    Cluster IP ranges are only discovered once per cluster, and rediscovered
+    if a known Service IP is outside the cached range, or a node's pod range
+    is outside the cached pod ranges.
+    """
+    cache = telepresence.cache.Cache("cidrs", Path(str(tmpdir)))
+    monkeypatch.setattr(telepresence.vpn, "_cidr_cache", lambda: cache)
+    discovered = []
+    node_cidrs = ["10.0.1.0/24"]
+
+    def get_cluster_cidrs(runner, max_prefixes, max_addresses):
+        discovered.append(True)
+        return list(node_cidrs), ["10.3.0.0/24"]
+
+    monkeypatch.setattr(
+        telepresence.vpn, "get_cluster_cidrs", get_cluster_cidrs
+    )
+
+    class NodesRunner(FakeRunner):
+        kubectl_cmd = "kubectl"
+
+        def get_output(self, args):
+            assert args[1:4] == ["get", "nodes", "-o"]
+            if node_cidrs is None:
+                raise subprocess.CalledProcessError(1, args)
+            return " ".join(node_cidrs)
+
+    args = telepresence.cli.parse_args(["--run", "true"])
+    args.cluster_server = "https://1.2.3.4"
+
+    def get_proxy_cidrs(service_address):
+        return sorted(
+            telepresence.vpn.get_proxy_cidrs(
+                NodesRunner(), args, None, service_address
+            )
+        )
+
+    expected = ["10.0.1.0/24", "10.3.0.0/24"]
+    assert get_proxy_cidrs("10.3.0.1") == expected
+    assert get_proxy_cidrs("10.3.0.1") == expected
+    assert len(discovered) == 1
+    # Service IP no longer in range, so cache is out of date:
+    assert get_proxy_cidrs("10.7.0.1") == expected
+    assert len(discovered) == 2
+    # A node was added, with a new pod range:
+    node_cidrs.append("10.0.2.0/24")
+    assert get_proxy_cidrs("10.3.0.1") == [
+        "10.0.1.0/24", "10.0.2.0/24", "10.3.0.0/24"
+    ]
+    assert len(discovered) == 3
+    # If nodes can't be listed, pod ranges are only reused for a short while:
+    node_cidrs = None
+    get_proxy_cidrs("10.3.0.1")
+    assert len(discovered) == 3
+    monkeypatch.setattr(telepresence.vpn, "UNCHECKED_POD_CIDR_TTL", -1)
+    node_cidrs = []
+    get_proxy_cidrs("10.3.0.1")
+    assert len(discovered) == 4
+    # Different cluster:
+    args.cluster_server = "https://5.6.7.8"
+    get_proxy_cidrs("10.3.0.1")
+    assert len(discovered) == 5
+
+
+def test_aggregate_cidrs():
+    """
+    aggregate_cidrs() drops covered ranges, merges neighbours, and only
+    covers extra addresses within the waste budget.
+    """
+    cidrs = [
+        "10.0.0.0/24", "10.0.1.0/24", "10.0.0.7", "10.0.3.0/24",
+        "10.96.0.0/12", "10.100.5.0/24", "fd00::/64"
+    ]
+    assert telepresence.vpn.aggregate_cidrs(cidrs) == [
+        "10.0.0.0/23", "10.0.3.0/24", "10.96.0.0/12", "fd00::/64"
+    ]
+    assert telepresence.vpn.aggregate_cidrs(cidrs, 255) == [
+        "10.0.0.0/23", "10.0.3.0/24", "10.96.0.0/12", "fd00::/64"
+    ]
+    assert telepresence.vpn.aggregate_cidrs(cidrs, 256) == [
+        "10.0.0.0/22", "10.96.0.0/12", "fd00::/64"
+    ]
+
+
+@given(st.lists(elements=ip, min_size=1), st.integers(0, 2**12))
+def test_aggregate_cidrs_covers(ips, waste):
+    """
+    aggregate_cidrs() covers the same addresses, plus at most the waste
+    budget.
+    """
+    cidrs = [ip + "/28" for ip in ips]
+    original = list(
+        ipaddress.collapse_addresses([
+            ipaddress.ip_network(c, strict=False) for c in cidrs
+        ])
+    )
+    aggregated = [
+        ipaddress.ip_network(c)
+        for c in telepresence.vpn.aggregate_cidrs(cidrs, waste)
+    ]
+    assert len(aggregated) <= len(original)
+    for network in original:
+        assert any([
+            network.network_address in a and network.broadcast_address in a
+            for a in aggregated
+        ])
+    assert sum([n.num_addresses for n in aggregated]) <= sum([
+        n.num_addresses for n in original
+    ]) + waste
+
+
+class FakeKubectl(FakeRunner):
+    """
+    A Runner whose 'kubectl get' calls may fail, and where listing nodes and
+    Services only returns once both are in flight at the same time.
+    """
+
+    kubectl_cmd = "kubectl"
+
+    def __init__(self, objects):
+        FakeRunner.__init__(self)
+        self.objects = objects
+        # Fails with BrokenBarrierError if the calls are made one by one:
+        self.together = threading.Barrier(2, timeout=10)
+
+    def get_output(self, args):
+        if args[2] in ("nodes", "services"):
+            self.together.wait()
+        items = self.objects[args[2]]
+        if items is None:
+            raise subprocess.CalledProcessError(1, args)
+        return json.dumps({"items": items})
+
+
+def test_cluster_cidrs_concurrent():
+    """
+    get_cluster_cidrs() lists nodes and Services concurrently, and still
+    falls back to pod IPs if nodes can't be listed.
+    """
+    services = [{
+        "spec": {
+            "clusterIP": "10.3.0.{}".format(i)
+        }
+    } for i in range(8)]
+    runner = FakeKubectl({
+        "nodes": [{"spec": {"podCIDR": "10.0.1.0/24"}}],
+        "services": services,
+    })
+    assert telepresence.vpn.get_cluster_cidrs(runner) == (
+        ["10.0.1.0/24"], ["10.3.0.0/24"]
+    )
+
+    runner = FakeKubectl({
+        "nodes": None,
+        "pods": [{"status": {"podIP": "10.0.2.5"}}],
+        "services": services,
+    })
+    assert telepresence.vpn.get_cluster_cidrs(runner) == (
+        ["10.0.2.0/24"], ["10.3.0.0/24"]
+    )
+    assert "Failed to get nodes" in runner.lines[0]
+
+
+def test_also_proxy_resolution_cached(tmpdir, monkeypatch):
+    """
+    --also-proxy hostnames are resolved in one kubectl exec, with all their
+    IPs, and the results are reused within the same namespace.
+    """
+    cache = telepresence.cache.Cache("also-proxy", Path(str(tmpdir)))
+    monkeypatch.setattr(telepresence.vpn, "_hostname_cache", lambda: cache)
+    calls = []
+
+    class Runner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            calls.append(args)
+            # Run the script locally, with a fake resolver:
+            code = args[args.index("-c") + 1].replace(
+                "socket.getaddrinfo(host, None, socket.AF_INET)",
+                "[(0, 0, 0, '', ('10.1.0.' + str(len(host)), 0)), "
+                "(0, 0, 0, '', ('10.2.0.1', 0))]"
+            )
+            return subprocess.check_output([
+                sys.executable, "-c", code
+            ] + args[args.index("-c") + 2:]).decode("utf-8")
+
+    args = telepresence.cli.parse_args(["--run", "true"])
+    args.context = "ctx"
+    args.namespace = "default"
+    args.cluster_server = "https://1.2.3.4"
+    remote_info = argparse.Namespace(
+        container_name="c", pod_name="p", agent=None
+    )
+
+    def resolve(hostnames):
+        return telepresence.vpn.resolve_in_cluster(
+            Runner(), args, remote_info, hostnames
+        )
+
+    assert resolve(["db", "queue"]) == {
+        "db": ["10.1.0.2", "10.2.0.1"],
+        "queue": ["10.1.0.5", "10.2.0.1"],
+    }
+    assert len(calls) == 1
+    assert resolve(["db", "queue"])["queue"] == ["10.1.0.5", "10.2.0.1"]
+    assert len(calls) == 1
+    # Only the new hostname is looked up:
+    resolve(["db", "cache"])
+    assert len(calls) == 2
+    assert calls[1][-1] == "cache"
+    # Short names may resolve differently in another namespace:
+    args.namespace = "staging"
+    resolve(["db"])
+    assert len(calls) == 3
+
+
+def _fake_agent(responses):
+    """
+    Start a server that answers agent requests from responses, a dict mapping
+    method to (status, payload), and return its port and the requests.
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    requests = []
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            request = json.loads(conn.makefile("rb").readline().decode())
+            requests.append(request)
+            if request["method"] in responses:
+                status, payload = responses[request["method"]]
+                conn.sendall(
+                    status + b" " + str(len(payload)).encode() + b"\n" +
+                    payload
+                )
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1], requests
+
+
+def test_agent_client():
+    """
+    The agent client parses null-delimited environments, and turns errors
+    and missing agents into AgentError.
+    """
+    port, requests = _fake_agent({
+        "env": (b"ok", b"A=1\0CERT=line1\nline2\0EQ=a=b\0EMPTY=\0"),
+        "resolve": (b"ok", b'{"db": ["10.0.0.1"], "nope": null}'),
+        "fail": (b"error", b"no such host"),
+    })
+    agent = telepresence.agent.Agent(FakeRunner(), port)
+    assert agent.env() == {
+        "A": "1",
+        "CERT": "line1\nline2",
+        "EQ": "a=b",
+        "EMPTY": "",
+    }
+    assert agent.resolve(["db", "nope"]) == {"db": ["10.0.0.1"], "nope": None}
+    assert requests[-1] == {"method": "resolve", "hosts": ["db", "nope"]}
+    with pytest.raises(telepresence.agent.AgentError):
+        agent.request("fail")
+    # An older proxy image has no agent, so the connection just closes:
+    del requests[:]
+    with pytest.raises(telepresence.agent.AgentError):
+        agent.request("unknown")
+
+
+def test_resolve_in_cluster_uses_agent(tmpdir, monkeypatch):
+    """
+    With an agent, resolving hostnames in the cluster doesn't need kubectl.
+    """
+    cache = telepresence.cache.Cache("also-proxy", Path(str(tmpdir)))
+    monkeypatch.setattr(telepresence.vpn, "_hostname_cache", lambda: cache)
+    port, requests = _fake_agent({
+        "resolve": (b"ok", b'{"db": ["10.1.0.2"]}'),
+    })
+    args = telepresence.cli.parse_args(["--run", "true"])
+    args.context = "ctx"
+    args.namespace = "default"
+    args.cluster_server = "https://1.2.3.4"
+    remote_info = argparse.Namespace(
+        agent=telepresence.agent.Agent(FakeRunner(), port)
+    )
+    assert telepresence.vpn.resolve_in_cluster(
+        FakeRunner(), args, remote_info, ["db"]
+    ) == {"db": ["10.1.0.2"]}
+    assert requests == [{"method": "resolve", "hosts": ["db"]}]
+
+
+def test_route_updater():
+    """
+    RouteUpdater routes new Service IPs outside the existing routes, once.
+    """
+    service_ips = ["10.3.0.1", "10.3.0.7"]
+
+    class Runner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            # New Services may be in any namespace:
+            assert "--all-namespaces" in args
+            return " ".join(service_ips + ["None"])
+
+    args = telepresence.cli.parse_args(["--run", "true"])
+    added = []
+    updater = telepresence.vpn.RouteUpdater(
+        Runner(), args, None, ["10.3.0.0/24"], added.append
+    )
+    assert updater.update() == []
+    service_ips.append("10.9.0.3")
+    assert updater.update() == ["10.9.0.0/24"]
+    assert updater.update() == []
+    assert added == [["10.9.0.0/24"]]
+
+
+def test_dns_probe():
+    """
+    The DNS probe builds queries a DNS server understands, and notices when
+    the answer has addresses.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    answers = [b"", b"\x7f\x00\x00\x01"]
+
+    def serve():
+        for answer in answers:
+            data, address = server.recvfrom(4096)
+            # Question is the name, then type A and class IN:
+            assert data[12:].endswith(b"\x00\x00\x01\x00\x01")
+            assert b"\x12hellotelepresence0" in data
+            response = data[:2] + b"\x81\x80" + data[4:6]
+            response += b"\x00\x01" if answer else b"\x00\x00"
+            response += b"\x00\x00\x00\x00" + data[12:]
+            if answer:
+                response += b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x05\x00\x04"
+                response += answer
+            server.sendto(response, address)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    port = server.getsockname()[1]
+    assert telepresence.dns.query(
+        "127.0.0.1", "hellotelepresence0.example.com", 1, port
+    ) == []
+    assert telepresence.dns.query(
+        "127.0.0.1", "hellotelepresence0", 1, port
+    ) == ["127.0.0.1"]
+    # Mismatched ID is ignored:
+    assert telepresence.dns.parse_response(
+        telepresence.dns.build_query("x", 2)[:2] + b"\x81\x80" + b"\x00" * 8,
+        3
+    ) is None
+
+
+def _fake_nameserver(answers, delay=0):
+    """
+    Start a DNS server that answers A queries using the given dict of name to
+    IP, and NXDOMAIN otherwise, after delay seconds. Return its port and a
+    list of names asked.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    asked = []
+
+    def serve():
+        while True:
+            data, address = server.recvfrom(4096)
+            name = telepresence.dns.parse_question(data)[0]
+            asked.append(name)
+            time.sleep(delay)
+            if name in answers:
+                response = data[:2] + b"\x81\x80" + data[4:6] + b"\x00\x01"
+                response += b"\x00\x00\x00\x00" + data[12:]
+                response += b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x05\x00\x04"
+                response += socket.inet_aton(answers[name])
+            else:
+                response = data[:2] + b"\x81\x83" + data[4:6] + b"\x00" * 6
+                response += data[12:]
+            server.sendto(response, address)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1], asked
+
+
+def test_redirect_dns_rules(monkeypatch):
+    """
+    redirect_dns() tags its iptables rules with our pid, deletes rules left
+    behind by telepresence processes that are gone, and registers a watchdog
+    that deletes ours if we die.
+    """
+    dead = _exited_process().pid
+    calls = []
+
+    class Runner(FakeRunner):
+        def get_output(self, args):
+            return "\n".join([
+                "-P OUTPUT ACCEPT",
+                "-A OUTPUT -d 10.0.0.1/32 -p udp -m udp ! --sport 1000"
+                " --dport 53 -m comment --comment telepresence-{}"
+                " -j REDIRECT --to-ports 2000".format(dead),
+                "-A OUTPUT -p udp -m comment --comment \"telepresence-{}\""
+                " -j REDIRECT --to-ports 3000".format(os.getpid()),
+                "-A OUTPUT -p udp -m comment --comment other -j ACCEPT",
+            ])
+
+        def check_call(self, args):
+            calls.append(args)
+
+        def popen(self, args):
+            calls.append(args)
+            return subprocess.Popen(["true"])
+
+    class Subprocesses(object):
+        def append(self, process, killer, policy):
+            self.killer = killer
+            self.policy = policy
+
+    monkeypatch.setattr(
+        telepresence.dns, "get_resolv_conf_namservers", lambda: ["10.0.0.1"]
+    )
+    stub = argparse.Namespace(port=5300, upstream_port=4000)
+    subprocesses = Subprocesses()
+    telepresence.dns.redirect_dns(Runner(), subprocesses, stub)
+    tag = "telepresence-{}".format(os.getpid())
+    assert calls[:2] == [[
+        "sudo", "iptables", "-t", "nat", "-D", "OUTPUT", "-d", "10.0.0.1/32",
+        "-p", "udp", "-m", "udp", "!", "--sport", "1000", "--dport", "53",
+        "-m", "comment", "--comment", "telepresence-{}".format(dead), "-j",
+        "REDIRECT", "--to-ports", "2000"
+    ], [
+        "sudo", "iptables", "-t", "nat", "-I", "OUTPUT", "-p", "udp", "-d",
+        "10.0.0.1", "--dport", "53", "!", "--sport", "4000", "-m", "comment",
+        "--comment", tag, "-j", "REDIRECT", "--to-ports", "5300"
+    ]]
+    watchdog = calls[2]
+    assert watchdog[:3] == ["sudo", "sh", "-c"]
+    assert "kill -0 {}".format(os.getpid()) in watchdog[3]
+    assert "iptables -t nat -D OUTPUT" in watchdog[3]
+    assert subprocesses.policy.name == "DNS redirect watchdog"
+    subprocesses.killer()
+    assert calls[3][4:] == ["-D"] + calls[1][5:]
+
+
+def test_split_domains():
+    """SplitDomains sends possible cluster names to the cluster first."""
+    domains = telepresence.dns.SplitDomains(["default", "prod"], ["corp.com"])
+    remote, local = telepresence.dns.REMOTE, telepresence.dns.LOCAL
+    assert domains.upstreams("db.prod.svc.cluster.local") == [remote]
+    for name in ("myservice", "myservice.corp.com", "myservice.prod",
+                 "myservice.prod.corp.com", "myservice.svc"):
+        assert domains.upstreams(name) == [remote, local]
+    for name in ("example.com", "www.example.com", "a.b.corp.com"):
+        assert domains.upstreams(name) == [local]
+
+
+def test_stub_resolver_split():
+    """
+    The DNS stub resolves cluster names remotely, other names locally, and
+    falls back to local lookups for names that weren't in the cluster.
+    """
+    remote_port, remote_asked = _fake_nameserver({
+        "myservice.corp.com": "10.3.0.5"
+    })
+    local_port, local_asked = _fake_nameserver({
+        "example.com": "1.2.3.4",
+        "intranet.corp.com": "192.168.1.1"
+    })
+    stub = telepresence.dns.StubResolver(
+        FakeRunner(),
+        telepresence.dns.SplitDomains(["default"], ["corp.com"]),
+        ("127.0.0.1", remote_port),
+        ("127.0.0.1", local_port),
+    )
+    stub.start()
+    try:
+
+        def lookup(name):
+            return telepresence.dns.query("127.0.0.1", name, 5, stub.port)
+
+        assert lookup("myservice.corp.com") == ["10.3.0.5"]
+        assert lookup("example.com") == ["1.2.3.4"]
+        assert lookup("intranet.corp.com") == ["192.168.1.1"]
+        assert lookup("nosuch.example.com") == []
+        assert remote_asked == ["myservice.corp.com", "intranet.corp.com"]
+        assert local_asked == [
+            "example.com", "intranet.corp.com", "nosuch.example.com"
+        ]
+    finally:
+        stub.close()
+
+
+def test_stub_resolver_cache():
+    """
+    The DNS stub answers repeated questions from its cache, negative answers
+    included, and asks only once when the same question arrives while it's
+    waiting for an answer.
+    """
+    port, asked = _fake_nameserver({"db.example.com": "10.0.0.1"}, 0.2)
+    stub = telepresence.dns.StubResolver(
+        FakeRunner(),
+        telepresence.dns.RemoteDomains(),
+        ("127.0.0.1", port),
+        ("127.0.0.1", port),
+    )
+    stub.start()
+    try:
+
+        def lookup(name):
+            return telepresence.dns.query("127.0.0.1", name, 5, stub.port)
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lookup, ["db.example.com"] * 4))
+        assert results == [["10.0.0.1"]] * 4
+        assert lookup("db.example.com") == ["10.0.0.1"]
+        assert lookup("nosuch.example.com") == []
+        assert lookup("NoSuch.example.com") == []
+        assert asked == ["db.example.com", "nosuch.example.com"]
+        # Cached answers say how much longer they're valid:
+        response = stub.cache.get(("db.example.com", telepresence.dns.TYPE_A))
+        assert 0 < struct.unpack("!I", response[-10:-6])[0] <= 5
+    finally:
+        stub.close()
+
+
+def test_response_ttl():
+    """
+    Answers may be cached for their lowest TTL, negative responses for the
+    TTL in their SOA record, and failures not at all.
+    """
+    query = telepresence.dns.build_query("db.example.com", 1)
+    header = query[:2] + b"\x81\x80\x00\x01"
+    record = b"\xc0\x0c\x00\x01\x00\x01{}\x00\x04\x0a\x00\x00\x01"
+    answer = header + b"\x00\x02\x00\x00\x00\x00" + query[12:] + \
+        record.replace(b"{}", struct.pack("!I", 30)) + \
+        record.replace(b"{}", struct.pack("!I", 20))
+    assert telepresence.dns.response_ttl(answer) == 20
+    soa_data = b"\x00\x00" + struct.pack("!IIIII", 1, 2, 3, 4, 60)
+    soa = b"\xc0\x0c\x00\x06\x00\x01" + struct.pack(
+        "!IH", 300, len(soa_data)
+    ) + soa_data
+    nxdomain = query[:2] + b"\x81\x83\x00\x01\x00\x00\x00\x01\x00\x00"
+    assert telepresence.dns.response_ttl(nxdomain + query[12:] + soa) == 60
+    assert telepresence.dns.response_ttl(
+        nxdomain[:-4] + b"\x00\x00\x00\x00" + query[12:]
+    ) == telepresence.dns.NEGATIVE_TTL
+    servfail = query[:2] + b"\x81\x82" + query[4:]
+    assert telepresence.dns.response_ttl(servfail) is None
+
+
+def test_swap_deployment_tun():
+    """
+    For --method vpn-tun the swapped Deployment runs the proxy privileged, so
+    it can create a TUN device.
+    """
+    original = yaml.safe_load(COMPLEX_DEPLOYMENT)
+    new, _ = telepresence.deployment.new_swapped_deployment(
+        original,
+        "nginxhttps",
+        "random_id_123",
+        "datawire/telepresence-k8s:0.777",
+        False,
+        False,
+        tun=True,
+    )
+    container = new["spec"]["template"]["spec"]["containers"][1]
+    assert container["securityContext"] == {
+        "runAsUser": 0,
+        "privileged": True
+    }
+    assert {"name": "TELEPRESENCE_TUN", "value": "1"} in container["env"]
+
+
+def test_vpn_tun_needs_own_deployment():
+    """
+    --method vpn-tun can't use an existing Deployment, since the proxy has to
+    run privileged.
+    """
+    with pytest.raises(SystemExit):
+        telepresence.cli.parse_args([
+            "--method", "vpn-tun", "--deployment", "existing"
+        ])
+    args = telepresence.cli.parse_args(["--method", "vpn-tun", "--split-dns"])
+    assert args.new_deployment is not None
+
+
+def test_mount_profiles(tmpdir):
+    """
+    The sshfs options of the chosen --mount-profile make it to the sshfs
+    command line.
+    """
+    assert telepresence.cli.parse_args([]).mount_profile == "default"
+    ssh = argparse.Namespace(
+        host="localhost", port=2222, options=lambda: ["Option=yes"]
+    )
+
+    class Runner(FakeRunner):
+        def check_call(self, args):
+            self.sshfs = args
+
+    for profile in ("default", "read-heavy", "consistent"):
+        args = telepresence.cli.parse_args(["--mount-profile", profile])
+        runner = Runner()
+        succeeded, _ = telepresence.remote.sshfs_volumes(
+            runner, None, ssh, str(tmpdir), False, args.mount_profile, "all"
+        )
+        assert succeeded
+        assert runner.sshfs[0] == "sshfs"
+        options = [
+            option for (flag, option) in zip(runner.sshfs, runner.sshfs[1:])
+            if flag == "-o"
+        ]
+        assert options[0] == "Option=yes"
+        assert options[1:1 + len(telepresence.remote.MOUNT_PROFILES[profile])
+                       ] == telepresence.remote.MOUNT_PROFILES[profile]
+    assert "cache=no" in options
+
+
+def test_volume_mount_paths():
+    """
+    The declared volume mounts come from the pod, so ones Kubernetes adds are
+    included, and mounts inside other mounts are left out.
+    """
+    container = {
+        "name": "app",
+        "image": "datawire/telepresence-k8s:0.777",
+        "volumeMounts": [{
+            "mountPath": "/etc/config"
+        }, {
+            "mountPath": "/etc/config/extra/"
+        }, {
+            "mountPath": "/etc/config-other"
+        }],
+    }
+    deployment = {"spec": {"template": {"spec": {"containers": [container]}}}}
+    pod_container = dict(container)
+    pod_container["volumeMounts"] = container["volumeMounts"] + [{
+        "mountPath": "/var/run/secrets/kubernetes.io/serviceaccount"
+    }]
+
+    class PodRunner(FakeRunner):
+        def get_kubectl(self, context, namespace, args):
+            assert args[:3] == ["get", "pod", "mypod"]
+            return json.dumps({"spec": {"containers": [pod_container]}})
+
+    runner = PodRunner()
+    remote_info = telepresence.remote.RemoteInfo(
+        runner, "ctx", "default", "mydeployment", "mypod", deployment
+    )
+    assert telepresence.remote.get_volume_mount_paths(
+        runner, remote_info
+    ) == [
+        "/etc/config", "/etc/config-other",
+        "/var/run/secrets/kubernetes.io/serviceaccount"
+    ]
+
+
+class LocalSSH(object):
+    """Stands in for SSH by running "remote" commands locally."""
+
+    def command(self, additional_args):
+        return ["sh", "-c"] + additional_args
+
+
+class LocalRunner(FakeRunner):
+    def check_call(self, args, input=None):
+        subprocess.run(args, input=input, check=True)
+
+    def get_output(self, args):
+        return subprocess.check_output(args).decode("utf-8").strip()
+
+
+def test_volume_snapshot(tmpdir, monkeypatch):
+    """
+    A volume snapshot copies the volumes, and resyncing only copies files
+    that changed since.
+    """
+    monkeypatch.setattr(
+        telepresence.remote.VolumeSnapshot, "MARKER", str(tmpdir / "marker")
+    )
+    volume = tmpdir.mkdir("volume")
+    volume.join("config").write("old")
+    volume.join("unchanged").write("same")
+    local = tmpdir.mkdir("local")
+    snapshot = telepresence.remote.VolumeSnapshot(
+        LocalRunner(), LocalSSH(), [str(volume)], str(local)
+    )
+    snapshot.sync()
+    copy = local.join(str(volume))
+    assert copy.join("config").read() == "old"
+    assert copy.join("unchanged").read() == "same"
+
+    # Pretend the sync was a while ago, and only some files changed since:
+    now = time.time()
+    for path, age in [(tmpdir / "marker", 10), (volume / "unchanged", 20)]:
+        os.utime(str(path), (now - age, now - age))
+    volume.join("config").write("new")
+    volume.join("added").write("added")
+    for name in ("config", "added"):
+        os.utime(str(volume.join(name)), (now - 5, now - 5))
+    assert sorted(snapshot.resync()) == [
+        str(volume.join("added"))[1:], str(volume.join("config"))[1:]
+    ]
+    assert copy.join("config").read() == "new"
+    assert copy.join("added").read() == "added"
+    assert snapshot.resync() == []
+
+
+def test_volume_snapshot_no_volumes(tmpdir):
+    """
+    A container without volumes gets an empty snapshot, rather than a copy of
+    its whole filesystem.
+    """
+
+    class NoRemoteRunner(FakeRunner):
+        def get_output(self, args):
+            raise AssertionError("Ran {}".format(args))
+
+        def check_call(self, args, input=None):
+            raise AssertionError("Ran {}".format(args))
+
+    snapshot = telepresence.remote.VolumeSnapshot(
+        NoRemoteRunner(), LocalSSH(), [], str(tmpdir)
+    )
+    assert snapshot.sync() == []
+    assert snapshot.resync() == []
+    assert tmpdir.listdir() == []
+
+
+def test_mount_remote_volumes_in_background(monkeypatch):
+    """
+    Mounting volumes doesn't block the caller; the ready marker appears once
+    it's done, and cleanup waits for it.
+    """
+    release = threading.Event()
+    cleaned = []
+
+    def slow_snapshot(runner, remote_info, ssh, directory, *args):
+        release.wait()
+        return True, lambda: cleaned.append(directory)
+
+    monkeypatch.setattr(
+        telepresence.remote, "snapshot_volumes", slow_snapshot
+    )
+    mount = telepresence.remote.mount_remote_volumes
+    mount_dir, ready_marker, cleanup = mount(
+        FakeRunner(), None, None, False, volume_mode="snapshot"
+    )
+    assert not os.path.exists(ready_marker)
+    assert not telepresence.remote.wait_for_volumes(ready_marker, 0.2)
+    release.set()
+    assert telepresence.remote.wait_for_volumes(ready_marker, 5)
+    cleanup()
+    assert cleaned == [mount_dir]
+    assert not os.path.exists(ready_marker)
+
+
+def test_mount_remote_volumes_failure_is_marked(monkeypatch):
+    """If mounting blows up, the ready marker still says so."""
+
+    def broken_snapshot(*args):
+        raise OSError("no space left")
+
+    monkeypatch.setattr(
+        telepresence.remote, "snapshot_volumes", broken_snapshot
+    )
+    _, ready_marker, cleanup = telepresence.remote.mount_remote_volumes(
+        FakeRunner(), None, None, False, volume_mode="snapshot"
+    )
+    assert not telepresence.remote.wait_for_volumes(ready_marker, 5)
+    with open(ready_marker) as f:
+        assert f.read() == "failed\n"
+    cleanup()
+
+
+def test_volume_snapshot_cached(tmpdir, monkeypatch):
+    """
+    With a content cache, a later snapshot gets unchanged files from the
+    cache instead of transferring them.
+    """
+    monkeypatch.setattr(
+        telepresence.remote.VolumeSnapshot, "MARKER", str(tmpdir / "marker")
+    )
+    volume = tmpdir.mkdir("volume")
+    volume.join("model").write("weights")
+    volume.join("token").write("secret")
+    cache = telepresence.cache.ContentCache(2**20, Path(str(tmpdir / "cache")))
+
+    def snapshot(name):
+        runner = LocalRunner()
+        runner.transferred = []
+        check_call = runner.check_call
+
+        def record(args, input=None):
+            runner.transferred += input.decode("utf-8").split()
+            check_call(args, input)
+
+        runner.check_call = record
+        local = tmpdir.mkdir(name)
+        telepresence.remote.VolumeSnapshot(
+            runner, LocalSSH(), [str(volume)], str(local), cache
+        ).sync()
+        return local.join(str(volume)), runner.transferred
+
+    _, transferred = snapshot("first")
+    assert len(transferred) == 2
+    volume.join("token").write("rotated")
+    copy, transferred = snapshot("second")
+    assert transferred == [str(volume.join("token"))[1:]]
+    assert copy.join("model").read() == "weights"
+    assert copy.join("token").read() == "rotated"
+
+
+def test_content_cache_evicts_least_recently_used(tmpdir):
+    """The content cache stays within its size by dropping unused files."""
+    cache = telepresence.cache.ContentCache(10, Path(str(tmpdir / "cache")))
+    source = tmpdir.join("source")
+    source.write("12345")
+    for i, name in enumerate(["a", "b", "c"]):
+        cache.store(name, 5, 0, str(source))
+        # Make use order unambiguous:
+        os.utime(str(cache._path(name, 5, 0)), (i, i))
+    assert cache.restore("a", 5, 0, str(tmpdir / "restored"))
+    cache.evict()
+    assert cache.restore("a", 5, 0, str(tmpdir / "restored"))
+    assert not cache.restore("b", 5, 0, str(tmpdir / "restored"))
+    assert cache.restore("c", 5, 0, str(tmpdir / "restored"))